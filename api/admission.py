@@ -0,0 +1,129 @@
+"""
+Admission control of uploads, from their headers, before their body is read.
+
+An upload holds one of a fixed number of slots on the node while it is received, further uploads
+are answered 503 with a Retry-After header instead of competing for the disk. Each slot records the
+Content-Length of its upload, the free space of data_path must fit all the uploads in progress.
+The slots are disabled by default (upload_max_concurrent 0): the uploads are then not limited in number
+and only checked against the size limits on their own, set upload_max_concurrent to e.g. 8 to enable them.
+"""
+
+import os
+import errno
+import fcntl
+import tempfile
+
+from . import util
+from . import config
+
+log = config.log
+
+# seconds the clients are asked to wait before retrying an upload refused for overload
+RETRY_AFTER = 30
+
+
+class AdmissionException(Exception):
+
+    def __init__(self, status, message, retry_after=None):
+        super(AdmissionException, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _slots_path():
+    # the slots are local to the node, data_path can be shared by several nodes
+    path = os.path.join(tempfile.gettempdir(), 'scitran-upload-slots')
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+def _reserved_size(slots_path, max_concurrent, own_slot):
+    """return the sum of the Content-Length of the other uploads in progress"""
+    reserved = 0
+    for i in range(max_concurrent):
+        if i == own_slot:
+            continue
+        try:
+            with open(os.path.join(slots_path, str(i)), 'r') as fd:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except IOError:
+                    # the slot is held, its upload is in progress
+                    reserved += int(fd.read() or 0)
+                else:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return reserved
+
+def _check_size(content_length, data_path, max_size, min_free, reserved):
+    if content_length is None:
+        # the size of chunked uploads is only known once they are received
+        return
+    if max_size and content_length > max_size:
+        raise AdmissionException(413, 'upload of {} exceeds the maximum size of {}'.format(util.hrsize(content_length), util.hrsize(max_size)))
+    stat = os.statvfs(data_path)
+    free = stat.f_bavail * stat.f_frsize - reserved
+    if free - content_length < min_free:
+        raise AdmissionException(507, 'not enough free space for an upload of {}'.format(util.hrsize(content_length)))
+
+class UploadSlot(object):
+    """An upload slot held until the upload is received, usable as a context manager."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def release(self):
+        if self.fd is not None and not self.fd.closed:
+            self.fd.truncate(0)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.fd.close()
+
+def acquire_slot(content_length, data_path, max_concurrent, max_size=0, min_free=0, slots_path=None):
+    """
+    Acquire an upload slot and check that an upload of content_length bytes fits in data_path.
+    Raises AdmissionException if all the slots are held, or if the upload is too large.
+    With max_concurrent 0 the uploads are not limited in number, and the returned slot holds nothing.
+    """
+    if not max_concurrent:
+        _check_size(content_length, data_path, max_size, min_free, 0)
+        return UploadSlot(None)
+    slots_path = slots_path or _slots_path()
+    for i in range(max_concurrent):
+        fd = open(os.path.join(slots_path, str(i)), 'a+')
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            fd.close()
+            continue
+        slot = UploadSlot(fd)
+        try:
+            fd.truncate(0)
+            fd.write(str(content_length or 0))
+            fd.flush()
+            _check_size(content_length, data_path, max_size, min_free, _reserved_size(slots_path, max_concurrent, i))
+        except:
+            slot.release()
+            raise
+        return slot
+    raise AdmissionException(503, 'too many uploads in progress, retry later', retry_after=RETRY_AFTER)
+
+def acquire_upload_slot(request):
+    """acquire an upload slot for request, with the configured limits"""
+    return acquire_slot(
+        request.content_length,
+        config.get_item('persistent', 'data_path'),
+        int(config.get_item('persistent', 'upload_max_concurrent')),
+        max_size=int(config.get_item('persistent', 'upload_max_size')) * 2**20,
+        min_free=int(config.get_item('persistent', 'upload_min_free')) * 2**20,
+    )
@@ -5,8 +5,10 @@ import webapp2_extras.routes
 
 from . import base
 from . import jobs
+from . import gears
 from . import root
 from . import util
+from . import blobstore
 from . import config
 from . import centralclient
 from . import download
@@ -73,6 +75,7 @@ routes = [
     webapp2_extras.routes.PathPrefixRoute(r'/api', [
         webapp2.Route(r'/download',         download.Download, handler_method='download', methods=['GET', 'POST'], name='download'),
         webapp2.Route(r'/reaper',           upload.Upload, handler_method='reaper', methods=['POST']),
+        webapp2.Route(r'/reaper/batch',     upload.Upload, handler_method='reaper_batch', methods=['POST']),
         webapp2.Route(r'/engine',           upload.Upload, handler_method='engine', methods=['POST']),
         webapp2.Route(r'/sites',            centralclient.CentralClient, handler_method='sites', methods=['GET']),
         webapp2.Route(r'/register',         centralclient.CentralClient, handler_method='register', methods=['POST']),
@@ -87,12 +90,19 @@ routes = [
         webapp2.Route(_format(r'/<uid:{user_id_re}>/groups'),   grouphandler.GroupHandler, handler_method='get_all', methods=['GET'], name='groups'),
     ]),
     webapp2.Route(r'/api/jobs',             jobs.Jobs),
+    webapp2.Route(r'/api/engines/<:[^/]+>', jobs.Engine, methods=['GET', 'PUT']),
+    webapp2.Route(r'/api/gears',            gears.GearsHandler, methods=['GET', 'POST']),
+    webapp2.Route(r'/api/gears/<:[^/]+>',   gears.GearsHandler, handler_method='get_current', methods=['GET']),
     webapp2_extras.routes.PathPrefixRoute(r'/api/jobs', [
         webapp2.Route(r'/next',             jobs.Jobs, handler_method='next', methods=['GET']),
         webapp2.Route(r'/count',            jobs.Jobs, handler_method='count', methods=['GET']),
         webapp2.Route(r'/stats',            jobs.Jobs, handler_method='stats', methods=['GET']),
         webapp2.Route(r'/addTestJob',       jobs.Jobs, handler_method='addTestJob', methods=['GET']),
         webapp2.Route(r'/reap',             jobs.Jobs, handler_method='reap_stale', methods=['POST']),
+        webapp2.Route(r'/archive',          jobs.Jobs, handler_method='archive', methods=['POST']),
+        webapp2.Route(r'/<:[^/]+>/attempts', jobs.Job, handler_method='attempts', methods=['GET']),
+        webapp2.Route(r'/<:[^/]+>/heartbeat', jobs.Job, handler_method='heartbeat', methods=['POST']),
+        webapp2.Route(r'/<:[^/]+>/retry',   jobs.Job,  handler_method='retry', methods=['POST']),
         webapp2.Route(r'/<:[^/]+>',         jobs.Job,  name='job'),
     ]),
     webapp2.Route(r'/api/groups',                                   grouphandler.GroupHandler, handler_method='get_all', methods=['GET']),
@@ -162,6 +172,11 @@ def dispatcher(router, request, response):
 def app_factory(*_, **__):
     # don't use config.get_item() as we don't want to require the database at startup
     application = webapp2.WSGIApplication(routes, debug=config.__config['core']['debug'])
+    try:
+        blobstore.parse_shard_depths(config.__config['persistent']['blob_shard_depth'])
+    except ValueError as e:
+        log.critical('invalid configuration: ' + str(e))
+        sys.exit(1)
     application.router.set_dispatcher(dispatcher)
 
     # configure new relic
@@ -8,6 +8,7 @@ import urlparse
 import jsonschema
 
 from . import config
+from . import admission
 
 log = config.log
 
@@ -163,6 +164,17 @@ class RequestHandler(webapp2.RequestHandler):
                 if header in r.headers:
                     self.response.headers[header] = r.headers[header]
 
+    def admit_upload(self):
+        """
+        Check an upload from the request headers, before its body is read.
+        Returns the upload slot to hold while the body is received.
+        """
+        try:
+            return admission.acquire_upload_slot(self.request)
+        except admission.AdmissionException as e:
+            headers = {'Retry-After': str(e.retry_after)} if e.retry_after else None
+            self.abort(e.status, str(e), headers=headers)
+
     def abort(self, code, detail=None, **kwargs):
         if isinstance(detail, jsonschema.ValidationError):
             detail = {
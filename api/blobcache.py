@@ -0,0 +1,235 @@
+"""
+Local cache of frequently read blobs, in front of a slow data_path.
+
+The cache is a directory on a fast local disk holding copies of the original bytes of blobs, named by
+their hash. Reads go through the cache and fill it on misses, received files fill it when they are
+stored. The modification time of a cached blob is refreshed on each hit, the least recently used blobs
+are evicted when the cache grows over its maximum size. The cache can be shared by several processes.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import shutil
+import socket
+import threading
+
+from . import config
+from . import blobstore
+
+log = config.log
+
+# cached blobs are evicted down to this fraction of the maximum size
+EVICTION_TARGET = 0.9
+# the cache is scanned for eviction when this fraction of the maximum size has been added
+EVICTION_INTERVAL = 0.05
+# hit and miss counters are saved at most this often, in seconds
+STATS_INTERVAL = 60
+
+
+class BlobCache(object):
+
+    def __init__(self, cache_path, max_size, max_entry_size=None, stats_collection=None):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        # a few large blobs should not evict the whole cache
+        self.max_entry_size = max_entry_size if max_entry_size is not None else max_size / 10
+        self.stats_collection = stats_collection
+        self._added = max_size # scan on the first addition
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(('hits', 'misses', 'hit_bytes', 'miss_bytes', 'fill_bytes', 'upload_bytes', 'evicted_bytes'), 0)
+        self._stats_saved = time.time()
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+
+    def _path(self, hash_):
+        return os.path.join(self.cache_path, hash_)
+
+    def _count(self, **counts):
+        with self._lock:
+            for key, value in counts.iteritems():
+                self._stats[key] += value
+            if self.stats_collection is None or time.time() - self._stats_saved < STATS_INTERVAL:
+                return
+            stats, self._stats = self._stats, dict.fromkeys(self._stats, 0)
+            self._stats_saved = time.time()
+        try:
+            self.stats_collection.update_one({'_id': socket.gethostname()}, {'$inc': stats}, upsert=True)
+        except Exception as e: # the stats are not worth failing a read
+            log.warning('blob cache stats not saved: ' + str(e))
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def open(self, hash_, size):
+        """open the cached blob hash_, returns None on a miss, which is counted by tee when the cache is filled"""
+        path = self._path(hash_)
+        try:
+            fd = open(path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass # evicted in the meantime, the open file is still readable
+        self._count(hits=1, hit_bytes=size)
+        return fd
+
+    def tee(self, fd, hash_, size):
+        """wrap the blob hash_ read from fd, the blob is cached if it is read completely"""
+        if size > self.max_entry_size:
+            return fd
+        self._count(misses=1, miss_bytes=size)
+        return _CacheFillingFile(self, fd, hash_, size)
+
+    def add_file(self, path, hash_):
+        """copy the file at path in the cache, the bytes copied are counted apart from the fills of reads"""
+        size = os.path.getsize(path)
+        if size > self.max_entry_size or os.path.exists(self._path(hash_)):
+            return
+        temp_path = self._temp_path(hash_)
+        try:
+            shutil.copyfile(path, temp_path)
+            self._add(temp_path, hash_, size, stat='upload_bytes')
+        except (IOError, OSError) as e:
+            self._discard(temp_path, e)
+
+    def _temp_path(self, hash_):
+        return os.path.join(self.cache_path, '.%s.%d.%d' % (hash_, os.getpid(), threading.current_thread().ident))
+
+    def _add(self, temp_path, hash_, size, stat='fill_bytes'):
+        os.rename(temp_path, self._path(hash_))
+        self._count(**{stat: size})
+        with self._lock:
+            self._added += size
+            evict = self._added >= self.max_size * EVICTION_INTERVAL
+            if evict:
+                self._added = 0
+        if evict:
+            self.evict()
+
+    def _discard(self, temp_path, error):
+        log.warning('blob not cached: ' + str(error))
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """remove the least recently used blobs, until the cache is below its target size"""
+        with open(os.path.join(self.cache_path, '.lock'), 'w') as lock_fd:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return # another process is evicting
+            entries = []
+            total_size = 0
+            for filename in os.listdir(self.cache_path):
+                if filename.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_path, filename))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+                total_size += stat.st_size
+            if total_size <= self.max_size:
+                return
+            evicted_size = 0
+            for _, size, filename in sorted(entries):
+                if total_size - evicted_size <= self.max_size * EVICTION_TARGET:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_path, filename))
+                except OSError:
+                    continue
+                evicted_size += size
+            self._count(evicted_bytes=evicted_size)
+
+
+class _CacheFillingFile(object):
+    """A file-like object copying the data read from a blob to the cache."""
+
+    def __init__(self, cache, fd, hash_, size):
+        self.cache = cache
+        self.fd = fd
+        self.hash_ = hash_
+        self.size = size
+        self.bytes_read = 0
+        self.temp_path = cache._temp_path(hash_)
+        try:
+            self.cache_fd = open(self.temp_path, 'wb')
+        except IOError as e:
+            cache._discard(self.temp_path, e)
+            self.cache_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        self.bytes_read += len(data)
+        if self.cache_fd:
+            try:
+                self.cache_fd.write(data)
+            except IOError as e:
+                self.cache_fd.close()
+                self.cache_fd = None
+                self.cache._discard(self.temp_path, e)
+        return data
+
+    def close(self):
+        self.fd.close()
+        if self.cache_fd:
+            self.cache_fd.close()
+            self.cache_fd = None
+            if self.bytes_read == self.size:
+                try:
+                    self.cache._add(self.temp_path, self.hash_, self.size)
+                except OSError as e:
+                    self.cache._discard(self.temp_path, e)
+            else: # partial read, e.g. an interrupted download
+                self.cache._discard(self.temp_path, 'partial read')
+
+    @property
+    def closed(self):
+        return self.fd.closed
+
+
+_cache = None
+
+def get_cache():
+    """return the configured blob cache, or None if it is disabled"""
+    global _cache
+    cache_path = config.get_item('persistent', 'blob_cache_path')
+    if not cache_path:
+        return None
+    max_size = int(config.get_item('persistent', 'blob_cache_size')) * 2**20
+    if _cache is None or _cache.cache_path != cache_path or _cache.max_size != max_size:
+        _cache = BlobCache(cache_path, max_size, stats_collection=config.db.blob_cache_stats)
+    return _cache
+
+def open_blob(path, size):
+    """open the blob at path for reading its original bytes, through the cache"""
+    cache = get_cache()
+    if cache is None:
+        return blobstore.open_blob(path)
+    hash_ = os.path.basename(path)
+    fd = cache.open(hash_, size)
+    if fd is None:
+        fd = cache.tee(blobstore.open_blob(path), hash_, size)
+    return fd
+
+def add_file(path, hash_):
+    """copy a received file in the cache"""
+    cache = get_cache()
+    if cache is not None:
+        cache.add_file(path, hash_)
@@ -0,0 +1,484 @@
+"""
+Storage format of the blobs under data_path.
+
+Blobs are addressed by the hash of their content, at util.path_from_hash locations with the configured
+shard depth of their hash version, see resolve_path. Compressible blobs
+can be stored gzip compressed, at the blob path with a .gz suffix. Large blobs can be split in content
+defined chunks, stored once under data_path/chunks, and replaced by a manifest at the blob path with a
+.chunks suffix. The hash is always computed on the original bytes, readers use open_blob to get them back.
+"""
+
+import os
+import json
+import zlib
+import gzip
+import errno
+import fcntl
+import bisect
+import hashlib
+import pymongo
+import tempfile
+import contextlib
+import collections
+
+from . import util
+from . import config
+
+GZIP_SUFFIX = '.gz'
+GZIP_LEVEL = 6
+
+CHUNKS_SUFFIX = '.chunks'
+CHUNKS_DIR = 'chunks'
+
+# the first bytes of a blob are compressed to decide whether it is worth compressing
+SAMPLE_SIZE = 2**20
+
+# the number of directory levels of the blob paths, unless configured otherwise for their hash version
+DEFAULT_SHARD_DEPTH = 2
+MAX_SHARD_DEPTH = 8
+
+
+def parse_shard_depths(setting):
+    """
+    Parse a 'v0=3,v1=2' shard depth setting into a dict of the depth of each hash version.
+    Raises ValueError if the setting is malformed.
+    """
+    depths = {}
+    for item in (setting or '').split(','):
+        if item.strip():
+            try:
+                hash_version, depth = item.split('=')
+                depth = int(depth)
+            except ValueError:
+                raise ValueError('malformed blob_shard_depth item {!r}, expected <hash version>=<depth>'.format(item))
+            if not 1 <= depth <= MAX_SHARD_DEPTH:
+                raise ValueError('blob_shard_depth {} out of range 1..{}'.format(depth, MAX_SHARD_DEPTH))
+            depths[hash_version.strip()] = depth
+    return depths
+
+# (setting, parsed depths) of the last configured blob_shard_depth, parsed once
+_shard_depths = (None, {})
+
+def shard_depths():
+    """the configured shard depth of each hash version"""
+    global _shard_depths
+    setting = config.get_item('persistent', 'blob_shard_depth')
+    if _shard_depths[0] != setting:
+        _shard_depths = (setting, parse_shard_depths(setting))
+    return _shard_depths[1]
+
+def shard_depth(hash_):
+    return shard_depths().get(hash_.split('-')[0], DEFAULT_SHARD_DEPTH)
+
+# hash version -> shard depths still holding blobs, from the shard_depths document of blobs_status
+_depths_in_use = util.LRUCache(maxsize=16, ttl=60)
+
+def depths_in_use(hash_version, depth):
+    """
+    Return the shard depths that can hold blobs of hash_version, the configured depth first.
+
+    Every configured depth is recorded in blobs_status until a migration moves all the blobs to the
+    configured depth. Stores that were never migrated have their blobs at the default depth.
+    """
+    depths = _depths_in_use.get(hash_version)
+    if depths is None or depth not in depths:
+        status = config.db.blobs_status.find_one_and_update(
+            {'_id': 'shard_depths'},
+            {'$addToSet': {'depths.' + hash_version: {'$each': [DEFAULT_SHARD_DEPTH, depth]}}},
+            upsert=True,
+            return_document=pymongo.collection.ReturnDocument.AFTER,
+        )
+        depths = status['depths'][hash_version]
+        _depths_in_use.set(hash_version, depths)
+    return [depth] + [d for d in depths if d != depth]
+
+def migrated(depths):
+    """record that the blobs of each hash version are all at their depth in depths, after a complete migration"""
+    config.db.blobs_status.update_one(
+        {'_id': 'shard_depths'},
+        {'$set': dict(('depths.' + hash_version, [depth]) for hash_version, depth in depths.iteritems())},
+        upsert=True,
+    )
+    _depths_in_use.clear()
+
+def blob_path(data_path, hash_, depth=None):
+    """return the path of the blob hash_ with depth directory levels, the configured shard depth by default"""
+    return os.path.join(data_path, util.path_from_hash(hash_, shard_depth(hash_) if depth is None else depth))
+
+def resolve_path(data_path, hash_):
+    """
+    Return the path of the blob hash_, without the suffix of its format.
+
+    While a store is migrated to a new shard depth, blobs can still be at a depth used before, see depths_in_use.
+    The path with the configured depth is returned for blobs stored at no depth in use, e.g. new blobs.
+    """
+    depth = shard_depth(hash_)
+    path = blob_path(data_path, hash_, depth)
+    if stored_path(path) is None:
+        for other_depth in depths_in_use(hash_.split('-')[0], depth)[1:]:
+            other_path = blob_path(data_path, hash_, other_depth)
+            if stored_path(other_path) is not None:
+                return other_path
+    return path
+
+
+def compression_ratio():
+    """the maximum compressed/original size ratio of blobs stored compressed, None if compression is disabled"""
+    if not config.get_item('persistent', 'blob_compression'):
+        return None
+    return float(config.get_item('persistent', 'blob_compression_ratio'))
+
+def stored_path(path):
+    """return the path of the stored blob at path, compressed, chunked or not, or None if it does not exist"""
+    for suffix in ('', GZIP_SUFFIX, CHUNKS_SUFFIX):
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return None
+
+def iter_stored_blobs(data_path, after=None):
+    """
+    Yield the paths of the blobs stored under data_path, in any format and with any shard depth.
+    Blobs are yielded in path order, with after (a path relative to data_path) only the blobs after it.
+    """
+    after = after.split(os.sep) if after else []
+    for hash_version in sorted(os.listdir(data_path)):
+        if hash_version.startswith('.') or hash_version == CHUNKS_DIR:
+            continue
+        if after and hash_version < after[0]:
+            continue
+        dir_after = after[1:] if after and hash_version == after[0] else []
+        for path in _iter_blob_dir(os.path.join(data_path, hash_version), hash_version, dir_after):
+            yield path
+
+def _iter_blob_dir(dir_path, hash_version, after):
+    try:
+        names = sorted(os.listdir(dir_path))
+    except OSError as e:
+        # removed by the collector or a migration
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    for name in names:
+        if name.startswith('.') or (after and name < after[0]):
+            continue
+        path = os.path.join(dir_path, name)
+        if os.path.isdir(path):
+            for blob_path_ in _iter_blob_dir(path, hash_version, after[1:] if after and name == after[0] else []):
+                yield blob_path_
+        elif name.startswith(hash_version + '-') and after[:1] != [name]:
+            yield path
+
+def relink_blob(data_path, stored_path_, depth):
+    """
+    Move the stored blob at stored_path_ to its path with depth directory levels.
+    The blob is hard linked first, it is readable at one of its paths during the move.
+    Returns False if the blob is already in place or was removed in the meantime.
+    """
+    filename = os.path.basename(stored_path_)
+    target_path = os.path.join(os.path.dirname(blob_path(data_path, blob_filename(filename), depth)), filename)
+    if target_path == stored_path_:
+        return False
+    try:
+        os.makedirs(os.path.dirname(target_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    try:
+        os.link(stored_path_, target_path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        # EEXIST: linked by an interrupted run, or the same content was stored in the meantime
+        if e.errno != errno.EEXIST:
+            raise
+    os.remove(stored_path_)
+    return True
+
+def is_compressed(stored_path_):
+    return stored_path_.endswith(GZIP_SUFFIX)
+
+def is_chunked(stored_path_):
+    return stored_path_.endswith(CHUNKS_SUFFIX)
+
+def blob_filename(filename):
+    """return the name of the blob stored in the file filename, without the suffix of its format"""
+    for suffix in (GZIP_SUFFIX, CHUNKS_SUFFIX):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+def open_stored_blob(path, data_path=None):
+    """
+    Open the stored blob at path, returns the file and whether it is gzip compressed.
+    Chunked blobs are reassembled from the chunks under data_path, the configured one by default,
+    they are never compressed.
+    """
+    for suffix in ('', GZIP_SUFFIX, CHUNKS_SUFFIX):
+        try:
+            if suffix == CHUNKS_SUFFIX:
+                return open_chunked_blob(path + suffix, data_path=data_path), False
+            return open(path + suffix, 'rb'), suffix == GZIP_SUFFIX
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    raise IOError(errno.ENOENT, 'No such blob', path)
+
+def decompress(fd):
+    """wrap an open compressed blob to read its original bytes"""
+    gzip_fd = gzip.GzipFile(fileobj=fd, mode='rb')
+    # as in gzip.open, the GzipFile owns the underlying file and closes it
+    gzip_fd.myfileobj = fd
+    return gzip_fd
+
+def open_blob(path, data_path=None):
+    """open the blob at path for reading its original bytes"""
+    fd, compressed = open_stored_blob(path, data_path)
+    return decompress(fd) if compressed else fd
+
+def should_compress(path, max_ratio):
+    """check if the file at path compresses to at most max_ratio of its size, on a sample of its first bytes"""
+    with open(path, 'rb') as fd:
+        sample = fd.read(SAMPLE_SIZE)
+    if not sample:
+        return False
+    return len(zlib.compress(sample, GZIP_LEVEL)) <= max_ratio * len(sample)
+
+# mkstemp creates private files, the temporary files renamed into place get the permissions of new files
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def temp_path(target_dir):
+    """
+    Create an empty file with a unique hidden name in target_dir and return its path, for a file written
+    then renamed into place. The name is unique across the threads and the nodes sharing data_path.
+    """
+    fd, path = tempfile.mkstemp(dir=target_dir, prefix='.')
+    try:
+        os.fchmod(fd, 0o666 & ~_UMASK)
+    finally:
+        os.close(fd)
+    return path
+
+def compress_file(path, target_path):
+    """
+    Store the file at path gzip compressed at target_path with the gzip suffix, then remove it.
+    The file is compressed to a temporary file in the target directory and renamed into place.
+    Returns the number of bytes written.
+    """
+    compressed_path = temp_path(os.path.dirname(target_path))
+    try:
+        with open(path, 'rb') as fd, open(compressed_path, 'wb') as compressed_fd:
+            with gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL, fileobj=compressed_fd, mtime=0) as gzip_fd:
+                for chunk in iter(lambda: fd.read(2**20), ''):
+                    gzip_fd.write(chunk)
+        os.rename(compressed_path, target_path + GZIP_SUFFIX)
+    except:
+        if os.path.exists(compressed_path):
+            os.remove(compressed_path)
+        raise
+    os.remove(path)
+    return os.path.getsize(target_path + GZIP_SUFFIX)
+
+
+# content defined chunking with a gear rolling hash, as in FastCDC: the hash only depends on the last
+# 32 bytes, chunk boundaries move with the content when bytes are inserted or removed.
+_GEAR = [int(hashlib.sha256(chr(i)).hexdigest()[:8], 16) for i in range(256)]
+
+CHUNK_MIN_SIZE = 2**18
+CHUNK_AVG_BITS = 20 # 1 MiB chunks on average, after the minimum size
+CHUNK_MAX_SIZE = 2**22
+
+def _chunk_boundary(data, start, end, min_size, mask, max_size):
+    """return the end of the chunk starting at start in data[:end], or None if it needs more data"""
+    gear = _GEAR
+    h = 0
+    stop = min(end, start + max_size)
+    # the bytes before the minimum size are not hashed, the hash only depends on the last 32 bytes
+    for i in xrange(max(start + min_size - 32, start), stop):
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        if not h & mask and i >= start + min_size:
+            return i + 1
+    if stop == start + max_size:
+        return stop
+    return None
+
+def iter_chunks(fd, min_size=CHUNK_MIN_SIZE, avg_bits=CHUNK_AVG_BITS, max_size=CHUNK_MAX_SIZE):
+    """yield the content defined chunks of the file fd"""
+    mask = ((1 << avg_bits) - 1) << (32 - avg_bits) # the upper bits depend on the most bytes
+    data = bytearray()
+    start = 0
+    eof = False
+    while not eof or start < len(data):
+        if not eof:
+            read = fd.read(max(max_size, 2**23))
+            eof = not read
+            data = data[start:] + read
+            start = 0
+        while start < len(data):
+            end = _chunk_boundary(data, start, len(data), min_size, mask, max_size)
+            if end is None:
+                if not eof:
+                    break
+                end = len(data)
+            yield str(data[start:end])
+            start = end
+
+def chunk_path(chunks_path, chunk_hash):
+    return os.path.join(chunks_path, chunk_hash[0:2], chunk_hash[2:4], chunk_hash)
+
+def write_chunks(fd, chunks_path, **kwargs):
+    """
+    Store the chunks of the file fd that are not stored yet under chunks_path.
+    Returns the manifest of the file and the number of bytes written.
+    """
+    manifest = {'size': 0, 'chunks': []}
+    bytes_written = 0
+    for chunk in iter_chunks(fd, **kwargs):
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+        manifest['chunks'].append([chunk_hash, len(chunk)])
+        manifest['size'] += len(chunk)
+        path = chunk_path(chunks_path, chunk_hash)
+        if not os.path.exists(path):
+            _write_file(path, chunk)
+            bytes_written += len(chunk)
+    return manifest, bytes_written
+
+def _write_file(path, data):
+    """write a file atomically, through a temporary file renamed into place"""
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    written_path = temp_path(os.path.dirname(path))
+    try:
+        with open(written_path, 'wb') as fd:
+            fd.write(data)
+        os.rename(written_path, path)
+    except:
+        os.remove(written_path)
+        raise
+
+def read_manifest(manifest_path):
+    with open(manifest_path, 'rb') as fd:
+        return json.load(fd)
+
+class ChunkedBlob(object):
+    """A read only file-like object reassembling a chunked blob, it supports seeking for zip member reads."""
+
+    def __init__(self, manifest, chunks_path):
+        self.chunks_path = chunks_path
+        self.chunks = manifest['chunks']
+        self.size = manifest['size']
+        self.offsets = []
+        offset = 0
+        for _, chunk_size in self.chunks:
+            self.offsets.append(offset)
+            offset += chunk_size
+        self.position = 0
+        self.closed = False
+        self._chunk_index = None
+        self._chunk_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError(errno.EINVAL, 'Invalid argument')
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        data = []
+        while size > 0 and self.position < self.size:
+            index = bisect.bisect_right(self.offsets, self.position) - 1
+            if index != self._chunk_index:
+                if self._chunk_fd:
+                    self._chunk_fd.close()
+                self._chunk_fd = open(chunk_path(self.chunks_path, self.chunks[index][0]), 'rb')
+                self._chunk_index = index
+            self._chunk_fd.seek(self.position - self.offsets[index])
+            chunk = self._chunk_fd.read(min(size, self.offsets[index] + self.chunks[index][1] - self.position))
+            if not chunk:
+                raise IOError(errno.EIO, 'truncated chunk', self.chunks[index][0])
+            data.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def close(self):
+        if self._chunk_fd:
+            self._chunk_fd.close()
+            self._chunk_fd = None
+        self.closed = True
+
+def chunks_path_for(data_path):
+    return os.path.join(data_path, CHUNKS_DIR)
+
+def open_chunked_blob(manifest_path, data_path=None):
+    manifest = read_manifest(manifest_path)
+    return ChunkedBlob(manifest, chunks_path_for(data_path or config.get_item('persistent', 'data_path')))
+
+@contextlib.contextmanager
+def chunks_lock(data_path):
+    """
+    Serialize the chunking and the removal of chunked blobs.
+    A chunk could otherwise be removed while a new manifest starts using it.
+    """
+    chunks_path = chunks_path_for(data_path)
+    if not os.path.exists(chunks_path):
+        os.makedirs(chunks_path)
+    with open(os.path.join(chunks_path, '.lock'), 'w') as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+def _update_chunk_refs(manifest, increment):
+    counts = collections.Counter(chunk_hash for chunk_hash, _ in manifest['chunks'])
+    if counts:
+        config.db.chunks.bulk_write([
+            pymongo.UpdateOne({'_id': chunk_hash}, {'$inc': {'refcount': increment * count}}, upsert=True)
+            for chunk_hash, count in counts.iteritems()
+        ], ordered=False)
+
+def chunk_blob(path, data_path):
+    """
+    Replace the uncompressed blob at path with a manifest of its chunks, stored once under data_path/chunks.
+    Returns the size of the blob and the number of bytes written for the new chunks.
+    """
+    with chunks_lock(data_path):
+        with open(path, 'rb') as fd:
+            manifest, bytes_written = write_chunks(fd, chunks_path_for(data_path))
+        # the chunks are referenced before the manifest is written, they are never removed while in use
+        _update_chunk_refs(manifest, 1)
+        _write_file(path + CHUNKS_SUFFIX, json.dumps(manifest))
+        os.remove(path)
+    return manifest['size'], bytes_written
+
+def remove_chunked_blob(manifest_path, data_path):
+    """remove a chunked blob, and the chunks no longer used by other blobs, returns the number of bytes removed"""
+    removed_bytes = 0
+    with chunks_lock(data_path):
+        manifest = read_manifest(manifest_path)
+        _update_chunk_refs(manifest, -1)
+        os.remove(manifest_path)
+        chunks_path = chunks_path_for(data_path)
+        for chunk_hash, chunk_size in manifest['chunks']:
+            if config.db.chunks.find_one_and_delete({'_id': chunk_hash, 'refcount': {'$lte': 0}}):
+                os.remove(chunk_path(chunks_path, chunk_hash))
+                removed_bytes += chunk_size
+    return removed_bytes
@@ -46,6 +46,15 @@ DEFAULT_CONFIG = {
         'db_connect_timeout': '2000',
         'db_server_selection_timeout': '3000',
         'data_path': os.path.join(os.path.dirname(__file__), '../persistent/data'),
+        'blob_compression': False,
+        'blob_compression_ratio': '0.8',
+        'blob_cache_path': None,
+        'blob_cache_size': '10240',
+        'blob_shard_depth': '',
+        'upload_max_concurrent': '0',
+        'upload_max_size': '0',
+        'upload_min_free': '1024',
+        'job_archive_age': '30',
     },
 }
 
@@ -89,7 +98,6 @@ def initialize_db():
     log.info('Initializing database')
     if not db.system.indexes.find_one():
         log.info('Creating database indexes')
-        # TODO jobs indexes
         # TODO review all indexes
         db.projects.create_index([('gid', 1), ('name', 1)])
         db.sessions.create_index('project')
@@ -101,6 +109,40 @@ def initialize_db():
         db.authtokens.create_index('timestamp', expireAfterSeconds=600)
         db.uploads.create_index('timestamp', expireAfterSeconds=60)
         db.downloads.create_index('timestamp', expireAfterSeconds=60)
+    # created on every start, existing databases get the indexes added since they were created
+    db.jobs.create_index([('state', 1), ('modified', 1)])
+    db.jobs.create_index([('state', 1), ('expires', 1)])
+    if 'state_1_heartbeat_1' in db.jobs.index_information():
+        db.jobs.drop_index('state_1_heartbeat_1')
+    # running jobs claimed before their lease expiration was stored
+    for job in db.jobs.find({'state': 'running', 'expires': {'$exists': False}}, ['heartbeat', 'modified', 'lease']):
+        expires = job.get('heartbeat', job['modified']) + datetime.timedelta(seconds=job.get('lease', 100))
+        db.jobs.update_one({'_id': job['_id'], 'state': 'running', 'expires': {'$exists': False}}, {'$set': {'expires': expires}})
+    db.jobs.create_index('reaped', sparse=True)
+    # the claims of engines other than the data-local ones filter on modified
+    db.jobs.create_index([('state', 1), ('priority', -1), ('vtime', 1), ('modified', 1)])
+    if 'state_1_priority_-1_vtime_1' in db.jobs.index_information():
+        db.jobs.drop_index('state_1_priority_-1_vtime_1')
+    db.jobs.create_index('memo_key', sparse=True)
+    # job listings, newest first, filtered by state, algorithm, tags or input container
+    db.jobs.create_index([('modified', -1), ('_id', -1)])
+    db.jobs.create_index([('state', 1), ('modified', -1), ('_id', -1)])
+    db.jobs.create_index([('algorithm_id', 1), ('modified', -1), ('_id', -1)])
+    db.jobs.create_index([('tags', 1), ('modified', -1), ('_id', -1)])
+    db.jobs.create_index([('input.container_type', 1), ('input.container_id', 1), ('modified', -1), ('_id', -1)])
+    db.jobs_archive.create_index([('modified', -1), ('_id', -1)])
+    db.jobs_archive.create_index('memo_key', sparse=True)
+    db.gears.create_index([('name', 1), ('version', 1)], unique=True)
+    db.gears.create_index([('name', 1), ('created', -1)])
+    # jobs queued before the priorities are scheduled with normal priority, ahead of the new ones
+    db.jobs.update_many({'state': 'pending', 'priority': {'$exists': False}}, {'$set': {'priority': 1, 'vtime': 0.0}})
+    # long-polling engines are woken up by tailing job_events, which needs a capped collection with a document
+    if 'job_events' not in db.collection_names():
+        try:
+            db.create_collection('job_events', capped=True, size=2**20)
+            db.job_events.insert_one({'queued': 0})
+        except pymongo.errors.CollectionInvalid: # created concurrently
+            pass
 
     now = datetime.datetime.utcnow()
     db.groups.update_one({'_id': 'unknown'}, {'$setOnInsert': { 'created': now, 'modified': now, 'name': 'Unknown', 'roles': []}}, upsert=True)
@@ -0,0 +1,193 @@
+"""
+Reference counts of the blobs in the content addressed store.
+
+The blobs collection maps each hash to the number of fileinfos referencing it, in live containers and in
+snapshots. Counts are updated when files are added, replaced and deleted, and when containers and snapshots
+holding files are removed. Blobs whose count drops to zero get a zero_since date and are reclaimed by collect()
+after a grace period.
+
+The counts are not updated atomically with the containers, a blob is unlinked only after checking
+that no container references it. reindex() rebuilds the counts from the containers.
+"""
+
+import os
+import time
+import errno
+import pymongo
+import datetime
+import collections
+
+from .. import util
+from .. import files
+from .. import blobstore
+from .. import config
+
+log = config.log
+
+# collections holding fileinfos in their files list
+FILE_COLLECTIONS = [
+    'projects', 'sessions', 'acquisitions', 'collections',
+    'project_snapshots', 'session_snapshots', 'acquisition_snapshots',
+]
+
+TRASH_DIR = '.trash'
+
+
+class BlobRefsException(Exception):
+    pass
+
+
+def file_hashes(containers):
+    """return the hashes of the files in containers, once for each fileinfo"""
+    return [f['hash'] for c in containers for f in c.get('files', []) if f.get('hash')]
+
+def find_file_hashes(cont_name, query):
+    """return the hashes of the files in the containers of cont_name matching query"""
+    return file_hashes(config.db[cont_name].find(query, ['files.hash']))
+
+def add_refs(hashes):
+    counts = collections.Counter(hashes)
+    if not counts:
+        return
+    config.db.blobs.bulk_write([
+        pymongo.UpdateOne({'_id': hash_}, {'$inc': {'refcount': count}, '$unset': {'zero_since': ''}}, upsert=True)
+        for hash_, count in counts.iteritems()
+    ], ordered=False)
+
+def remove_refs(hashes):
+    """
+    Decrement the reference counts of hashes, without going below zero.
+    The blobs without a count, stored before the counts were indexed, are left to reindex().
+    """
+    counts = collections.Counter(hashes)
+    if not counts:
+        return
+    operations = []
+    for hash_, count in counts.iteritems():
+        # the clamp is applied first, so that it never applies to a count just decremented
+        operations.append(pymongo.UpdateOne({'_id': hash_, 'refcount': {'$lt': count}}, {'$set': {'refcount': 0}}))
+        operations.append(pymongo.UpdateOne({'_id': hash_, 'refcount': {'$gte': count}}, {'$inc': {'refcount': -count}}))
+    config.db.blobs.bulk_write(operations, ordered=True)
+    config.db.blobs.update_many(
+        {'_id': {'$in': counts.keys()}, 'refcount': {'$lte': 0}, 'zero_since': {'$exists': False}},
+        {'$set': {'zero_since': datetime.datetime.utcnow()}}
+    )
+
+def replace_refs(old_hashes, new_hashes):
+    add_refs(new_hashes)
+    remove_refs(old_hashes)
+
+def create_indexes():
+    config.db.blobs.create_index('zero_since', sparse=True)
+    for cont_name in FILE_COLLECTIONS:
+        config.db[cont_name].create_index('files.hash')
+
+def is_referenced(hash_):
+    """check the containers for a reference to hash_, regardless of the reference count"""
+    return any(config.db[cont_name].find_one({'files.hash': hash_}, ['_id']) for cont_name in FILE_COLLECTIONS)
+
+def index_complete():
+    return config.db.blobs_status.find_one({'_id': 'refcounts', 'complete': True}) is not None
+
+def _iter_stored_hashes(data_path):
+    """yield the hashes of the blobs stored under data_path"""
+    for path in blobstore.iter_stored_blobs(data_path):
+        yield blobstore.blob_filename(os.path.basename(path))
+
+def reindex(scan_store=True):
+    """
+    Rebuild the reference counts from the containers and the snapshots.
+
+    With scan_store, the store is walked once to register the blobs that are not referenced,
+    e.g. blobs of files deleted before the counts were maintained.
+    Returns the number of referenced and unreferenced blobs.
+    """
+    config.db.blobs_status.update_one({'_id': 'refcounts'}, {'$set': {'complete': False}}, upsert=True)
+    create_indexes()
+    now = datetime.datetime.utcnow()
+    counts = collections.Counter()
+    for cont_name in FILE_COLLECTIONS:
+        pipeline = [
+            {'$match': {'files.hash': {'$exists': True}}},
+            {'$unwind': '$files'},
+            {'$group': {'_id': '$files.hash', 'count': {'$sum': 1}}},
+        ]
+        for result in config.db[cont_name].aggregate(pipeline):
+            if result['_id']:
+                counts[result['_id']] += result['count']
+    operations = [
+        pymongo.UpdateOne({'_id': hash_}, {'$set': {'refcount': count, 'reindexed': now}, '$unset': {'zero_since': ''}}, upsert=True)
+        for hash_, count in counts.iteritems()
+    ]
+    if scan_store:
+        operations.extend(
+            pymongo.UpdateOne({'_id': hash_}, {'$set': {'refcount': 0, 'reindexed': now}, '$min': {'zero_since': now}}, upsert=True)
+            for hash_ in _iter_stored_hashes(config.get_item('persistent', 'data_path')) if hash_ not in counts
+        )
+    for i in range(0, len(operations), 1000):
+        config.db.blobs.bulk_write(operations[i:i + 1000], ordered=False)
+    # the blobs that are no longer referenced
+    config.db.blobs.update_many({'reindexed': {'$ne': now}}, {'$set': {'refcount': 0, 'reindexed': now}, '$min': {'zero_since': now}})
+    config.db.blobs_status.update_one({'_id': 'refcounts'}, {'$set': {'complete': True, 'reindexed': now}})
+    return len(counts), config.db.blobs.count({'refcount': {'$lte': 0}})
+
+def collect(grace=datetime.timedelta(days=1), limit=1000, rate=None, dry_run=False):
+    """
+    Remove up to limit blobs that have been unreferenced for longer than grace, at most rate blobs per second.
+
+    Each blob is moved to the trash before checking again the containers and the blob modification time,
+    which is refreshed by uploads of the same content. Blobs found in use are restored.
+    Returns the number of removed blobs and bytes.
+    """
+    if not index_complete():
+        raise BlobRefsException('blob reference counts are incomplete, run a reindex first')
+    data_path = config.get_item('persistent', 'data_path')
+    trash_path = os.path.join(data_path, TRASH_DIR)
+    if not os.path.exists(trash_path):
+        os.makedirs(trash_path)
+    cutoff = datetime.datetime.utcnow() - grace
+    removed = removed_bytes = 0
+    for blob in config.db.blobs.find({'zero_since': {'$lt': cutoff}}).sort('zero_since').limit(limit):
+        start_time = time.time()
+        hash_ = blob['_id']
+        path = blobstore.resolve_path(data_path, hash_)
+        if blob['refcount'] > 0 or is_referenced(hash_):
+            log.warning('Keeping     %s (referenced, refcount %d)' % (hash_, blob['refcount']))
+            config.db.blobs.update_one({'_id': hash_}, {'$unset': {'zero_since': ''}})
+            continue
+        if dry_run:
+            log.info('Would remove %s' % hash_)
+            removed += 1
+            continue
+        stored_path = blobstore.stored_path(path)
+        if stored_path is None:
+            config.db.blobs.delete_one({'_id': hash_, 'refcount': {'$lte': 0}})
+            continue
+        blob_trash_path = os.path.join(trash_path, os.path.basename(stored_path))
+        try:
+            os.rename(stored_path, blob_trash_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            config.db.blobs.delete_one({'_id': hash_, 'refcount': {'$lte': 0}})
+            continue
+        stat = os.stat(blob_trash_path)
+        if (datetime.datetime.utcfromtimestamp(stat.st_mtime) > cutoff or
+                config.db.blobs.find_one({'_id': hash_, 'refcount': {'$gt': 0}}) or is_referenced(hash_)):
+            # the blob has been uploaded or referenced again in the meantime
+            log.info('Restoring   %s (in use)' % hash_)
+            files.move_file(blob_trash_path, stored_path)
+            continue
+        if blobstore.is_chunked(blob_trash_path):
+            size = blobstore.remove_chunked_blob(blob_trash_path, data_path)
+        else:
+            os.remove(blob_trash_path)
+            size = stat.st_size
+        config.db.blobs.delete_one({'_id': hash_, 'refcount': {'$lte': 0}})
+        config.db.zip_indexes.delete_one({'_id': hash_})
+        removed += 1
+        removed_bytes += size
+        log.info('Removed     %s [%s]' % (hash_, util.hrsize(size)))
+        if rate:
+            time.sleep(max(0, 1.0 / rate - (time.time() - start_time)))
+    return removed, removed_bytes
@@ -3,13 +3,16 @@ import bson.errors
 from .. import util
 from .. import config
 from . import APIStorageException
+from . import reaperutil
+from . import blobrefs
 
 log = config.log
 
 def project_purge(method, _id, payload=None):
     assert method == 'DELETE'
-    sessions = config.db.sessions.find({'project': util.ObjectId(_id)})
+    sessions = list(config.db.sessions.find({'project': util.ObjectId(_id)}))
     session_ids = [s['_id'] for s in sessions]
+    hashes = blobrefs.file_hashes(sessions) + blobrefs.find_file_hashes('acquisitions', {'session': {'$in': session_ids}})
 
     delete_acquisitions = config.db.acquisitions.delete_many({'session': {'$in': session_ids}})
     if not delete_acquisitions.acknowledged:
@@ -18,6 +21,8 @@ def project_purge(method, _id, payload=None):
     delete_sessions = config.db.sessions.delete_many({'project': util.ObjectId(_id)})
     if not delete_sessions.acknowledged:
         raise APIStorageException('sessions within project {} have not been deleted'.format(_id))
+    reaperutil.invalidate_hierarchy_cache(util.ObjectId(_id))
+    blobrefs.remove_refs(hashes)
 
 def acquisitions_in_project(method, _id, payload=None):
     assert method == 'GET'
@@ -1,10 +1,14 @@
+import copy
+import math
 import difflib
 import pymongo
 import datetime
+import threading
 import dateutil.parser
 
 from .. import util
 from .. import config
+from . import blobrefs
 from . import APIStorageException
 
 log = config.log
@@ -46,6 +50,11 @@ class TargetAcquisition(object):
             return_document=pymongo.collection.ReturnDocument.AFTER
         )
 
+    def commit_files(self, added, updated):
+        for fileinfo in added + updated:
+            fileinfo.update(self.fileinfo)
+        return commit_fileinfos('acquisitions', self.acquisition['_id'], added, updated)
+
 def update_fileinfo(cont_name, _id, fileinfo):
     update_set = {'files.$.modified': datetime.datetime.utcnow()}
     # in this method, we are overriding an existing file.
@@ -65,11 +74,156 @@ def add_fileinfo(cont_name, _id, fileinfo):
         return_document=pymongo.collection.ReturnDocument.AFTER
     )
 
+def commit_fileinfos(cont_name, _id, added, updated):
+    """
+    Add new fileinfos and override existing ones in a container with a single bulk write.
+    Returns the container after the update.
+    """
+    now = datetime.datetime.utcnow()
+    operations = []
+    if added:
+        operations.append(pymongo.UpdateOne({'_id': _id}, {'$push': {'files': {'$each': added}}}))
+    for fileinfo in updated:
+        update_set = {'files.$.modified': now}
+        for k,v in fileinfo.iteritems():
+            update_set['files.$.' + k] = v
+        operations.append(pymongo.UpdateOne({'_id': _id, 'files.name': fileinfo['name']}, {'$set': update_set}))
+    if operations:
+        config.db[cont_name].bulk_write(operations)
+    return config.db[cont_name].find_one({'_id': _id})
+
+def commit_engine_files(acquisition_obj, fileinfos, received, now):
+    """
+    Add or override the fileinfos of an engine upload in an acquisition with a single bulk write.
+    fileinfos maps file names to their infos, the infos of files that are neither received nor
+    already in the acquisition are skipped. Returns the acquisition after the update and the
+    committed fileinfos.
+    """
+    existing_hashes = dict((f['name'], f.get('hash')) for f in acquisition_obj.get('files', []))
+    added = []
+    updated = []
+    replaced_hashes = []
+    for name, fileinfo in fileinfos.items():
+        fileinfo.pop('path', None)
+        if name in existing_hashes:
+            # update the fileinfo in mongo if a file already exists
+            fileinfo['modified'] = now
+            updated.append(fileinfo)
+            if fileinfo.get('hash') and existing_hashes[name]:
+                replaced_hashes.append(existing_hashes[name])
+        elif name in received:
+            # create the missing fileinfo in mongo
+            # skip update fileinfo for files that are not received
+            fileinfo['created'] = now
+            fileinfo['modified'] = now
+            added.append(fileinfo)
+    # commit all the fileinfos with a single bulk write
+    acquisition_obj = commit_fileinfos('acquisitions', acquisition_obj['_id'], added, updated)
+    new_hashes = [fileinfo['hash'] for fileinfo in added] + [fileinfo['hash'] for fileinfo in updated if fileinfo.get('hash')]
+    blobrefs.replace_refs(replaced_hashes, new_hashes)
+    return acquisition_obj, added + updated
+
+class GroupMatcher(object):
+    """
+    Fuzzy matching of reaper group names with the existing group ids.
+
+    It gives the same results as difflib.get_close_matches(group_name, group_ids, cutoff=0.8). A close
+    match shares most of its characters with the name, in few matching blocks, so it shares a minimum
+    number of character pairs with the name, or for short names of characters. The ids are indexed by
+    their pairs of characters and their characters, counting repeated ones apart, and only the ids that
+    share one of the rarest pairs or characters of the name that a close match cannot all miss are
+    compared. The results are memoized.
+    """
+
+    cutoff = 0.8
+
+    def __init__(self, group_ids, stamp=None):
+        self.group_ids = group_ids
+        self.stamp = stamp
+        self.created = datetime.datetime.utcnow()
+        # (character or pair of characters, occurrence) -> ids
+        self._ids_by_token = {}
+        self._empty_ids = []
+        for group_id in group_ids:
+            for token in self._tokens(group_id) + self._tokens(self._pairs(group_id)):
+                self._ids_by_token.setdefault(token, []).append(group_id)
+            if not group_id:
+                self._empty_ids.append(group_id)
+        self._matches = util.LRUCache(maxsize=4096)
+
+    @staticmethod
+    def _pairs(s):
+        return [s[i:i+2] for i in range(len(s) - 1)]
+
+    @staticmethod
+    def _tokens(items):
+        seen = {}
+        tokens = []
+        for item in items:
+            seen[item] = seen.get(item, 0) + 1
+            tokens.append((item, seen[item]))
+        return tokens
+
+    def _candidates(self, group_name):
+        length = len(group_name)
+        if not length:
+            return self._empty_ids
+        # the length of the shortest close match (real_quick_ratio), which has at least cutoff * (length +
+        # its length) / 2 matching characters, in at most one block more than its unmatched characters and
+        # the unmatched characters of the name
+        min_length = self.cutoff * length / (2.0 - self.cutoff)
+        shared = int(math.ceil((1.5 * self.cutoff - 1) * (length + min_length) - 1 - 1e-9))
+        if shared >= 1:
+            tokens = self._tokens(self._pairs(group_name))
+        else:
+            shared = int(math.ceil(self.cutoff * (length + min_length) / 2 - 1e-9))
+            tokens = self._tokens(group_name)
+        # a close match shares at least `shared` tokens with the name, so one of any len(tokens) - shared + 1
+        tokens.sort(key=lambda token: len(self._ids_by_token.get(token, ())))
+        candidates = set()
+        for token in tokens[:len(tokens) - max(shared, 1) + 1]:
+            candidates.update(self._ids_by_token.get(token, ()))
+        return list(candidates)
+
+    def match(self, group_name):
+        """return the group id matching group_name, or None if there are no or many close matches"""
+        matches = self._matches.get(group_name)
+        if matches is None:
+            matches = difflib.get_close_matches(group_name, self._candidates(group_name), cutoff=self.cutoff)
+            self._matches.set(group_name, matches)
+        return matches[0] if len(matches) == 1 else None
+
+_group_matcher = None
+
+def invalidate_group_matcher():
+    global _group_matcher
+    _group_matcher = None
+
+def groups_changed(db):
+    """record that groups were created or deleted, the group matchers of all the processes are rebuilt"""
+    db.groups_status.update_one({'_id': 'stamp'}, {'$inc': {'stamp': 1}}, upsert=True)
+    invalidate_group_matcher()
+
+def _match_group(group_name):
+    """
+    Match a group name using a GroupMatcher of the current groups.
+    The matcher is rebuilt when the groups change stamp moves, see groups_changed, and every few
+    minutes, for groups changed directly in the database.
+    """
+    global _group_matcher
+    group_matcher = _group_matcher
+    # the stamp is read before the groups, a change made meanwhile rebuilds the matcher again
+    stamp = (config.db.groups_status.find_one({'_id': 'stamp'}) or {}).get('stamp', 0)
+    if (group_matcher is None or group_matcher.stamp != stamp or
+            datetime.datetime.utcnow() - group_matcher.created > datetime.timedelta(minutes=5)):
+        group_ids = [g['_id'] for g in config.db.groups.find(None, ['_id'])]
+        group_matcher = _group_matcher = GroupMatcher(group_ids, stamp=stamp)
+    return group_matcher.match(group_name)
+
 def _find_or_create_destination_project(group_name, project_label, created, modified):
-    existing_group_ids = [g['_id'] for g in config.db.groups.find(None, ['_id'])]
-    group_id_matches = difflib.get_close_matches(group_name, existing_group_ids, cutoff=0.8)
-    if len(group_id_matches) == 1:
-        group_name = group_id_matches[0]
+    group_id_match = _match_group(group_name)
+    if group_id_match is not None:
+        group_name = group_id_match
     else:
         project_label = group_name + '_' + project_label
         group_name = 'unknown'
@@ -88,6 +242,20 @@ def _find_or_create_destination_project(group_name, project_label, created, modi
         )
     return project
 
+# Resolved containers of recent reaper uploads, keyed by ('session', uid) and ('acquisition', uid).
+# Drones send many files for the same session and acquisition, the cache allows to skip the lookups,
+# the project upserts and the timestamp updates that would not change anything.
+# Entries expire after a few minutes. As other processes can move or delete the cached containers,
+# a cached session or acquisition is updated only if it is still in its cached parent, which checks
+# the cache entry with the update made on each upload anyway.
+hierarchy_cache = util.LRUCache(maxsize=1024, ttl=300)
+# guards the timestamps of the cached sessions, shared by the threads of the process
+_timestamps_lock = threading.Lock()
+
+def invalidate_hierarchy_cache(_id):
+    """drop the cached hierarchies including the project, session or acquisition _id, e.g. when it is moved or deleted"""
+    hierarchy_cache.discard(lambda key, entry: _id in (entry['_id'], entry.get('session'), entry.get('project')))
+
 def create_container_hierarchy(metadata):
     #TODO: possibly try to keep a list of session IDs on the project, instead of having the session point to the project
     #      same for the session and acquisition
@@ -115,16 +283,89 @@ def create_container_hierarchy(metadata):
 
     now = datetime.datetime.utcnow()
 
-    session_obj = config.db.sessions.find_one({'uid': session_uid}, ['project'])
-    if session_obj: # skip project creation, if session exists
-        project_obj = config.db.projects.find_one({'_id': session_obj['project']}, projection=PROJECTION_FIELDS + ['name'])
-    else:
-        project_obj = _find_or_create_destination_project(group_id, project_label, now, now)
     session['subject'] = subject or {}
     #FIXME session modified date should be updated on updates
     if session.get('timestamp'):
         session['timestamp'] = dateutil.parser.parse(session['timestamp'])
+    if acquisition.get('timestamp'):
+        acquisition['timestamp'] = dateutil.parser.parse(acquisition['timestamp'])
+    # the cached payloads are compared without the modified date
+    session_payload = copy.deepcopy(session)
+    acquisition_payload = copy.deepcopy(acquisition)
     session['modified'] = now
+    acquisition['modified'] = now
+
+    session_entry = hierarchy_cache.get(('session', session_uid))
+    if session_entry is not None and session_entry['payload'] == session_payload:
+        # update the cached session only if it is still in the cached project
+        if config.db.sessions.find_one_and_update({'_id': session_entry['_id'], 'project': session_entry['project']}, {'$set': session}, ['_id']) is None:
+            # the session has been deleted or moved, e.g. by another process
+            invalidate_hierarchy_cache(session_entry['_id'])
+            session_entry = None
+    else:
+        session_entry = None
+    if session_entry is None:
+        session_entry = _upsert_session(group_id, project_label, session_uid, session, session_payload, now)
+
+    acquisition_obj = None
+    acquisition_entry = hierarchy_cache.get(('acquisition', acquisition_uid))
+    if acquisition_entry is not None and acquisition_entry['payload'] == acquisition_payload:
+        # update the cached acquisition only if it is still in the session
+        acquisition_obj = config.db.acquisitions.find_one_and_update(
+            {'_id': acquisition_entry['_id'], 'session': session_entry['_id']},
+            {'$set': acquisition},
+            return_document=pymongo.collection.ReturnDocument.AFTER,
+        )
+        if acquisition_obj is None:
+            # the acquisition has been deleted or moved
+            invalidate_hierarchy_cache(acquisition_entry['_id'])
+
+    log.info('Storing     %s -> %s -> %s' % (session_entry['group'], session_entry['project_label'], session_uid))
+
+    if acquisition.get('timestamp'):
+        # skip the updates if the timestamp has already been applied to the project and the session
+        timestamps = session_entry['timestamps']
+        with _timestamps_lock:
+            applied = timestamps.get(acquisition['timestamp'], ()) == acquisition.get('timezone')
+        if not applied:
+            config.db.projects.update_one({'_id': session_entry['project']}, {'$max': dict(timestamp=acquisition['timestamp']), '$set': dict(timezone=acquisition.get('timezone'))})
+            config.db.sessions.update_one({'_id': session_entry['_id']}, {'$min': dict(timestamp=acquisition['timestamp']), '$set': dict(timezone=acquisition.get('timezone'))})
+            with _timestamps_lock:
+                timestamps[acquisition['timestamp']] = acquisition.get('timezone')
+
+    if acquisition_obj is None:
+        acq_operations = {
+            '$setOnInsert': dict(
+                session=session_entry['_id'],
+                permissions=session_entry['permissions'],
+                public=session_entry['public'],
+                created=now
+            ),
+            '$set': acquisition
+        }
+        #FIXME acquisition modified date should be updated on updates
+        acquisition_obj = config.db.acquisitions.find_one_and_update(
+            {'uid': acquisition_uid},
+            acq_operations,
+            upsert=True,
+            return_document=pymongo.collection.ReturnDocument.AFTER,
+        )
+        if acquisition_obj['session'] == session_entry['_id']:
+            hierarchy_cache.set(('acquisition', acquisition_uid), {
+                '_id': acquisition_obj['_id'],
+                'session': session_entry['_id'],
+                'project': session_entry['project'],
+                'payload': acquisition_payload,
+            })
+    return TargetAcquisition(acquisition_obj, file_)
+
+def _upsert_session(group_id, project_label, session_uid, session, session_payload, now):
+    """find or create the session and its project, returns the hierarchy cache entry of the session"""
+    session_obj = config.db.sessions.find_one({'uid': session_uid}, ['project'])
+    if session_obj: # skip project creation, if session exists
+        project_obj = config.db.projects.find_one({'_id': session_obj['project']}, projection=PROJECTION_FIELDS + ['name'])
+    else:
+        project_obj = _find_or_create_destination_project(group_id, project_label, now, now)
     session_obj = config.db.sessions.find_one_and_update(
         {'uid': session_uid},
         {
@@ -141,32 +382,18 @@ def create_container_hierarchy(metadata):
         upsert=True,
         return_document=pymongo.collection.ReturnDocument.AFTER,
     )
-
-    log.info('Storing     %s -> %s -> %s' % (project_obj['group'], project_obj['label'], session_uid))
-
-    if acquisition.get('timestamp'):
-        acquisition['timestamp'] = dateutil.parser.parse(acquisition['timestamp'])
-        config.db.projects.update_one({'_id': project_obj['_id']}, {'$max': dict(timestamp=acquisition['timestamp']), '$set': dict(timezone=acquisition.get('timezone'))})
-        config.db.sessions.update_one({'_id': session_obj['_id']}, {'$min': dict(timestamp=acquisition['timestamp']), '$set': dict(timezone=acquisition.get('timezone'))})
-
-    acquisition['modified'] = now
-    acq_operations = {
-        '$setOnInsert': dict(
-            session=session_obj['_id'],
-            permissions=session_obj['permissions'],
-            public=session_obj['public'],
-            created=now
-        ),
-        '$set': acquisition
+    session_entry = {
+        '_id': session_obj['_id'],
+        'project': project_obj['_id'],
+        'group': project_obj['group'],
+        'project_label': project_obj['label'],
+        'permissions': session_obj['permissions'],
+        'public': session_obj['public'],
+        'payload': session_payload,
+        'timestamps': {},
     }
-    #FIXME acquisition modified date should be updated on updates
-    acquisition_obj = config.db.acquisitions.find_one_and_update(
-        {'uid': acquisition_uid},
-        acq_operations,
-        upsert=True,
-        return_document=pymongo.collection.ReturnDocument.AFTER,
-    )
-    return TargetAcquisition(acquisition_obj, file_)
+    hierarchy_cache.set(('session', session_uid), session_entry)
+    return session_entry
 
 def update_container_hierarchy(metadata, acquisition_id, level):
     project = metadata.get('project')
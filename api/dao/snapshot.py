@@ -1,5 +1,6 @@
 from .. import config
 from .. import util
+from . import blobrefs
 
 from pymongo import ReturnDocument
 
@@ -75,24 +76,41 @@ def create(method, _id, payload=None):
         snap_id = payload['_id']
     else:
         snap_id = None
-    return _store(hierarchy, snap_id)
+    result = _store(hierarchy, snap_id)
+    # the snapshot holds copies of the fileinfos
+    blobrefs.add_refs(_file_hashes([result.inserted_id]))
+    return result
+
+
+def _file_hashes(project_snapshot_ids):
+    """return the hashes of the files in the project snapshots and in their session and acquisition snapshots"""
+    session_snapshot_ids = [s['_id'] for s in config.db.session_snapshots.find({'project': {'$in': project_snapshot_ids}}, ['_id'])]
+    return (
+        blobrefs.find_file_hashes('project_snapshots', {'_id': {'$in': project_snapshot_ids}}) +
+        blobrefs.find_file_hashes('session_snapshots', {'_id': {'$in': session_snapshot_ids}}) +
+        blobrefs.find_file_hashes('acquisition_snapshots', {'session': {'$in': session_snapshot_ids}})
+    )
 
 
 def remove(method, _id, payload=None):
     snapshot_id = util.ObjectId(_id)
+    hashes = _file_hashes([snapshot_id])
     result = config.db.project_snapshots.find_one_and_delete({'_id': snapshot_id})
     session_snapshot_ids = [s['_id'] for s in config.db.session_snapshots.find({'project': snapshot_id})]
     config.db.session_snapshots.delete_many({'_id': {'$in': session_snapshot_ids}})
     config.db.acquisition_snapshots.delete_many({'session': {'$in': session_snapshot_ids}})
+    blobrefs.remove_refs(hashes)
     return result
 
 def remove_private_snapshots_for_project(pid):
     pid = util.ObjectId(pid)
     project_snapshot_ids = [sn['_id'] for sn in config.db.project_snapshots.find({'original': pid, 'public': False})]
+    hashes = _file_hashes(project_snapshot_ids)
     result = config.db.project_snapshots.delete_many({'original': pid, 'public': False})
     session_snapshot_ids = [s['_id'] for s in config.db.session_snapshots.find({'project': {'$in': project_snapshot_ids}})]
     config.db.session_snapshots.delete_many({'_id': {'$in': session_snapshot_ids}})
     config.db.acquisition_snapshots.delete_many({'session': {'$in': session_snapshot_ids}})
+    blobrefs.remove_refs(hashes)
     return result
 
 def remove_permissions_from_snapshots(pid):
@@ -10,6 +10,8 @@ from . import base
 from . import validators
 
 from . import util
+from . import blobstore
+from . import blobcache
 from . import config
 
 log = config.log
@@ -40,8 +42,8 @@ def _append_targets(targets, container, prefix, total_size, total_cnt, optional,
             if filtered:
                 continue
         if optional or not f.get('optional', False):
-            filepath = os.path.join(data_path, util.path_from_hash(f['hash']))
-            if os.path.exists(filepath): # silently skip missing files
+            filepath = blobstore.resolve_path(data_path, f['hash'])
+            if blobstore.stored_path(filepath): # silently skip missing files
                 targets.append((filepath, prefix + '/' + urllib.url2pathname(f['name']), f['size']))
                 total_size += f['size']
                 total_cnt += 1
@@ -190,13 +192,20 @@ class Download(base.RequestHandler):
         CHUNKSIZE = 2**20  # stream files in 1MB chunks
         stream = cStringIO.StringIO()
         with tarfile.open(mode='w|', fileobj=stream) as archive:
-            for filepath, arcpath, _ in ticket['target']:
-                yield archive.gettarinfo(filepath, arcpath).tobuf()
-                with open(filepath, 'rb') as fd:
+            for filepath, arcpath, size in ticket['target']:
+                stored_path = blobstore.stored_path(filepath)
+                if stored_path is None:
+                    log.warning('Skipping    %s (missing blob)' % arcpath)
+                    continue
+                tarinfo = archive.gettarinfo(stored_path, arcpath)
+                # the size of the original bytes, the blob could be stored compressed
+                tarinfo.size = size
+                yield tarinfo.tobuf()
+                with blobcache.open_blob(filepath, size) as fd:
                     for chunk in iter(lambda: fd.read(CHUNKSIZE), ''):
                         yield chunk
-                    if len(chunk) % BLOCKSIZE != 0:
-                        yield (BLOCKSIZE - (len(chunk) % BLOCKSIZE)) * b'\0'
+                if size % BLOCKSIZE != 0:
+                    yield (BLOCKSIZE - (size % BLOCKSIZE)) * b'\0'
         yield stream.getvalue() # get tar stream trailer
         stream.close()
 
@@ -204,7 +213,8 @@ class Download(base.RequestHandler):
         for filepath, arcpath, _ in ticket['target']:
             t = tarfile.TarInfo(name=arcpath)
             t.type = tarfile.SYMTYPE
-            t.linkname = os.path.relpath(filepath, data_path)
+            # links point to the stored blob, gzip compressed blobs have a .gz suffix
+            t.linkname = os.path.relpath(blobstore.stored_path(filepath) or filepath, data_path)
             yield t.tobuf()
         stream = cStringIO.StringIO()
         with tarfile.open(mode='w|', fileobj=stream) as archive:
@@ -1,25 +1,268 @@
 import os
 import cgi
 import json
+import contextlib
+import time
+import Queue
+import errno
 import shutil
+import struct
 import hashlib
 import zipfile
 import datetime
 import urllib
+import threading
+import bson.binary
 
 from . import util
 from . import config
+from . import blobstore
+from . import blobcache
 
 log = config.log
 
 def get_tempname(filename):
     return hashlib.sha384(filename).hexdigest()
 
-def move_file(path, target_path):
+def move_file(path, target_path, compress_ratio=None):
+    """
+    Place the file at path in its content addressed location target_path.
+
+    Blobs are addressed by their hash, so an existing target already holds the same bytes
+    and the temporary file is dropped. Otherwise the file is hard linked (or renamed) into place,
+    which never overwrites a concurrently stored blob. The data is copied only when the temporary
+    file and the target are on different devices.
+
+    With compress_ratio, the file is stored gzip compressed if it compresses to at most that ratio.
+
+    Returns the number of bytes written to place the file.
+    """
     target_dir = os.path.dirname(target_path)
-    if not os.path.exists(target_dir):
+    try:
         os.makedirs(target_dir)
-    shutil.move(path, target_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    existing_path = blobstore.stored_path(target_path)
+    if existing_path:
+        try:
+            # refresh the modification time of an existing blob, the blob collector keeps recently stored blobs
+            os.utime(existing_path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            os.remove(path)
+            return 0
+    if compress_ratio is not None and blobstore.should_compress(path, compress_ratio):
+        return blobstore.compress_file(path, target_path)
+    try:
+        os.link(path, target_path)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            os.remove(path)
+            return 0
+        elif e.errno == errno.EXDEV:
+            return _copy_file(path, target_path)
+        # the filesystem does not support hard links
+        try:
+            os.rename(path, target_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            return _copy_file(path, target_path)
+        return 0
+    os.remove(path)
+    return 0
+
+def _copy_file(path, target_path):
+    """copy across devices to a temporary name in the target directory and rename it atomically"""
+    copy_path = blobstore.temp_path(os.path.dirname(target_path))
+    try:
+        shutil.copyfile(path, copy_path)
+        os.rename(copy_path, target_path)
+    except:
+        os.remove(copy_path)
+        raise
+    os.remove(path)
+    return os.path.getsize(target_path)
+
+# zip archives with more members than this, or an index larger than this when BSON encoded, are not indexed:
+# the index must fit in a document of at most 16 MiB, member names can be up to 64 KiB long.
+# Their index only holds the comment and a too_large marker, their members are read from the archive.
+MAX_ZIP_INDEX_MEMBERS = 50000
+MAX_ZIP_INDEX_SIZE = 8 * 2**20
+
+# signature, versions, flags, compression, time, date, crc, sizes, filename and extra field lengths
+_ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_ZIP_LOCAL_HEADER_SIGNATURE = 'PK\003\004'
+
+def _zip_member_name(name):
+    # names without the utf-8 flag are cp437 encoded and mongo only accepts valid utf-8
+    return name if isinstance(name, unicode) else name.decode('cp437')
+
+def _zip_member(zi):
+    return {
+        'name': _zip_member_name(zi.filename),
+        'size': zi.file_size,
+        'compressed_size': zi.compress_size,
+        'compress_type': zi.compress_type,
+        'flag_bits': zi.flag_bits,
+        'crc': zi.CRC,
+        'offset': zi.header_offset,
+        'date_time': list(zi.date_time),
+    }
+
+def _members_by_name(members):
+    """the positions of the members sorted by name, for lookups by name"""
+    return sorted(range(len(members)), key=lambda i: members[i]['name'])
+
+def zip_index(path):
+    """
+    Extract the central directory of a zip file.
+
+    The index holds the comment and, for each member, the name, sizes, CRC and the offset
+    of the local header, so that members can be listed, compared and read without parsing
+    the central directory again. Returns None if the file is not a zip archive.
+    """
+    if not zipfile.is_zipfile(path):
+        return None
+    try:
+        with zipfile.ZipFile(path) as zf:
+            infolist = zf.infolist()
+            too_large = {'comment': bson.binary.Binary(zf.comment), 'too_large': True}
+            if len(infolist) > MAX_ZIP_INDEX_MEMBERS:
+                return too_large
+            members = [_zip_member(zi) for zi in infolist]
+            index = {
+                'comment': bson.binary.Binary(zf.comment),
+                'members': members,
+                'by_name': _members_by_name(members),
+            }
+            if len(bson.BSON.encode(index)) > MAX_ZIP_INDEX_SIZE:
+                return too_large
+            return index
+    except zipfile.BadZipfile:
+        return None
+
+def zip_index_complete(index):
+    """whether a zip index holds the members of its archive"""
+    return index is not None and not index.get('too_large')
+
+def save_zip_index(hash_, index):
+    config.db.zip_indexes.replace_one({'_id': hash_}, index, upsert=True)
+
+def get_zip_index(hash_, path):
+    """
+    Load the zip index of a stored file.
+
+    Files received before indexes were extracted at upload time are indexed on first access.
+    Returns None if the file is not a zip archive.
+    """
+    index = config.db.zip_indexes.find_one({'_id': hash_})
+    if index is None:
+        index = zip_index(path)
+        if index is not None:
+            save_zip_index(hash_, index)
+    elif zip_index_complete(index) and 'by_name' not in index:
+        # indexed before the members were sorted by name
+        index['by_name'] = _members_by_name(index['members'])
+        save_zip_index(hash_, index)
+    return index
+
+def zip_indexes_identical(index1, index2):
+    """zip files are identical if they have the same comment and members with the same CRCs"""
+    if str(index1['comment']) != str(index2['comment']):
+        return False
+    if len(index1['members']) != len(index2['members']):
+        return False
+    members1 = sorted(index1['members'], key=lambda m: m['name'])
+    members2 = sorted(index2['members'], key=lambda m: m['name'])
+    return all(m1['crc'] == m2['crc'] for m1, m2 in zip(members1, members2))
+
+def zip_members(index, path):
+    """return the members of a zip file, from its index or from the archive at path if it is too large to be indexed"""
+    if zip_index_complete(index):
+        return index['members']
+    with contextlib.closing(blobstore.open_blob(path)) as fd, zipfile.ZipFile(fd) as zf:
+        return [_zip_member(zi) for zi in zf.infolist()]
+
+def zip_member_info(index, name, path=None):
+    """
+    Look up a zip member by name, in the index or in the archive at path if it is too large to be indexed.
+    Returns None if there is no such member.
+    """
+    if not zip_index_complete(index):
+        with contextlib.closing(blobstore.open_blob(path)) as fd, zipfile.ZipFile(fd) as zf:
+            try:
+                return _zip_member(zf.getinfo(name))
+            except KeyError:
+                return None
+    members, by_name = index['members'], index['by_name']
+    lo, hi = 0, len(by_name)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if members[by_name[mid]]['name'] < name:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < len(by_name) and members[by_name[lo]]['name'] == name:
+        return members[by_name[lo]]
+    return None
+
+def _open_zip_member_data(path, member):
+    """open the zip file at path positioned at the start of the data of member, using the offset from the index"""
+    if member['flag_bits'] & 0x1:
+        raise zipfile.BadZipfile('encrypted zip members are not supported')
+    fd = blobstore.open_blob(path)
+    try:
+        fd.seek(member['offset'])
+        header = _ZIP_LOCAL_HEADER.unpack(fd.read(_ZIP_LOCAL_HEADER.size))
+        if header[0] != _ZIP_LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipfile('bad local header for zip member ' + member['name'])
+        fd.seek(header[10] + header[11], os.SEEK_CUR)
+    except:
+        fd.close()
+        raise
+    return fd
+
+def open_zip_member(path, member):
+    """
+    Open a zip member for reading, seeking directly to its local header with the offset from the index.
+    Returns a file-like object yielding the decompressed member.
+    """
+    fd = _open_zip_member_data(path, member)
+    zi = zipfile.ZipInfo(member['name'], tuple(member['date_time']))
+    zi.compress_type = member['compress_type']
+    zi.compress_size = member['compressed_size']
+    zi.file_size = member['size']
+    zi.flag_bits = member['flag_bits']
+    zi.CRC = member['crc']
+    return zipfile.ZipExtFile(fd, 'r', zi, close_fileobj=True)
+
+def open_zip_member_range(path, member, start):
+    """
+    Open a stored (uncompressed) zip member positioned at byte start of the member.
+    Returns the underlying file, the caller should read at most member['size'] - start bytes.
+    """
+    if member['compress_type'] != zipfile.ZIP_STORED:
+        raise zipfile.BadZipfile('byte ranges are supported only for stored zip members')
+    fd = _open_zip_member_data(path, member)
+    fd.seek(start, os.SEEK_CUR)
+    return fd
+
+def iter_file(fd, size, chunk_size=2**20):
+    """yield size bytes read from fd in chunks, closing it when done"""
+    try:
+        while size > 0:
+            chunk = fd.read(min(chunk_size, size))
+            if not chunk:
+                break
+            size -= len(chunk)
+            yield chunk
+    finally:
+        fd.close()
+
 
 class FileStoreException(Exception):
     pass
@@ -37,11 +280,82 @@ class HashingFile(file):
         return self.hash_alg.hexdigest()
 
 
-def getHashingFieldStorage(upload_dir, hash_alg):
+class ThreadedHashingFile(file):
+    """
+    A HashingFile computing the hash on a worker thread, while the request thread keeps receiving.
+
+    hashlib releases the GIL while hashing large chunks, the writes are coalesced into chunk_size
+    chunks for the worker. Each part of a multi-file upload is hashed while it is received, its worker
+    is finished when the part ends. The queue is bounded, a slow worker throttles the writes.
+    """
+
+    chunk_size = 2**20
+    queue_size = 8
+
+    def __init__(self, file_path, hash_alg):
+        super(ThreadedHashingFile, self).__init__(file_path, "wb")
+        self.hash_alg = hashlib.new(hash_alg)
+        self.size = 0
+        self.start_time = self.end_time = time.time()
+        self._chunks = []
+        self._chunks_size = 0
+        self._queue = Queue.Queue(self.queue_size)
+        self._worker = threading.Thread(target=self._hash_chunks)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _hash_chunks(self):
+        for chunk in iter(self._queue.get, None):
+            self.hash_alg.update(chunk)
+
+    def _flush_chunks(self):
+        if self._chunks:
+            self._queue.put(''.join(self._chunks))
+            self._chunks = []
+            self._chunks_size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._chunks_size += len(data)
+        self.size += len(data)
+        if self._chunks_size >= self.chunk_size:
+            self._flush_chunks()
+        self.end_time = time.time()
+        return file.write(self, data)
+
+    def finish(self):
+        """wait for the worker to hash the received data, it can be called more than once"""
+        if self._worker.is_alive():
+            self._flush_chunks()
+            self._queue.put(None)
+            self._worker.join()
+
+    @property
+    def duration(self):
+        """time spent receiving the file"""
+        return datetime.timedelta(seconds=self.end_time - self.start_time)
+
+    def get_hash(self):
+        self.finish()
+        return self.hash_alg.hexdigest()
+
+
+def getHashingFieldStorage(upload_dir, hash_alg, hashing_file=HashingFile):
     class HashingFieldStorage(cgi.FieldStorage):
         bufsize = 2**20
+        # files created while parsing the form, shared by the FieldStorage of each part
+        received_files = []
+
+        def __init__(self, *args, **kwargs):
+            cgi.FieldStorage.__init__(self, *args, **kwargs)
+            # the part is received, its hashing worker is not kept alive while the next parts are received
+            open_file = getattr(self, 'open_file', None)
+            if hasattr(open_file, 'finish'):
+                open_file.finish()
+
         def make_file(self, binary=None):
-            self.open_file = HashingFile(os.path.join(upload_dir, get_tempname(self.filename)), hash_alg)
+            self.open_file = hashing_file(os.path.join(upload_dir, get_tempname(self.filename)), hash_alg)
+            self.received_files.append(self.open_file)
             return self.open_file
 
         # override private method __write of superclass FieldStorage
@@ -95,6 +409,9 @@ class FileStore(object):
         # version will track changes on hash related methods like for example how we check for identical files.
         self.hash = util.format_hash(hash_alg, self.received_file.get_hash())
         self.size = os.path.getsize(self.path)
+        self.zip_index = zip_index(self.path)
+        # bytes written to disk for this upload, including the copies needed to store it
+        self.bytes_written = self.size
 
     def _save_multipart_file(self, dest_path, hash_alg):
         form = getHashingFieldStorage(dest_path, hash_alg)(fp=self.body, environ=self.environ, keep_blank_values=True)
@@ -117,25 +434,29 @@ class FileStore(object):
         self.metadata = None
 
     def move_file(self, target_path):
-        move_file(self.path, target_path)
+        # zip files are never compressed, their members are read at the offsets of the index
+        compress_ratio = blobstore.compression_ratio() if not self.zip_index else None
+        blobcache.add_file(self.path, self.hash)
+        self.bytes_written += move_file(self.path, target_path, compress_ratio)
         self.path = target_path
+        if self.zip_index:
+            save_zip_index(self.hash, self.zip_index)
+
+    @property
+    def write_amplification(self):
+        """bytes written per received byte, above 1.0 if the file had to be copied into place, below if it was compressed"""
+        return float(self.bytes_written) / self.size if self.size else 1.0
 
     def identical(self, filepath, hash_):
-        if zipfile.is_zipfile(filepath) and zipfile.is_zipfile(self.path):
-            with zipfile.ZipFile(filepath) as zf1, zipfile.ZipFile(self.path) as zf2:
-                zf1_infolist = sorted(zf1.infolist(), key=lambda zi: zi.filename)
-                zf2_infolist = sorted(zf2.infolist(), key=lambda zi: zi.filename)
-                if zf1.comment != zf2.comment:
-                    return False
-                if len(zf1_infolist) != len(zf2_infolist):
-                    return False
-                for zii, zij in zip(zf1_infolist, zf2_infolist):
-                    if zii.CRC != zij.CRC:
-                        return False
-                else:
-                    return True
-        else:
-            return hash_ == self.hash
+        """
+        Check if the received file is identical to the stored file at filepath with hash hash_.
+        Zip files are compared on their comments and member CRCs using the zip indexes.
+        """
+        if zip_index_complete(self.zip_index):
+            stored_zip_index = get_zip_index(hash_, filepath)
+            if zip_index_complete(stored_zip_index):
+                return zip_indexes_identical(self.zip_index, stored_zip_index)
+        return hash_ == self.hash
 
 class MultiFileStore(object):
     """This class provides and interface for file uploads.
@@ -148,18 +469,52 @@ class MultiFileStore(object):
         self.environ['QUERY_STRING'] = ''
         self.hash_alg = hash_alg
         self.files = {}
+        self.zip_indexes = {}
+        # time spent receiving each file
+        self.durations = {}
         self._save_multipart_files(dest_path, hash_alg)
         self.payload = request.POST.mixed()
 
     def _save_multipart_files(self, dest_path, hash_alg):
-        form = getHashingFieldStorage(dest_path, hash_alg)(fp=self.body, environ=self.environ, keep_blank_values=True)
+        # each part is hashed by a worker thread while it is received
+        field_storage = getHashingFieldStorage(dest_path, hash_alg, ThreadedHashingFile)
+        try:
+            form = field_storage(fp=self.body, environ=self.environ, keep_blank_values=True)
+        finally:
+            # the workers of the parts interrupted by an error
+            for received_file in field_storage.received_files:
+                received_file.finish()
         self.metadata = json.loads(form['metadata'].file.getvalue()) if 'metadata' in form else None
         for field in form:
             if form[field].filename:
+                received_file = form[field].file
                 temp_filename = get_tempname(form[field].filename)
                 filename = urllib.quote(form[field].filename, '')
+                received_file.flush()
                 self.files[filename] = {
-                    'hash': util.format_hash(hash_alg, form[field].file.get_hash()),
-                    'size': os.path.getsize(os.path.join(dest_path, filename)),
+                    'hash': util.format_hash(hash_alg, received_file.get_hash()),
+                    'size': received_file.size,
                     'path': os.path.join(dest_path, temp_filename)
                 }
+                self.durations[filename] = received_file.duration
+                index = zip_index(self.files[filename]['path'])
+                if index:
+                    self.zip_indexes[filename] = index
+
+    def identical(self, filename, filepath, hash_):
+        """check if the received file filename is identical to the stored file at filepath with hash hash_"""
+        if zip_index_complete(self.zip_indexes.get(filename)):
+            stored_zip_index = get_zip_index(hash_, filepath)
+            if zip_index_complete(stored_zip_index):
+                return zip_indexes_identical(self.zip_indexes[filename], stored_zip_index)
+        return hash_ == self.files[filename]['hash']
+
+    def move_file(self, filename, target_path):
+        """move a received file to its destination, returns the number of bytes written"""
+        fileinfo = self.files[filename]
+        compress_ratio = blobstore.compression_ratio() if filename not in self.zip_indexes else None
+        blobcache.add_file(fileinfo['path'], fileinfo['hash'])
+        bytes_written = move_file(fileinfo['path'], target_path, compress_ratio)
+        if filename in self.zip_indexes:
+            save_zip_index(fileinfo['hash'], self.zip_indexes[filename])
+        return bytes_written
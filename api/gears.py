@@ -0,0 +1,179 @@
+"""
+Registry of the gears, the algorithms run by jobs.
+
+Gear definitions are versioned documents of the gears collection, jobs run the latest registered version
+of a gear, or the built-in definition of gears that were never registered. Lookups by name are cached in
+each process for CACHE_TTL seconds: registering a version invalidates the cache of the registering process,
+the other processes use it once their cached lookup expires.
+
+The formula template of each gear version is built once. Formulas generated from a template share its
+constant parts, they must not be modified.
+"""
+
+import datetime
+import pymongo
+from collections import namedtuple
+
+from . import base
+from . import util
+from . import config
+
+log = config.log
+
+# How many seconds a gear lookup is cached
+CACHE_TTL = 60
+
+Category = util.Enum('Category', {
+    'classifier': 'classifier', # discover metadata
+    'converter':  'converter',  # translate between formats
+    'qa':         'qa',         # quality assurance
+    'analytical': 'analytical', # general purpose
+})
+
+Gear = namedtuple('gear', ['name', 'category', 'input', 'version'])
+
+def _builtin_gear(name, category, uri):
+    # the version of a built-in gear is the name of its image
+    return Gear(name, category, {'type': 'file', 'location': '/', 'uri': uri}, uri.rsplit('/', 1)[-1])
+
+DEFAULT_GEARS = [
+    _builtin_gear('dicom_mr_classifier', Category.classifier, '/opt/flywheel-temp/dicom_mr_classifier-0.0.1.c.tar'),
+    _builtin_gear('dcm_convert',         Category.converter,  '/opt/flywheel-temp/dcm_convert-0.3.0.c.tar'),
+    _builtin_gear('qa-report-fmri',      Category.qa,         '/opt/flywheel-temp/qa-report-fmri-0.1.0.c.tar'),
+]
+
+TARGET = {
+    'command': ['bash', '-c', 'rm -rf output; mkdir -p output; sed -i \'s/_dicom//\' run; ./run; echo "Exit was $?"'],
+    'env': {
+        'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
+    },
+    'dir': "/flywheel/v0",
+}
+
+
+class FormulaTemplate(object):
+    """The formula of the jobs of a gear version, with the parts that do not depend on the job built once."""
+
+    def __init__(self, gear):
+        self.gear = gear
+        self.gear_input = gear.input
+        self.target = TARGET
+
+    def formula(self, i, job_id=None):
+        """
+        Generate the formula to process input i.
+
+        i: dict of a FileInput
+        job_id: the id of the job, the outputs are recorded on the job for memoization
+        """
+        return {
+            'inputs': [
+                self.gear_input,
+                {
+                    'type': 'scitran',
+                    'uri': '/' + i['container_type'] + 's/' + i['container_id'] + '/files/' + i['filename'],
+                    'location': '/flywheel/v0/input',
+                },
+            ],
+            'target': self.target,
+            'outputs': [
+                {
+                    'type': 'scitran',
+                    'uri': '/engine?level=' + i['container_type'] + '&id=' + i['container_id'] + ('&job=' + str(job_id) if job_id else ''),
+                    'location': '/flywheel/v0/output',
+                },
+            ],
+        }
+
+
+# gear name -> template of its latest version
+_lookups = util.LRUCache(maxsize=256, ttl=CACHE_TTL)
+# (gear name, version) -> template
+_templates = util.LRUCache(maxsize=1024)
+
+def _find_gear(name):
+    """return the document of the latest registered version of a gear, or None"""
+    for doc in config.db.gears.find({'name': name}).sort('created', pymongo.DESCENDING).limit(1):
+        return doc
+    return None
+
+def _load_gear(name):
+    doc = _find_gear(name)
+    if doc is not None:
+        return Gear(doc['name'], Category(doc['category']), doc['input'], doc['version'])
+    for gear in DEFAULT_GEARS:
+        if gear.name == name:
+            return gear
+    raise Exception("Unknown gear " + name)
+
+def get_template(name):
+    """return the formula template of the latest version of a gear"""
+    template = _lookups.get(name)
+    if template is None:
+        gear = _load_gear(name)
+        template = _templates.get((gear.name, gear.version))
+        if template is None or template.gear != gear:
+            template = FormulaTemplate(gear)
+            _templates.set((gear.name, gear.version), template)
+        _lookups.set(name, template)
+    return template
+
+def get_gear(name):
+    """return the latest version of a gear"""
+    return get_template(name).gear
+
+def register_gear(db, name, category, input, version):
+    """
+    Register a new version of a gear, used by the jobs queued from now on.
+    Raises ValueError for an unknown category, and pymongo.errors.DuplicateKeyError if the version exists.
+    """
+    category = Category(category)
+    db.gears.insert_one({
+        'name': name,
+        'category': category.value,
+        'input': input,
+        'version': version,
+        'created': datetime.datetime.utcnow(),
+    })
+    _lookups.pop(name)
+    log.info('registered gear %s version %s' % (name, version))
+
+
+class GearsHandler(base.RequestHandler):
+
+    """Provide /gears API routes."""
+
+    def get(self):
+        """List the registered gear versions, latest first."""
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        return list(config.db.gears.find().sort([('name', 1), ('created', -1)]))
+
+    def get_current(self, name):
+        """Return the gear version that jobs run."""
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        try:
+            gear = get_gear(name)
+        except Exception:
+            self.abort(404, 'Unknown gear ' + name)
+        return dict(gear._asdict(), category=str(gear.category))
+
+    def post(self):
+        """Register a gear version, from its name, category, input and version."""
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        payload = self.request.json
+        missing = [key for key in ('name', 'category', 'input', 'version') if not payload.get(key)]
+        if missing:
+            self.abort(400, 'missing gear fields: ' + ', '.join(missing))
+        try:
+            register_gear(config.db, payload['name'], payload['category'], payload['input'], payload['version'])
+        except ValueError:
+            self.abort(400, 'unknown gear category ' + payload['category'])
+        except pymongo.errors.DuplicateKeyError:
+            self.abort(409, 'gear {} version {} exists'.format(payload['name'], payload['version']))
+        return {'name': payload['name'], 'version': payload['version']}
@@ -1,12 +1,14 @@
+import os
 import datetime
 
 from .. import base
 from .. import util
+from .. import blobstore
 from .. import config
 from .. import debuginfo
 from .. import validators
 from ..auth import containerauth, always_ok
-from ..dao import APIStorageException, containerstorage, snapshot, openfmriutils
+from ..dao import APIStorageException, containerstorage, snapshot, openfmriutils, reaperutil, blobrefs
 
 log = config.log
 
@@ -92,8 +94,14 @@ class ContainerHandler(base.RequestHandler):
             self._filter_permissions(result, self.uid, self.user_site)
         # build and insert file paths if they are requested
         if self.is_true('paths'):
+            data_path = config.get_item('persistent', 'data_path')
             for fileinfo in result['files']:
-                fileinfo['path'] = util.path_from_hash(fileinfo['hash'])
+                path = blobstore.resolve_path(data_path, fileinfo['hash'])
+                fileinfo['path'] = os.path.relpath(path, data_path)
+                # gzip compressed blobs are stored with a suffix
+                stored_path = blobstore.stored_path(path)
+                if stored_path and blobstore.is_compressed(stored_path):
+                    fileinfo['path'] += blobstore.GZIP_SUFFIX
         if self.debug:
             debuginfo.add_debuginfo(self, cont_name, result)
         return result
@@ -297,6 +305,8 @@ class ContainerHandler(base.RequestHandler):
             self.abort(400, e.message)
 
         if result.modified_count == 1:
+            # the container could have been moved or its permissions changed
+            reaperutil.invalidate_hierarchy_cache(container['_id'])
             return {'modified': result.modified_count}
         else:
             self.abort(404, 'Element not updated in container {} {}'.format(storage.cont_name, _id))
@@ -316,6 +326,8 @@ class ContainerHandler(base.RequestHandler):
             self.abort(400, e.message)
 
         if result.deleted_count == 1:
+            reaperutil.invalidate_hierarchy_cache(container['_id'])
+            blobrefs.remove_refs(blobrefs.file_hashes([container]))
             if cont_name == 'projects':
                 snapshot.remove_private_snapshots_for_project(_id)
                 snapshot.remove_permissions_from_snapshots(_id)
@@ -5,7 +5,7 @@ from .. import config
 from .. import debuginfo
 from .. import validators
 from ..auth import groupauth, always_ok
-from ..dao import containerstorage
+from ..dao import containerstorage, reaperutil
 
 log = config.log
 
@@ -34,6 +34,7 @@ class GroupHandler(base.RequestHandler):
         permchecker = groupauth.default(self, group)
         result = permchecker(self.storage.exec_op)('DELETE', _id)
         if result.deleted_count == 1:
+            reaperutil.groups_changed(config.db)
             return {'deleted': result.deleted_count}
         else:
             self.abort(404, 'User {} not removed'.format(_id))
@@ -79,6 +80,7 @@ class GroupHandler(base.RequestHandler):
             payload['roles'] = [{'_id': self.uid, 'access': 'admin', 'site': self.user_site}]
         result = permchecker(mongo_validator(self.storage.exec_op))('POST', payload=payload)
         if result.acknowledged:
+            reaperutil.groups_changed(config.db)
             return {'_id': result.inserted_id}
         else:
             self.abort(404, 'User {} not updated'.format(_id))
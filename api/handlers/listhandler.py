@@ -1,17 +1,22 @@
 import os
 import copy
+import zipfile
 import datetime
 import urllib
 
 from .. import base
 from .. import util
 from .. import files
+from .. import blobstore
+from .. import blobcache
 from .. import rules
 from .. import config
 from .. import validators
 from .. import tempdir as tempfile
 from ..auth import listauth, always_ok
 from ..dao import liststorage
+from ..dao import reaperutil
+from ..dao import blobrefs
 from ..dao import APIStorageException
 
 log = config.log
@@ -230,6 +235,7 @@ class PermissionsListHandler(ListHandler):
             config.db.project_snapshots.update_many({'original': oid}, {'$set': update})
             config.db.session_snapshots.update_many({'original': {'$in': session_ids}}, {'$set': update})
             config.db.acquisition_snapshots.update_many({'original': {'$in': acq_ids}}, {'$set': update})
+            reaperutil.invalidate_hierarchy_cache(oid)
         except:
             self.abort(500, 'permissions not propagated from project {} to sessions'.format(_id))
 
@@ -316,56 +322,105 @@ class FileListHandler(ListHandler):
         hash_ = self.get_param('hash')
         if hash_ and hash_ != fileinfo['hash']:
             self.abort(409, 'file exists, hash mismatch')
-        filepath = os.path.join(config.get_item('persistent', 'data_path'), util.path_from_hash(fileinfo['hash']))
+        filepath = blobstore.resolve_path(config.get_item('persistent', 'data_path'), fileinfo['hash'])
         if self.get_param('ticket') == '':    # request for download ticket
             ticket = util.download_ticket(self.request.client_addr, 'file', _id, filename, fileinfo['size'])
             return {'ticket': config.db.downloads.insert_one(ticket).inserted_id}
         else:                                       # authenticated or ticketed (unauthenticated) download
             zip_member = self.get_param('member')
-            if self.is_true('info'):
-                try:
-                    with zipfile.ZipFile(filepath) as zf:
-                        return [(zi.filename, zi.file_size, datetime.datetime(*zi.date_time)) for zi in zf.infolist()]
-                except zipfile.BadZipfile:
+            if self.is_true('info') or self.is_true('comment') or zip_member:
+                zip_index = files.get_zip_index(fileinfo['hash'], filepath)
+                if zip_index is None:
                     self.abort(400, 'not a zip file')
+            if self.is_true('info'):
+                return [(m['name'], m['size'], datetime.datetime(*m['date_time'])) for m in files.zip_members(zip_index, filepath)]
             elif self.is_true('comment'):
-                try:
-                    with zipfile.ZipFile(filepath) as zf:
-                        self.response.write(zf.comment)
-                except zipfile.BadZipfile:
-                    self.abort(400, 'not a zip file')
+                self.response.write(str(zip_index['comment']))
             elif zip_member:
-                try:
-                    with zipfile.ZipFile(filepath) as zf:
-                        self.response.headers['Content-Type'] = util.guess_mimetype(zip_member)
-                        self.response.write(zf.open(zip_member).read())
-                except zipfile.BadZipfile:
-                    self.abort(400, 'not a zip file')
-                except KeyError:
+                member = files.zip_member_info(zip_index, zip_member, filepath)
+                if member is None:
                     self.abort(400, 'zip file contains no such member')
+                self._send_zip_member(filepath, member)
             else:
-                self.response.app_iter = open(filepath, 'rb')
-                self.response.headers['Content-Length'] = str(fileinfo['size']) # must be set after setting app_iter
+                cache = blobcache.get_cache()
+                cached_fd = cache.open(fileinfo['hash'], fileinfo['size']) if cache else None
+                if cached_fd:
+                    fd, compressed = cached_fd, False
+                else:
+                    fd, compressed = blobstore.open_stored_blob(filepath)
+                if compressed and 'gzip' in self.request.accept_encoding:
+                    # pass the compressed blob through
+                    size = os.fstat(fd.fileno()).st_size
+                    self.response.app_iter = files.iter_file(fd, size)
+                    self.response.headers['Content-Length'] = str(size) # must be set after setting app_iter
+                    self.response.headers['Content-Encoding'] = 'gzip'
+                else:
+                    if compressed:
+                        fd = blobstore.decompress(fd)
+                    if cache and not cached_fd:
+                        # fill the cache with the blob being sent
+                        fd = cache.tee(fd, fileinfo['hash'], fileinfo['size'])
+                    self.response.app_iter = files.iter_file(fd, fileinfo['size'])
+                    self.response.headers['Content-Length'] = str(fileinfo['size']) # must be set after setting app_iter
+                if compressed:
+                    self.response.headers['Vary'] = 'Accept-Encoding'
                 if self.is_true('view'):
                     self.response.headers['Content-Type'] = str(util.guess_mimetype(fileinfo.get('name')))
                 else:
                     self.response.headers['Content-Type'] = 'application/octet-stream'
                     self.response.headers['Content-Disposition'] = 'attachment; filename="' + os.path.basename(urllib.url2pathname(filename)) + '"'
 
+    def _send_zip_member(self, filepath, member):
+        """
+        Stream a zip member in chunks, the whole decompressed member is never held in memory.
+        Byte ranges are supported on stored members, as their data can be read directly from the zip file.
+        """
+        size = member['size']
+        byte_range = self.request.range if member['compress_type'] == zipfile.ZIP_STORED else None
+        try:
+            if byte_range:
+                start_stop = byte_range.range_for_length(size)
+                if start_stop is None:
+                    self.abort(416, 'requested range not satisfiable', headers={'Content-Range': 'bytes */%d' % size})
+                start, stop = start_stop
+                fd = files.open_zip_member_range(filepath, member, start)
+            else:
+                start, stop = 0, size
+                fd = files.open_zip_member(filepath, member)
+        except zipfile.BadZipfile:
+            self.abort(400, 'not a zip file')
+        self.response.app_iter = files.iter_file(fd, stop - start)
+        self.response.headers['Content-Length'] = str(stop - start) # must be set after setting app_iter
+        self.response.headers['Content-Type'] = str(util.guess_mimetype(member['name']))
+        if member['compress_type'] == zipfile.ZIP_STORED:
+            self.response.headers['Accept-Ranges'] = 'bytes'
+        if byte_range:
+            self.response.status = 206
+            self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+
     def delete(self, cont_name, list_name, **kwargs):
         kwargs['name'] = urllib.quote(kwargs.get('name'), '')
         filename = kwargs.get('name')
         _id = kwargs.get('cid')
+        storage = self.list_handler_configurations[cont_name][list_name]['storage']
+        try:
+            container = storage.get_container(_id, query_params={'name': filename})
+        except APIStorageException as e:
+            self.abort(400, e.message)
         result = super(FileListHandler, self).delete(cont_name, list_name, **kwargs)
+        if container:
+            blobrefs.remove_refs(blobrefs.file_hashes([container]))
         return result
 
     def post(self, cont_name, list_name, **kwargs):
         force = self.is_true('force')
         _id = kwargs.pop('cid')
         container, permchecker, storage, mongo_validator, payload_validator, keycheck = self._initialize_request(cont_name, list_name, _id)
+        # check the permissions before receiving the file, adding and replacing files both need write access
+        permchecker(lambda *args: None)('POST', _id=_id)
 
         result = None
-        with tempfile.TemporaryDirectory(prefix='.tmp', dir=config.get_item('persistent', 'data_path')) as tempdir_path:
+        with self.admit_upload(), tempfile.TemporaryDirectory(prefix='.tmp', dir=config.get_item('persistent', 'data_path')) as tempdir_path:
             file_store = files.FileStore(self.request, tempdir_path, filename=kwargs.get('name'))
             payload = file_store.payload
             file_datetime = datetime.datetime.utcnow()
@@ -380,23 +435,25 @@ class FileListHandler(ListHandler):
                 file_properties['metadata'] = file_store.metadata
             if file_store.tags:
                 file_properties['tags'] = file_store.tags
-            dest_path = os.path.join(config.get_item('persistent', 'data_path'), util.path_from_hash(file_properties['hash']))
+            dest_path = blobstore.resolve_path(config.get_item('persistent', 'data_path'), file_properties['hash'])
             query_params = None
+            replaced_hashes = []
             if not force:
                 method = 'POST'
             else:
                 filename = file_store.filename
-                filepath = file_store.path
                 for f in container.get('files', []):
                     if f['name'] == filename:
+                        filepath = blobstore.resolve_path(config.get_item('persistent', 'data_path'), f['hash'])
                         if file_store.identical(filepath, f['hash']):
                             log.debug('Dropping    %s (identical)' % filename)
-                            os.remove(filepath)
+                            os.remove(file_store.path)
                             return {'modified': 0}
                         else:
                             log.debug('Replacing   %s' % filename)
                             method = 'PUT'
                             query_params = {'name':filename}
+                            replaced_hashes.append(f['hash'])
                         break
                 else:
                     method = 'POST'
@@ -406,5 +463,6 @@ class FileListHandler(ListHandler):
             result = keycheck(mongo_validator(permchecker(storage.exec_op)))(method, _id=_id, query_params=query_params, payload=payload)
             if not result or result.modified_count != 1:
                 self.abort(404, 'Element not added in list {} of container {} {}'.format(storage.list_name, storage.cont_name, _id))
+            blobrefs.replace_refs(replaced_hashes, [file_properties['hash']])
             rules.create_jobs(config.db, container, cont_name[:-1], file_properties)
         return {'modified': result.modified_count}
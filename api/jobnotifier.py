@@ -0,0 +1,92 @@
+"""
+Notification of queued jobs, for the engines waiting for jobs in long-polling requests.
+
+Queuing jobs inserts an event in the capped job_events collection, created by config.initialize_db.
+Each API process tails the collection in a single thread, and wakes up its waiting requests on each
+event. Requests waiting in the process that queued the jobs are woken up directly.
+"""
+
+import time
+import pymongo
+import threading
+
+from . import config
+
+log = config.log
+
+
+class JobNotifier(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.thread = None
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def current(self):
+        """return the generation to wait on, read it before looking for jobs"""
+        self._start()
+        with self.condition:
+            return self.generation
+
+    def wait(self, generation, timeout):
+        """wait until jobs are queued after generation was read, or for timeout seconds"""
+        with self.condition:
+            if self.generation == generation:
+                self.condition.wait(timeout)
+            return self.generation
+
+    def _start(self):
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._tail, name='job-notifier')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _tail(self):
+        while True:
+            try:
+                self._tail_cursor()
+            except pymongo.errors.PyMongoError as e:
+                log.warning('job events not tailed: ' + str(e))
+            time.sleep(1)
+
+    def _tail_cursor(self):
+        """
+        Follow job_events with a single tailable cursor, in natural order, until the cursor dies.
+        The events in the collection when the cursor is opened are skipped up to the last one.
+        """
+        last_event = self.db.job_events.find_one(sort=[('$natural', -1)])
+        # the cursor is opened from the start of the collection, which holds at least the seed event of
+        # initialize_db, a tailable cursor matching no document would be closed immediately by the server
+        cursor = self.db.job_events.find(cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+        caught_up = last_event is None
+        # jobs may have been queued while no cursor was open
+        self.notify()
+        while cursor.alive:
+            for event in cursor:
+                if caught_up:
+                    self.notify()
+                elif event['_id'] == last_event['_id']:
+                    caught_up = True
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+def get_notifier():
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = JobNotifier(config.db)
+        return _notifier
+
+def jobs_queued(db, count):
+    """notify the waiting requests that count jobs were queued"""
+    db.job_events.insert_one({'queued': count})
+    if _notifier is not None:
+        _notifier.notify()
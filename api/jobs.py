@@ -5,19 +5,65 @@ API request handlers for process-job-handling.
 # We shadow the standard library; this is a workaround.
 from __future__ import absolute_import
 
+import os
+import bson
+import json
+import time
 import pymongo
 import datetime
+import itertools
+import threading
+import collections
+import dateutil.parser
+import dateutil.tz
 from collections import namedtuple
 
 from . import base
 from . import config
 from . import util
+from . import gears
+from . import blobstore
+from . import jobnotifier
 
 log = config.log
 
 # How many times a job should be retried
 MAX_ATTEMPTS = 3
 
+# How many jobs an engine can claim at once
+MAX_CLAIM = 100
+
+# How many seconds a running job is kept without a heartbeat, unless set otherwise for the job
+DEFAULT_LEASE = 100
+MAX_LEASE = 86400
+
+# Priority classes, the pending jobs of a higher class are always claimed first
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2 # interactive re-runs
+
+# The job_queues document holding the virtual time of the fair-share scheduler
+SYSTEM_QUEUE = '_system'
+DEFAULT_WEIGHT = 1.0
+
+# How many jobs are moved to the archive per bulk write
+ARCHIVE_BATCH = 1000
+
+# How many jobs are listed per page by default, and at most
+LIST_LIMIT = 100
+MAX_LIST_LIMIT = 1000
+
+# While a data-local engine waits for jobs, the other engines claim the jobs pending for this many seconds
+LOCAL_PREFERENCE = 2
+
+# How many seconds an engine can wait for jobs in a long-polling next request
+MAX_WAIT = 60
+# Waiting engines look for jobs at least this often, in case a notification was missed
+WAIT_SLICE = 10
+# How many engines wait for jobs at once per process, a waiting engine holds a server thread
+MAX_WAITERS = 2
+_waiters = threading.BoundedSemaphore(MAX_WAITERS)
+
 JOB_STATES = [
     'pending',  # Job is queued
     'running',  # Job has been handed to an engine and is being processed
@@ -25,6 +71,11 @@ JOB_STATES = [
     'complete', # Job has successfully completed
 ]
 
+JOB_STATES_TERMINAL = [
+    'failed',
+    'complete',
+]
+
 JOB_STATES_ALLOWED_MUTATE = [
     'pending',
     'running',
@@ -39,27 +90,6 @@ JOB_TRANSITIONS = [
 def valid_transition(from_state, to_state):
     return (from_state + ' --> ' + to_state) in JOB_TRANSITIONS or from_state == to_state
 
-Category = util.Enum('Category', {
-    'classifier': 'classifier', # discover metadata
-    'converter':  'converter',  # translate between formats
-    'qa':         'qa',         # quality assurance
-    'analytical': 'analytical', # general purpose
-})
-
-Gear = namedtuple('gear', ['name', 'category', 'input'])
-
-Gears = [
-    Gear('dicom_mr_classifier', Category.classifier, {'type': 'file', 'location': '/', 'uri': '/opt/flywheel-temp/dicom_mr_classifier-0.0.1.c.tar'}),
-    Gear('dcm_convert',         Category.converter,  {'type': 'file', 'location': '/', 'uri': '/opt/flywheel-temp/dcm_convert-0.3.0.c.tar'      }),
-    Gear('qa-report-fmri',      Category.qa,         {'type': 'file', 'location': '/', 'uri': '/opt/flywheel-temp/qa-report-fmri-0.1.0.c.tar'     })
-]
-
-def get_gear_by_name(name):
-    for gear in Gears:
-        if gear.name == name:
-            return gear
-    raise Exception("Unknown gear " + name)
-
 # A FileInput tuple holds all the details of a scitran file that needed to use that as an input a formula.
 FileInput = namedtuple('input', ['container_type', 'container_id', 'filename', 'filehash'])
 
@@ -103,25 +133,164 @@ def create_fileinput_from_reference(container, container_type, file_):
     return FileInput(container_type=container_type, container_id=container_id, filename=filename, filehash=filehash)
 
 
-def queue_job(db, algorithm_id, input, tags=[], attempt_n=1, previous_job_id=None):
+def memo_key(gear, filehash):
+    """jobs with the same memo key compute the same results"""
+    return ':'.join((gear.name, gear.version, filehash))
+
+def memoize(db, job_specs):
+    """
+    Drop the jobs that would compute results already computed or being computed.
+
+    A job is coalesced with a pending, running or complete job with the same memo key and input container.
+    The results of a complete job with the same memo key for another acquisition can be reused.
+    Returns the job specs to queue, and (job spec, complete job) pairs for the reusable results.
     """
-    Enqueues a job for execution.
+
+    keys = [memo_key(gears.get_gear(algorithm_id), input.filehash) for algorithm_id, input in job_specs]
+    existing = {}
+    query = {'memo_key': {'$in': keys}, 'state': {'$in': ['pending', 'running', 'complete']}}
+    fields = ['memo_key', 'state', 'input', 'outputs']
+    for j in itertools.chain(db.jobs.find(query, fields), db.jobs_archive.find(query, fields)):
+        existing.setdefault(j['memo_key'], []).append(j)
+
+    to_queue = []
+    reusable = []
+    coalesced = 0
+    for (algorithm_id, input), key in zip(job_specs, keys):
+        same_key = existing.get(key, [])
+        if any(j['input']['container_type'] == input.container_type and j['input']['container_id'] == input.container_id for j in same_key):
+            coalesced += 1
+            continue
+        computed = [j for j in same_key if j['state'] == 'complete' and j.get('outputs')]
+        if computed and input.container_type == 'acquisition':
+            reusable.append(((algorithm_id, input), computed[0]))
+        else:
+            to_queue.append((algorithm_id, input))
+        # the same file can be in a batch twice
+        same_key.append({'state': 'pending', 'input': input._asdict()})
+        existing[key] = same_key
+
+    if coalesced:
+        log.info('coalesced %d jobs with identical jobs' % coalesced)
+        db.job_stats.update_one({'_id': 'memo'}, {'$inc': {'coalesced': coalesced}}, upsert=True)
+    return to_queue, reusable
+
+def record_reused(db, algorithm_id, input, memo_job, queue=''):
+    """
+    Record a complete job whose results were reused from memo_job instead of computed.
+    Returns the id of the job.
+    """
+
+    job = _new_job(algorithm_id, input, queue=queue)
+    job['state'] = 'complete'
+    job['memo_of'] = memo_job['_id']
+    job['outputs'] = memo_job['outputs']
+    db.jobs.insert_one(job)
+    count_new_jobs(db, [job])
+    db.job_stats.update_one({'_id': 'memo'}, {'$inc': {'reused': 1}}, upsert=True)
+
+    log.info('Reused      results of job %s as job %s for %s %s' % (memo_job['_id'], job['_id'], input.container_type, input.container_id))
+    return job['_id']
+
+def outputs_stored(outputs, data_path):
+    """
+    Whether the output files of a job are all still stored.
+    Job outputs do not hold blob references, their blobs are collected once the output files are deleted.
+    """
+    return all(
+        blobstore.stored_path(blobstore.resolve_path(data_path, f['hash'])) is not None
+        for f in outputs['files']
+    )
+
+def record_outputs(db, job_id, metadata, fileinfos, received):
+    """
+    Record the outputs of a job uploaded by an engine, for reusing them.
 
     Parameters
     ----------
-    db: pymongo.database.Database
-        Reference to the database instance
-    algorithm_id: string
-        Human-friendly unique name of the algorithm
-    input: FileInput
-        The input to be used by this job
-    tags: string array (optional)
-        Tags that this job should be marked with.
-    attempt_n: integer (optional)
-        If an equivalent job has tried & failed before, pass which attempt number we're at. Defaults to 1 (no previous attempts).
+    metadata: dict
+        The container metadata of the engine upload
+    fileinfos: list of dict
+        The fileinfos added or updated by the engine upload
+    received: list of string
+        The names of the files received in the engine upload
+    """
+
+    outputs = {'metadata': metadata, 'files': fileinfos, 'received': received}
+    db.jobs.update_one({'_id': job_id}, {'$set': {'outputs': outputs}})
+
+def _tags_key(tags):
+    return 'tags:' + '|'.join(sorted(tags))
+
+def count_new_jobs(db, new_jobs):
+    """
+    Count inserted jobs in the materialized statistics, by state and by tags.
+    The counters are only maintained once they were built by rebuild_stats.
     """
 
-    gear = get_gear_by_name(algorithm_id)
+    if not new_jobs:
+        return
+    states = collections.Counter(j['state'] for j in new_jobs)
+    inc = dict(('state.' + state, n) for state, n in states.iteritems())
+    inc['total'] = len(new_jobs)
+    result = db.job_stats.update_one({'_id': 'counts'}, {'$inc': inc})
+    if not result.matched_count:
+        return
+    tags = collections.Counter(_tags_key(j['tags']) for j in new_jobs)
+    now = datetime.datetime.utcnow()
+    db.job_stats.bulk_write([
+        # a tags counter created while the statistics are rebuilt is newer than the rebuild, rebuild_stats keeps it
+        pymongo.UpdateOne({'_id': key}, {'$inc': {'count': n}, '$setOnInsert': {'tags': key[len('tags:'):].split('|'), 'rebuilt': now}}, upsert=True)
+        for key, n in tags.iteritems()
+    ], ordered=False)
+
+def count_transition(db, from_state, to_state, n=1, permafailed=0):
+    """count n jobs moving from from_state to to_state in the materialized statistics"""
+
+    if n and from_state != to_state:
+        db.job_stats.update_one({'_id': 'counts'}, {'$inc': {'state.' + from_state: -n, 'state.' + to_state: n, 'permafailed': permafailed}})
+
+def rebuild_stats(db):
+    """
+    Build the materialized statistics from the jobs and the archived jobs, with full collection aggregations.
+    The tags counters are overwritten in place, then the counters of tags no job has anymore are removed,
+    so that readers and count_new_jobs never see the tags counters missing.
+    Returns the counts document.
+    """
+
+    now = datetime.datetime.utcnow()
+    by_state = collections.Counter(dict((s, 0) for s in JOB_STATES))
+    tags = collections.Counter()
+    permafailed = 0
+    for collection in (db.jobs, db.jobs_archive):
+        for r in collection.aggregate([{"$group": {"_id": "$state", "count": {"$sum": 1}}}]):
+            by_state[r['_id']] += r['count']
+        for r in collection.aggregate([{"$group": {"_id": "$tags", "count": {"$sum": 1}}}]):
+            tags[_tags_key(r['_id'] or [])] += r['count']
+        permafailed += collection.count({"attempt": {"$gte": MAX_ATTEMPTS}, "state": "failed"})
+    counts = {
+        '_id': 'counts',
+        'state': dict(by_state),
+        'total': sum(by_state.itervalues()),
+        'permafailed': permafailed,
+        'rebuilt': now,
+    }
+    if tags:
+        db.job_stats.bulk_write([
+            pymongo.UpdateOne({'_id': key}, {'$set': {'tags': key[len('tags:'):].split('|'), 'count': n, 'rebuilt': now}}, upsert=True)
+            for key, n in tags.iteritems()
+        ], ordered=False)
+    db.job_stats.delete_many({'_id': {'$regex': '^tags:'}, 'rebuilt': {'$lt': now}})
+    db.job_stats.replace_one({'_id': 'counts'}, counts, upsert=True)
+    return counts
+
+def _new_job(algorithm_id, input, tags=[], attempt_n=1, previous_job_id=None, lease=DEFAULT_LEASE, priority=PRIORITY_NORMAL, queue=''):
+    """
+    Build a pending job document, see queue_job for the parameters.
+    """
+
+    gear = gears.get_gear(algorithm_id)
+    check_lease(lease)
 
     if input.container_type.endswith('s'):
         raise Exception('Container type cannot be plural :|')
@@ -136,7 +305,10 @@ def queue_job(db, algorithm_id, input, tags=[], attempt_n=1, previous_job_id=Non
     # Union of two arrays
     tags = list(set(hardcoded_tags) | set(tags))
 
+    _id = bson.ObjectId()
+
     job = {
+        '_id': _id,
         'state': 'pending',
 
         'created':  now,
@@ -146,32 +318,309 @@ def queue_job(db, algorithm_id, input, tags=[], attempt_n=1, previous_job_id=Non
         'input': input._asdict(),
 
         'attempt': attempt_n,
-        'tags': tags
+        'tags': tags,
+        'lease': lease,
+
+        # Scheduling: by priority class, then fair share between queues, see assign_vtimes
+        'priority': priority,
+        'queue': queue,
+
+        # the formula is generated once, engines claim jobs with it
+        'request': generate_formula(gear.name, input._asdict(), _id),
+        'memo_key': memo_key(gear, input.filehash),
     }
 
     if previous_job_id is not None:
         job['previous_job_id'] = previous_job_id
 
+    return job
+
+def _queue_cost(q):
+    """the virtual time taken by a job of queue document q, the weights are set by hand in the database"""
+    weight = q.get('weight')
+    if isinstance(weight, bool) or not isinstance(weight, (int, long, float)) or not 0 < weight < float('inf'):
+        log.warning('queue %s has invalid weight %r, using %s' % (q['_id'], weight, DEFAULT_WEIGHT))
+        weight = DEFAULT_WEIGHT
+    return 1.0 / weight
+
+def assign_vtimes(db, new_jobs):
+    """
+    Assign the virtual start times of new jobs, for start-time fair queuing between their queues.
+
+    Each queue, e.g. a project, has a virtual finish time advanced by 1/weight per job. A job starts at
+    the later of its queue finish time and the system virtual time, the start time of the last claimed job.
+    Pending jobs are claimed in virtual start time order, a queue with many jobs does not delay the jobs
+    of the other queues, which get their turn at their share of the engines.
+    """
+
+    system = db.job_queues.find_one({'_id': SYSTEM_QUEUE}) or {}
+    system_vtime = system.get('vtime', 0.0)
+    by_queue = {}
+    for job in new_jobs:
+        by_queue.setdefault(job['queue'], []).append(job)
+    for queue, queue_jobs_ in by_queue.iteritems():
+        q = db.job_queues.find_one_and_update(
+            {'_id': queue},
+            {'$max': {'finish': system_vtime}, '$setOnInsert': {'weight': DEFAULT_WEIGHT}},
+            upsert=True,
+            return_document=pymongo.collection.ReturnDocument.AFTER
+        )
+        cost = _queue_cost(q)
+        q = db.job_queues.find_one_and_update(
+            {'_id': queue},
+            {'$inc': {'finish': cost * len(queue_jobs_)}},
+            return_document=pymongo.collection.ReturnDocument.AFTER
+        )
+        start = q['finish'] - cost * len(queue_jobs_)
+        for i, job in enumerate(queue_jobs_):
+            job['vtime'] = start + i * cost
+
+def queue_job(db, algorithm_id, input, tags=[], attempt_n=1, previous_job_id=None, lease=DEFAULT_LEASE, priority=PRIORITY_NORMAL, queue=''):
+    """
+    Enqueues a job for execution.
+
+    Parameters
+    ----------
+    db: pymongo.database.Database
+        Reference to the database instance
+    algorithm_id: string
+        Human-friendly unique name of the algorithm
+    input: FileInput
+        The input to be used by this job
+    tags: string array (optional)
+        Tags that this job should be marked with.
+    attempt_n: integer (optional)
+        If an equivalent job has tried & failed before, pass which attempt number we're at. Defaults to 1 (no previous attempts).
+    lease: integer (optional)
+        Seconds the job is kept running without a heartbeat before it is reaped. Defaults to DEFAULT_LEASE.
+    priority: integer (optional)
+        Priority class of the job. Defaults to PRIORITY_NORMAL.
+    queue: string (optional)
+        Fair-share queue of the job, e.g. the id of the project of the input.
+    """
+
+    job = _new_job(algorithm_id, input, tags=tags, attempt_n=attempt_n, previous_job_id=previous_job_id, lease=lease, priority=priority, queue=queue)
+    assign_vtimes(db, [job])
+
     result = db.jobs.insert_one(job)
     _id = result.inserted_id
+    count_new_jobs(db, [job])
+    jobnotifier.jobs_queued(db, 1)
 
-    log.info('Running %s as job %s to process %s %s' % (gear.name, str(_id), input.container_type, input.container_id))
+    log.info('Running %s as job %s to process %s %s' % (job['algorithm_id'], str(_id), input.container_type, input.container_id))
     return _id
 
+def queue_jobs(db, job_specs, queue=''):
+    """
+    Enqueues many jobs for execution with a single insert.
+
+    Parameters
+    ----------
+    db: pymongo.database.Database
+        Reference to the database instance
+    job_specs: list of (string, FileInput) tuples
+        The algorithm id and the input of each job
+    queue: string (optional)
+        Fair-share queue of the jobs, e.g. the id of the project of the inputs.
+    """
+
+    if not job_specs:
+        return []
+
+    new_jobs = [_new_job(algorithm_id, input, queue=queue) for algorithm_id, input in job_specs]
+    assign_vtimes(db, new_jobs)
+
+    result = db.jobs.insert_many(new_jobs)
+    count_new_jobs(db, new_jobs)
+    jobnotifier.jobs_queued(db, len(new_jobs))
+
+    for job, _id in zip(new_jobs, result.inserted_ids):
+        log.info('Running %s as job %s to process %s %s' % (job['algorithm_id'], str(_id), job['input']['container_type'], job['input']['container_id']))
+    return result.inserted_ids
+
 def retry_job(db, j, force=False):
     """
     Given a failed job, either retry the job or fail it permanently, based on the attempt number.
     Can override the attempt limit by passing force=True.
     """
 
-    if j['attempt'] < MAX_ATTEMPTS or force:
-        job_id = queue_job(db, j['algorithm_id'], convert_to_fileinput(j['input']), attempt_n=j['attempt']+1, previous_job_id=j['_id'])
+    retry_jobs(db, [j], force=force)
+
+def retry_jobs(db, failed_jobs, force=False, priority=None):
+    """
+    Retry many failed jobs with a single insert, the jobs at the attempt limit are failed permanently.
+    The new jobs keep the priority of the failed jobs, unless priority is given.
+    Returns the ids of the new jobs.
+    """
+
+    retried = []
+    for j in failed_jobs:
+        if j['attempt'] < MAX_ATTEMPTS or force:
+            retried.append(j)
+        else:
+            log.info('permanently failed job %s (after %d attempts)' % (j['_id'], j['attempt']))
+    if not retried:
+        return []
+
+    new_jobs = [
+        _new_job(
+            j['algorithm_id'], convert_to_fileinput(j['input']), attempt_n=j['attempt']+1, previous_job_id=j['_id'],
+            lease=j.get('lease', DEFAULT_LEASE), priority=priority if priority is not None else j.get('priority', PRIORITY_NORMAL),
+            queue=j.get('queue', '')
+        )
+        for j in retried
+    ]
+    assign_vtimes(db, new_jobs)
+    result = db.jobs.insert_many(new_jobs)
+    count_new_jobs(db, new_jobs)
+    jobnotifier.jobs_queued(db, len(new_jobs))
+
+    for j, job_id in zip(retried, result.inserted_ids):
         log.info('respawned job %s as %s (attempt %d)' % (j['_id'], job_id, j['attempt']+1))
+    return result.inserted_ids
+
+def check_lease(lease):
+    """raise ValueError unless lease is a number of seconds between 1 and MAX_LEASE"""
+    if not isinstance(lease, (int, long)) or isinstance(lease, bool) or not 0 < lease <= MAX_LEASE:
+        raise ValueError('lease must be an integer between 1 and {}'.format(MAX_LEASE))
+
+def lease_expiration(heartbeat, lease):
+    """a running job is reaped when its lease expires, lease seconds after its last heartbeat"""
+    return heartbeat + datetime.timedelta(seconds=lease)
+
+def reap_jobs(db):
+    """
+    Fail the running jobs whose lease expired and retry them.
+    The expired jobs are failed with a single update under a token unique to this call, whatever their number.
+    Returns the number of reaped jobs.
+    """
+
+    now = datetime.datetime.utcnow()
+    token = bson.ObjectId()
+    result = db.jobs.update_many(
+        {'state': 'running', 'expires': {'$lt': now}},
+        {'$set': {'state': 'failed', 'modified': now, 'reaped': token}}
+    )
+    if not result.modified_count:
+        return 0
+
+    failed_jobs = list(db.jobs.find({'reaped': token}))
+    count_transition(db, 'running', 'failed', len(failed_jobs), permafailed=sum(1 for j in failed_jobs if j['attempt'] >= MAX_ATTEMPTS))
+    for j in failed_jobs:
+        log.info('reaped job %s (no heartbeat for %d seconds)' % (j['_id'], j.get('lease', DEFAULT_LEASE)))
+    retry_jobs(db, failed_jobs)
+    return len(failed_jobs)
+
+def claim_jobs(db, count, min_age=None):
+    """
+    Mark up to count pending jobs as running and return them, by priority and virtual start time.
+
+    The first pending jobs are claimed with a single update, under a token unique to this call.
+    Jobs claimed concurrently by another engine do not match the update, the next pending jobs are
+    claimed instead, until count jobs are claimed or no pending jobs remain.
+    With min_age, only the jobs pending for at least min_age seconds are claimed.
+    """
+
+    now = datetime.datetime.utcnow()
+    query = {'state': 'pending'}
+    if min_age:
+        query['modified'] = {'$lt': now - datetime.timedelta(seconds=min_age)}
+    token = bson.ObjectId()
+    candidates = []
+    n_claimed = 0
+    while n_claimed < count:
+        if candidates:
+            query['_id'] = {'$nin': candidates}
+        batch = list(db.jobs.find(query, ['_id', 'lease']).sort([('priority', -1), ('vtime', 1)]).limit(count - n_claimed))
+        if not batch:
+            break
+        candidates += [j['_id'] for j in batch]
+        # the jobs of each lease duration expire together, the leases are few distinct durations
+        by_lease = collections.defaultdict(list)
+        for j in batch:
+            by_lease[j.get('lease', DEFAULT_LEASE)].append(j['_id'])
+        for lease, ids in by_lease.iteritems():
+            result = db.jobs.update_many(
+                {'_id': {'$in': ids}, 'state': 'pending'},
+                {'$set': {'state': 'running', 'modified': now, 'heartbeat': now, 'expires': lease_expiration(now, lease), 'claim': token}}
+            )
+            n_claimed += result.modified_count
+    if not n_claimed:
+        return []
+
+    count_transition(db, 'pending', 'running', n_claimed)
+    claimed = dict((j['_id'], j) for j in db.jobs.find({'_id': {'$in': candidates}, 'claim': token}))
+
+    # Jobs queued before the formulas were generated at enqueue time
+    for j in claimed.itervalues():
+        if 'request' not in j:
+            j['request'] = generate_formula(j['algorithm_id'], j['input'], j['_id'])
+            db.jobs.update_one({'_id': j['_id']}, {'$set': {'request': j['request']}})
+
+    # The system virtual time follows the start time of the claimed jobs
+    vtimes = [j['vtime'] for j in claimed.itervalues() if 'vtime' in j]
+    if vtimes:
+        db.job_queues.update_one({'_id': SYSTEM_QUEUE}, {'$max': {'vtime': max(vtimes)}}, upsert=True)
+
+    return [claimed[_id] for _id in candidates if _id in claimed]
+
+
+def register_engine(db, engine_id, capabilities):
+    """
+    Register the capabilities of an engine, replacing the previous ones.
+
+    capabilities: dict
+        data_path: the mount point of the data_path of the API on the engine, for data-local jobs
+    """
+    db.engines.update_one(
+        {'_id': engine_id},
+        {'$set': {'capabilities': capabilities, 'registered': datetime.datetime.utcnow()}},
+        upsert=True
+    )
+
+def engine_seen(db, engine_id):
+    """record that an engine is looking for jobs, return its registration or None"""
+    return db.engines.find_one_and_update({'_id': engine_id}, {'$set': {'seen': datetime.datetime.utcnow()}})
+
+def engine_waiting(db, engine_id, until):
+    """record that an engine waits for jobs until the until datetime, or stopped waiting if until is None"""
+    if until is None:
+        db.engines.update_one({'_id': engine_id}, {'$unset': {'waiting': ''}})
     else:
-        log.info('permanently failed job %s (after %d attempts)' % (j['_id'], j['attempt']))
+        db.engines.update_one({'_id': engine_id}, {'$set': {'waiting': until}})
+
+def local_engine_waiting(db):
+    """whether a data-local engine is waiting for jobs, it has free processing slots"""
+    now = datetime.datetime.utcnow()
+    return db.engines.find_one({'capabilities.data_path': {'$exists': True}, 'waiting': {'$gt': now}}, []) is not None
+
+def localize_formula(formula, path, filename, data_path, engine_data_path):
+    """
+    Return the formula with its scitran input replaced by the blob at path, in the data_path mount of an engine.
+    Blobs stored compressed or chunked are not readable in place, their formula is returned as is.
+    """
+    if not os.path.isfile(path):
+        return formula
+    local_input = {
+        'type': 'local',
+        'uri': os.path.join(engine_data_path, os.path.relpath(path, data_path)),
+        'name': filename,
+    }
+    inputs = [dict(local_input, location=i['location']) if i['type'] == 'scitran' else i for i in formula['inputs']]
+    return dict(formula, inputs=inputs)
 
+def localize_jobs(claimed, data_path, engine_data_path):
+    """return the claimed jobs with their inputs read from the data_path mount of an engine"""
+    return [
+        dict(j, request=localize_formula(
+            j['request'], blobstore.resolve_path(data_path, j['input']['filehash']), j['input']['filename'],
+            data_path, engine_data_path
+        ))
+        for j in claimed
+    ]
 
-def generate_formula(algorithm_id, i):
+
+def generate_formula(algorithm_id, i, job_id=None):
     """
     Given an intent, generates a formula to execute a job.
 
@@ -181,36 +630,104 @@ def generate_formula(algorithm_id, i):
         Human-friendly unique name of the algorithm
     i: FileInput
         The input to be used by this job
+    job_id: ObjectId (optional)
+        The id of the job, the outputs are recorded on the job for memoization
     """
 
-    gear = get_gear_by_name(algorithm_id)
-
-    f = {
-        'inputs': [
-            gear.input,
-            {
-                'type': 'scitran',
-                'uri': '/' + i['container_type'] + 's/' + i['container_id'] + '/files/' + i['filename'],
-                'location': '/flywheel/v0/input',
-            }
-        ],
-        'target': {
-            'command': ['bash', '-c', 'rm -rf output; mkdir -p output; sed -i \'s/_dicom//\' run; ./run; echo "Exit was $?"'],
-            'env': {
-                'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
-            },
-            'dir': "/flywheel/v0",
-        },
-        'outputs': [
-            {
-                'type': 'scitran',
-                'uri': '/engine?level=' + i['container_type'] + '&id=' + i['container_id'],
-                'location': '/flywheel/v0/output',
-            },
-        ],
-    }
+    return gears.get_template(algorithm_id).formula(i, job_id)
+
+
+def find_job(db, _id):
+    """find a job by id, in the jobs or in the archived jobs"""
+    return db.jobs.find_one({'_id': _id}) or db.jobs_archive.find_one({'_id': _id})
+
+def job_attempts(db, job):
+    """return the attempts of a job, following previous_job_id through the archive, the first attempt first"""
+    attempts = [job]
+    while attempts[-1].get('previous_job_id') is not None:
+        previous = find_job(db, attempts[-1]['previous_job_id'])
+        if previous is None:
+            break
+        attempts.append(previous)
+    return attempts[::-1]
+
+def archive_jobs(db, age, limit=None):
+    """
+    Move the failed and complete jobs not modified for age seconds to the jobs_archive collection.
+    Jobs are copied and then removed in batches, a job copied by an interrupted run is removed by the next one.
+    Returns the number of archived jobs.
+    """
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=age)
+    archived = 0
+    while limit is None or archived < limit:
+        batch_size = ARCHIVE_BATCH if limit is None else min(ARCHIVE_BATCH, limit - archived)
+        batch = list(db.jobs.find({'state': {'$in': JOB_STATES_TERMINAL}, 'modified': {'$lt': cutoff}}).limit(batch_size))
+        if not batch:
+            break
+        try:
+            db.jobs_archive.insert_many(batch, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # jobs already archived by an interrupted run
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+        result = db.jobs.delete_many({'_id': {'$in': [j['_id'] for j in batch]}, 'state': {'$in': JOB_STATES_TERMINAL}})
+        archived += result.deleted_count
+    if archived:
+        log.info('archived %d jobs' % archived)
+    return archived
+
+def _parse_time(value):
+    """parse an ISO 8601 time as a naive UTC datetime, as stored"""
+    time_ = dateutil.parser.parse(value)
+    if time_.tzinfo is not None:
+        time_ = time_.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
+    return time_
+
+def list_query(states=None, algorithm_id=None, tags=None, container_type=None, container_id=None, since=None, until=None, after=None):
+    """
+    Build the query of a job listing, sorted by modified and _id, newest first.
+
+    states: list of job states
+    tags: list of tags the jobs must all have
+    since, until: range of modification times, ISO 8601 strings
+    after: the modified and _id of the last job of the previous page, separated by a comma
+    Raises ValueError on an invalid time, id or cursor.
+    """
 
-    return f
+    query = {}
+    if states:
+        query['state'] = {'$in': states}
+    if algorithm_id:
+        query['algorithm_id'] = algorithm_id
+    if tags:
+        query['tags'] = {'$all': tags}
+    if container_type:
+        query['input.container_type'] = container_type
+    if container_id:
+        query['input.container_id'] = container_id
+    if since or until:
+        query['modified'] = {}
+        if since:
+            query['modified']['$gte'] = _parse_time(since)
+        if until:
+            query['modified']['$lt'] = _parse_time(until)
+    if after:
+        modified, _, _id = after.rpartition(',')
+        modified = _parse_time(modified)
+        _id = bson.ObjectId(_id)
+        query['$or'] = [
+            {'modified': {'$lt': modified}},
+            {'modified': modified, '_id': {'$lt': _id}},
+        ]
+    return query
+
+def iter_json_list(cursor):
+    """serialize the documents of cursor as a JSON list, one document at a time"""
+    yield '['
+    for i, doc in enumerate(cursor):
+        yield (',' if i else '') + json.dumps(doc, default=util.custom_json_serializer)
+    yield ']'
 
 
 class Jobs(base.RequestHandler):
@@ -219,108 +736,191 @@ class Jobs(base.RequestHandler):
 
     def get(self):
         """
-        List all jobs. Not used by engine.
+        List jobs, newest first, one page at a time. Not used by engine.
+
+        Filters: state (comma separated), algorithm_id, tag (repeated), container_type, container_id,
+        since and until (modification times). The next page is listed with after=<modified>,<_id>
+        of the last job of the page. fields selects the returned fields, comma separated.
+        With archived=true, lists the archived jobs.
         """
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
 
-        results = list(config.db.jobs.find())
-
-        return results
+        state = self.get_param('state')
+        try:
+            limit = int(self.get_param('limit', LIST_LIMIT))
+            query = list_query(
+                states=state.split(',') if state else None,
+                algorithm_id=self.get_param('algorithm_id'),
+                tags=self.request.GET.getall('tag'),
+                container_type=self.get_param('container_type'),
+                container_id=self.get_param('container_id'),
+                since=self.get_param('since'),
+                until=self.get_param('until'),
+                after=self.get_param('after'),
+            )
+        except (ValueError, bson.errors.InvalidId) as e:
+            self.abort(400, 'invalid job listing parameters: ' + str(e))
+        if not 0 < limit <= MAX_LIST_LIMIT:
+            self.abort(400, 'limit must be between 1 and {}'.format(MAX_LIST_LIMIT))
+
+        fields = self.get_param('fields')
+        projection = None
+        if fields:
+            # modified and _id are always returned, they are the cursor of the next page
+            projection = dict((field, 1) for field in fields.split(',') + ['modified'])
+
+        collection = config.db.jobs_archive if self.is_true('archived') else config.db.jobs
+        cursor = collection.find(query, projection).sort([('modified', -1), ('_id', -1)]).limit(limit)
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.app_iter = iter_json_list(cursor)
 
     def count(self):
         """Return the total number of jobs. Not used by engine."""
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
 
-        return config.db.jobs.count()
+        counts = config.db.job_stats.find_one({'_id': 'counts'}) or rebuild_stats(config.db)
+        return counts['total']
 
     def stats(self):
+        """
+        Return the job counts by state and by tags, from the materialized statistics.
+        The statistics are rebuilt from the jobs with rebuild=true, or if they were never built.
+        """
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
 
-        # Count jobs by state
-        result = config.db.jobs.aggregate([{"$group": {"_id": "$state", "count": {"$sum": 1}}}])
-        # Map mongo result to a useful object
-        by_state = {s: 0 for s in JOB_STATES}
-        by_state.update({r['_id']: r['count'] for r in result})
+        counts = None if self.is_true('rebuild') else config.db.job_stats.find_one({'_id': 'counts'})
+        if counts is None:
+            counts = rebuild_stats(config.db)
 
-        # Count jobs by tag grouping
-        result = list(config.db.jobs.aggregate([{"$group": {"_id": "$tags", "count": {"$sum": 1}}}]))
-        by_tag = []
-        for r in result:
-            by_tag.append({'tags': r['_id'], 'count': r['count']})
+        by_state = dict((s, 0) for s in JOB_STATES)
+        by_state.update(counts['state'])
+        by_tag = [{'tags': r['tags'], 'count': r['count']} for r in config.db.job_stats.find({'_id': {'$regex': '^tags:'}, 'count': {'$gt': 0}})]
 
-        # Count jobs that will not be retried
-        permafailed = config.db.jobs.count({"attempt": {"$gte": MAX_ATTEMPTS}, "state":"failed"})
+        # Count jobs that were not computed, coalesced with identical jobs or reusing their results
+        memo = config.db.job_stats.find_one({'_id': 'memo'}) or {}
 
         return {
             'by-state': by_state,
             'by-tag': by_tag,
-            'permafailed': permafailed
+            'permafailed': counts['permafailed'],
+            'memoized': {'coalesced': memo.get('coalesced', 0), 'reused': memo.get('reused', 0)},
         }
 
     def next(self):
         """
-        Atomically change a 'pending' job to 'running' and returns it. Updates timestamp.
-        Will return empty if there are no jobs to offer.
+        Atomically change up to count 'pending' jobs to 'running' and returns them. Updates timestamp.
+        Without count, returns a single job, or 400 if there are no jobs to offer.
+        With wait, blocks up to wait seconds until jobs are queued when there are no jobs to offer.
+        Once MAX_WAITERS engines wait in this process, the others are answered at once.
         Engine will poll this endpoint whenever there are free processing slots.
+
+        Engines registered with a data_path mount are offered jobs first, and their jobs read the
+        input blobs from the mount, see register_engine. They identify themselves with engine.
         """
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
 
-        # First, atomically mark document as running.
-        result = config.db.jobs.find_one_and_update(
-            {
-                'state': 'pending'
-            },
-            { '$set': {
-                'state': 'running',
-                'modified': datetime.datetime.utcnow()}
-            },
-            sort=[('modified', 1)],
-            return_document=pymongo.collection.ReturnDocument.AFTER
-        )
-
-        if result is None:
+        count = self.get_param('count')
+        wait = self.get_param('wait')
+        try:
+            n = int(count) if count is not None else 1
+            wait = min(float(wait), MAX_WAIT) if wait is not None else 0
+        except ValueError:
+            self.abort(400, 'count must be an integer and wait a number of seconds')
+        if not 0 < n <= MAX_CLAIM:
+            self.abort(400, 'count must be between 1 and {}'.format(MAX_CLAIM))
+
+        engine_id = self.get_param('engine')
+        engine = engine_seen(config.db, engine_id) if engine_id else None
+        engine_data_path = engine and engine.get('capabilities', {}).get('data_path')
+
+        # the other request threads are kept for uploads and downloads
+        holds_waiter = wait > 0 and _waiters.acquire(False)
+        if not holds_waiter:
+            wait = 0
+        deadline = time.time() + wait
+        notifier = jobnotifier.get_notifier() if wait > 0 else None
+        waiting = False
+        try:
+            while True:
+                # read the generation before looking for jobs, not to miss jobs queued in between
+                generation = notifier.current() if notifier else None
+                # the jobs just queued are left to the data-local engines waiting for them
+                min_age = LOCAL_PREFERENCE if not engine_data_path and local_engine_waiting(config.db) else None
+                claimed = claim_jobs(config.db, n, min_age)
+                remaining = deadline - time.time()
+                if claimed or remaining <= 0:
+                    break
+                if engine_data_path and not waiting:
+                    waiting = True
+                    engine_waiting(config.db, engine_id, datetime.datetime.utcnow() + datetime.timedelta(seconds=remaining))
+                # jobs left to a data-local engine are claimable once pending for LOCAL_PREFERENCE seconds
+                notifier.wait(generation, min(remaining, LOCAL_PREFERENCE if min_age else WAIT_SLICE))
+        finally:
+            if waiting:
+                engine_waiting(config.db, engine_id, None)
+            if holds_waiter:
+                _waiters.release()
+
+        if engine_data_path:
+            claimed = localize_jobs(claimed, config.get_item('persistent', 'data_path'), engine_data_path)
+        if count is not None:
+            return claimed
+        if not claimed:
             self.abort(400, 'No jobs to process')
+        return claimed[0]
 
-        # Second, update document to store formula request.
-        result = config.db.jobs.find_one_and_update(
-            {
-                '_id': result['_id']
-            },
-            { '$set': {
-                'request': generate_formula(result['algorithm_id'], result['input'])}
-            },
-            return_document=pymongo.collection.ReturnDocument.AFTER
-        )
+    def reap_stale(self):
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        return {'reaped': reap_jobs(config.db)}
+
+    def archive(self):
+        """Move the jobs finished for longer than job_archive_age days out of the jobs collection."""
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
 
-        if result is None:
-            self.abort(500, 'Marked job as running but could not generate and save formula')
+        limit = self.get_param('limit')
+        try:
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            self.abort(400, 'limit must be an integer')
+        age = float(config.get_item('persistent', 'job_archive_age')) * 86400
+        return {'archived': archive_jobs(config.db, age, limit)}
 
-        return result
 
-    def reap_stale(self):
+class Engine(base.RequestHandler):
+
+    """Provides /engines/<engine> routes."""
+
+    def get(self, _id):
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        engine = config.db.engines.find_one({'_id': _id})
+        if engine is None:
+            self.abort(404, 'Engine not found')
+        return engine
+
+    def put(self, _id):
+        """
+        Register the capabilities of an engine.
+        An engine that mounts the data_path of the API registers its mount point as data_path.
+        """
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
 
-        while True:
-            j = config.db.jobs.find_one_and_update(
-                {
-                    'state': 'running',
-                    'modified': {'$lt': datetime.datetime.utcnow() - datetime.timedelta(seconds=100)},
-                },
-                {
-                    '$set': {
-                        'state': 'failed',
-                    },
-                },
-                )
-            if j is None:
-                break
-            else:
-                retry_job(config.db, j)
+        capabilities = self.request.json
+        if not isinstance(capabilities, dict):
+            self.abort(400, 'capabilities must be an object')
+        data_path = capabilities.get('data_path')
+        if data_path is not None and not (isinstance(data_path, basestring) and os.path.isabs(data_path)):
+            self.abort(400, 'data_path must be an absolute path')
+        register_engine(config.db, _id, capabilities)
 
 
 class Job(base.RequestHandler):
@@ -331,8 +931,63 @@ class Job(base.RequestHandler):
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
 
-        result = config.db.jobs.find_one({'_id': util.ObjectId(_id)})
-        return result
+        return find_job(config.db, util.ObjectId(_id))
+
+    def attempts(self, _id):
+        """Return the attempts of a job, the first attempt first, including the archived attempts."""
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        job = find_job(config.db, util.ObjectId(_id))
+        if job is None:
+            self.abort(404, 'Job not found')
+        return job_attempts(config.db, job)
+
+    def heartbeat(self, _id):
+        """
+        Extend the lease of a running job, optionally with a new lease duration in seconds.
+        Returns 404 if the job is no longer running, e.g. reaped after its lease expired.
+        """
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        now = datetime.datetime.utcnow()
+        update = {'heartbeat': now}
+        lease = self.get_param('lease')
+        if lease is not None:
+            try:
+                lease = int(lease)
+                check_lease(lease)
+            except ValueError:
+                self.abort(400, 'lease must be an integer between 1 and {}'.format(MAX_LEASE))
+            update['lease'] = lease
+        else:
+            job = config.db.jobs.find_one({'_id': util.ObjectId(_id), 'state': 'running'}, ['lease'])
+            if job is None:
+                self.abort(404, 'Job not running')
+            lease = job.get('lease', DEFAULT_LEASE)
+        update['expires'] = lease_expiration(now, lease)
+
+        result = config.db.jobs.update_one({'_id': util.ObjectId(_id), 'state': 'running'}, {'$set': update})
+        if result.matched_count != 1:
+            self.abort(404, 'Job not running')
+
+    def retry(self, _id):
+        """
+        Queue a new attempt of a finished job, ahead of the jobs of normal priority.
+        Used for interactive re-runs.
+        """
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        job = find_job(config.db, util.ObjectId(_id))
+        if job is None:
+            self.abort(404, 'Job not found')
+        if job['state'] in JOB_STATES_ALLOWED_MUTATE:
+            self.abort(400, 'Cannot retry a job that is ' + job['state'] + '.')
+
+        job_ids = retry_jobs(config.db, [job], force=True, priority=PRIORITY_HIGH)
+        return {'_id': job_ids[0]}
 
     def put(self, _id):
         """
@@ -355,8 +1010,11 @@ class Job(base.RequestHandler):
         if 'state' in mutation and not valid_transition(job['state'], mutation['state']):
             self.abort(404, 'Mutating job from ' + job['state'] + ' to ' + mutation['state'] + ' not allowed.')
 
-        # Any modification must be a timestamp update
+        # Any modification must be a timestamp update, and extends the lease of a running job
         mutation['modified'] = datetime.datetime.utcnow()
+        if mutation.get('state', job['state']) == 'running':
+            mutation['heartbeat'] = mutation['modified']
+            mutation['expires'] = lease_expiration(mutation['modified'], job.get('lease', DEFAULT_LEASE))
 
         # Create an object with all the fields that must not have changed concurrently.
         job_query =  {
@@ -367,6 +1025,9 @@ class Job(base.RequestHandler):
         result = config.db.jobs.update_one(job_query, {'$set': mutation})
         if result.modified_count != 1:
             self.abort(500, 'Job modification not saved')
+        if 'state' in mutation:
+            permafailed = 1 if mutation['state'] == 'failed' and job['attempt'] >= MAX_ATTEMPTS else 0
+            count_transition(config.db, job['state'], mutation['state'], permafailed=permafailed)
 
         # If the job did not succeed, check to see if job should be retried.
         if 'state' in mutation and mutation['state'] == 'failed':
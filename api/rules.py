@@ -1,7 +1,10 @@
+import copy
 import fnmatch
+import datetime
 
 from . import jobs
 from . import config
+from .dao import reaperutil
 
 log = config.log
 
@@ -131,35 +134,83 @@ def create_jobs(db, container, container_type, file_):
     Returns the algorithm names that were queued.
     """
 
-    job_list = []
+    return create_jobs_for_files(db, container, container_type, [file_])
 
-    # Get configured rules for this project
-    rules = get_rules_for_container(db, container)
+def create_jobs_for_files(db, container, container_type, files_, reused=None):
+    """
+    Check all rules that apply to a batch of files of the same container, and enqueue the jobs that should be run.
+    Rules are loaded once for the whole batch and the jobs are enqueued with a single insert.
+    Jobs that were already computed for the same gear and input hash are not queued, see jobs.memoize.
+    reused holds the memo keys of the results already reused for the files that led to this batch,
+    they are not reused again.
+    Returns the algorithm names that were queued or reused.
+    """
 
-    # Add hardcoded rules that cannot be removed or changed
-    for hardcoded_rule in HARDCODED_RULES:
-        rules.append(hardcoded_rule)
+    reused = set() if reused is None else reused
+
+    job_specs = []
+
+    # Get configured rules for this project, and the hardcoded rules that cannot be removed or changed
+    # The jobs of the project share the engines fairly with the other projects
+    project = get_project_for_container(db, container)
+    rules = project.get('rules', []) + HARDCODED_RULES
+    queue = str(project['_id'])
+
+    for file_ in files_:
+        for rule in rules:
+            if eval_rule(rule, file_, container):
+                input = jobs.create_fileinput_from_reference(container, container_type, file_)
+                job_specs.append((rule['alg'], input))
+
+    to_queue, reusable = jobs.memoize(db, job_specs)
+    if reusable:
+        # outputs whose blobs were collected are computed again
+        data_path = config.get_item('persistent', 'data_path')
+        stored = [jobs.outputs_stored(memo_job['outputs'], data_path) for _, memo_job in reusable]
+        to_queue += [spec for (spec, _), ok in zip(reusable, stored) if not ok]
+        reusable = [pair for pair, ok in zip(reusable, stored) if ok]
+        # outputs leading back to their own input are reused once
+        for (alg_name, input), memo_job in reusable:
+            if memo_job['memo_key'] in reused:
+                log.warning('not reusing results of job %s again for %s %s' % (memo_job['_id'], input.container_type, input.container_id))
+        reusable = [(spec, memo_job) for spec, memo_job in reusable if memo_job['memo_key'] not in reused]
+    jobs.queue_jobs(db, to_queue, queue=queue)
+    for (alg_name, input), memo_job in reusable:
+        reused.add(memo_job['memo_key'])
+        reuse_outputs(db, container, alg_name, input, memo_job, queue, reused)
+
+    return [alg_name for alg_name, _ in to_queue + [spec for spec, _ in reusable]]
+
+def reuse_outputs(db, acquisition, alg_name, input, memo_job, queue, reused):
+    """
+    Add the output files of a complete job to an acquisition, instead of running the same job on identical input.
+    Only the files are reused, the container metadata of the job describes the hierarchy of its own input.
+    The jobs triggered by the output files are created as if the files were uploaded by an engine.
+    """
 
-    for rule in rules:
-        if eval_rule(rule, file_, container):
-            alg_name = rule['alg']
-            input = jobs.create_fileinput_from_reference(container, container_type, file_)
-            jobs.queue_job(db, alg_name, input)
-            job_list.append(alg_name)
+    outputs = memo_job['outputs']
+    acquisition_obj = db.acquisitions.find_one({'_id': acquisition['_id']})
+    if acquisition_obj is None:
+        log.warning('not reusing results of job %s for deleted acquisition %s' % (memo_job['_id'], acquisition['_id']))
+        return
+    fileinfos = dict((f['name'], copy.deepcopy(f)) for f in outputs['files'])
+    acquisition_obj, _ = reaperutil.commit_engine_files(acquisition_obj, fileinfos, outputs['received'], datetime.datetime.utcnow())
+    jobs.record_reused(db, alg_name, input, memo_job, queue)
 
-    return job_list
+    received = [f for f in acquisition_obj['files'] if f['name'] in outputs['received']]
+    create_jobs_for_files(db, acquisition_obj, 'acquisition', received, reused)
 
 # TODO: consider moving to a module that has a variety of hierarchy-management helper functions
-def get_rules_for_container(db, container):
+def get_project_for_container(db, container):
     """
     Recursively walk the hierarchy until the project object is found.
     """
     if 'session' in container:
         session = db.sessions.find_one({'_id': container['session']})
-        return get_rules_for_container(db, session)
+        return get_project_for_container(db, session)
     elif 'project' in container:
         project = db.projects.find_one({'_id': container['project']})
-        return get_rules_for_container(db, project)
+        return get_project_for_container(db, project)
     else:
         # Assume container is a project, or a collection (which currently cannot have a rules property)
-        return container.get('rules', [])
+        return container
@@ -0,0 +1,135 @@
+"""
+Background verification of the stored blobs against their hash.
+
+The referenced blobs are scrubbed in hash order, a cursor saved after each batch lets an interrupted
+pass resume where it stopped. Blobs are hashed again in a pool of worker processes, which run at the
+lowest CPU and idle I/O priority and share a bandwidth and I/O operations budget, so that the scrubber
+does not slow down downloads. The verification time is saved per blob, mismatching and missing blobs
+are flagged as corrupt and logged.
+"""
+
+import os
+import time
+import errno
+import hashlib
+import datetime
+import subprocess
+import multiprocessing
+
+from . import util
+from . import config
+from . import blobstore
+
+log = config.log
+
+CHUNK_SIZE = 2**20
+BATCH_SIZE = 100
+
+
+class Throttle(object):
+    """Sleep as needed to keep the bytes and operations per second under their budget."""
+
+    def __init__(self, bytes_per_second=None, ops_per_second=None):
+        self.bytes_per_second = bytes_per_second
+        self.ops_per_second = ops_per_second
+        self.start_time = time.time()
+        self.bytes = 0
+        self.ops = 0
+
+    def wait(self, bytes_=0, ops=1):
+        self.bytes += bytes_
+        self.ops += ops
+        delay = 0
+        if self.bytes_per_second:
+            delay = max(delay, float(self.bytes) / self.bytes_per_second)
+        if self.ops_per_second:
+            delay = max(delay, float(self.ops) / self.ops_per_second)
+        delay -= time.time() - self.start_time
+        if delay > 0:
+            time.sleep(delay)
+
+
+def verify_blob(path, hash_, data_path=None, throttle=None):
+    """return the hash of the original bytes of the blob at path, computed as hash_, or None if it is missing"""
+    _, hash_alg, _ = hash_.split('-')
+    try:
+        fd = blobstore.open_blob(path, data_path)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    hash_obj = hashlib.new(hash_alg)
+    with fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), ''):
+            hash_obj.update(chunk)
+            if throttle:
+                throttle.wait(len(chunk))
+    return util.format_hash(hash_alg, hash_obj.hexdigest())
+
+
+_throttle = None
+
+def _init_worker(bytes_per_second, ops_per_second):
+    global _throttle
+    os.nice(19)
+    try:
+        subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
+    except OSError: # ionice is not available, the worker only runs at the lowest CPU priority
+        pass
+    _throttle = Throttle(bytes_per_second, ops_per_second)
+
+def _verify(args):
+    hash_, path, data_path = args
+    try:
+        return hash_, verify_blob(path, hash_, data_path, _throttle), None
+    except (IOError, OSError) as e:
+        return hash_, None, str(e)
+
+
+def scrub(workers=2, bytes_per_second=None, ops_per_second=None, limit=None):
+    """
+    Verify up to limit referenced blobs, continuing the current pass, or starting a new one.
+    The budgets are shared by the workers. Returns the number of verified and corrupt blobs.
+    """
+    data_path = config.get_item('persistent', 'data_path')
+    status = config.db.blobs_status.find_one({'_id': 'scrub'}) or {}
+    cursor = status.get('cursor')
+    if cursor is None:
+        log.info('starting a new scrub pass')
+    verified = corrupt = 0
+    pool = multiprocessing.Pool(workers, _init_worker, (
+        bytes_per_second and bytes_per_second / workers,
+        ops_per_second and ops_per_second / workers,
+    ))
+    try:
+        while limit is None or verified < limit:
+            query = {'refcount': {'$gt': 0}}
+            if cursor is not None:
+                query['_id'] = {'$gt': cursor}
+            batch_size = BATCH_SIZE if limit is None else min(BATCH_SIZE, limit - verified)
+            hashes = [blob['_id'] for blob in config.db.blobs.find(query, ['_id']).sort('_id').limit(batch_size)]
+            if not hashes:
+                cursor = None
+                config.db.blobs_status.update_one({'_id': 'scrub'}, {'$set': {'cursor': None, 'completed': datetime.datetime.utcnow()}}, upsert=True)
+                log.info('scrub pass completed')
+                break
+            tasks = [(hash_, blobstore.resolve_path(data_path, hash_), data_path) for hash_ in hashes]
+            now = datetime.datetime.utcnow()
+            for hash_, actual_hash, error in pool.imap_unordered(_verify, tasks):
+                verified += 1
+                if actual_hash == hash_:
+                    config.db.blobs.update_one({'_id': hash_}, {'$set': {'verified': now}, '$unset': {'corrupt': ''}})
+                    continue
+                corrupt += 1
+                reason = error or ('missing' if actual_hash is None else 'hash mismatch ' + actual_hash)
+                log.error('Corrupt     %s (%s)' % (hash_, reason))
+                config.db.blobs.update_one({'_id': hash_}, {'$set': {'corrupt': {'detected': now, 'reason': reason}}})
+            cursor = hashes[-1]
+            config.db.blobs_status.update_one({'_id': 'scrub'}, {'$set': {'cursor': cursor}}, upsert=True)
+    finally:
+        pool.terminate()
+        pool.join()
+    return verified, corrupt
+
+def corrupt_blobs():
+    return config.db.blobs.find({'corrupt': {'$exists': True}}).sort('corrupt.detected')
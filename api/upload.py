@@ -1,3 +1,4 @@
+import bson
 import copy
 import os.path
 import datetime
@@ -7,9 +8,11 @@ import validators
 from . import base
 from . import util
 from . import files
+from . import blobstore
+from . import jobs
 from . import rules
 from . import config
-from .dao import reaperutil, APIStorageException
+from .dao import reaperutil, blobrefs, APIStorageException
 from . import validators
 from . import tempdir as tempfile
 
@@ -21,7 +24,7 @@ class Upload(base.RequestHandler):
         """Receive a sortable reaper upload."""
         if not self.superuser_request:
             self.abort(402, 'uploads must be from an authorized drone')
-        with tempfile.TemporaryDirectory(prefix='.tmp', dir=config.get_item('persistent', 'data_path')) as tempdir_path:
+        with self.admit_upload(), tempfile.TemporaryDirectory(prefix='.tmp', dir=config.get_item('persistent', 'data_path')) as tempdir_path:
             try:
                 file_store = files.FileStore(self.request, tempdir_path)
             except files.FileStoreException as e:
@@ -38,17 +41,71 @@ class Upload(base.RequestHandler):
             )
             container = reaperutil.create_container_hierarchy(file_store.metadata)
             f = container.find(file_store.filename)
-            target_path = os.path.join(config.get_item('persistent', 'data_path'), util.path_from_hash(fileinfo['hash']))
+            target_path = blobstore.resolve_path(config.get_item('persistent', 'data_path'), fileinfo['hash'])
             if not f:
                 file_store.move_file(target_path)
                 container.add_file(fileinfo)
+                blobrefs.add_refs([fileinfo['hash']])
                 rules.create_jobs(config.db, container.acquisition, 'acquisition', fileinfo)
-            elif not file_store.identical(util.path_from_hash(fileinfo['hash']), f['hash']):
+            elif not file_store.identical(blobstore.resolve_path(config.get_item('persistent', 'data_path'), f['hash']), f['hash']):
                 file_store.move_file(target_path)
                 container.update_file(fileinfo)
+                blobrefs.replace_refs([f['hash']], [fileinfo['hash']])
                 rules.create_jobs(config.db, container.acquisition, 'acquisition', fileinfo)
             throughput = file_store.size / file_store.duration.total_seconds()
-            log.info('Received    %s [%s, %s/s] from %s' % (file_store.filename, util.hrsize(file_store.size), util.hrsize(throughput), self.request.client_addr))
+            log.info('Received    %s [%s, %s/s, %.1fx written] from %s' % (file_store.filename, util.hrsize(file_store.size), util.hrsize(throughput), file_store.write_amplification, self.request.client_addr))
+
+    def reaper_batch(self):
+        """
+        Receive many sortable reaper files of the same acquisition in a single request.
+
+        It expects a multipart/form-data request with a "metadata" field, holding the hierarchy as in a single
+        reaper upload and optional per file infos in acquisition.files, and one or more file fields.
+        The hierarchy is resolved once, and fileinfos and jobs are committed with bulk writes.
+        """
+        if not self.superuser_request:
+            self.abort(402, 'uploads must be from an authorized drone')
+        start_time = datetime.datetime.utcnow()
+        data_path = config.get_item('persistent', 'data_path')
+        with self.admit_upload(), tempfile.TemporaryDirectory(prefix='.tmp', dir=data_path) as tempdir_path:
+            try:
+                file_store = files.MultiFileStore(self.request, tempdir_path)
+            except files.FileStoreException as e:
+                self.abort(400, str(e))
+            if not file_store.metadata:
+                self.abort(400, 'metadata is missing')
+            file_infos = file_store.metadata.get('acquisition', {}).pop('files', None) or []
+            try:
+                container = reaperutil.create_container_hierarchy(file_store.metadata)
+            except APIStorageException as e:
+                self.abort(400, e.message)
+            now = datetime.datetime.utcnow()
+            merged_infos = self._merge_fileinfos(file_store.files, file_infos)
+            added = []
+            updated = []
+            replaced_hashes = []
+            for name in file_store.files:
+                fileinfo = merged_infos[name]
+                del fileinfo['path']
+                fileinfo['name'] = name
+                fileinfo['created'] = fileinfo['modified'] = now
+                f = container.find(name)
+                target_path = blobstore.resolve_path(data_path, fileinfo['hash'])
+                if not f:
+                    file_store.move_file(name, target_path)
+                    added.append(fileinfo)
+                elif not file_store.identical(name, blobstore.resolve_path(data_path, f['hash']), f['hash']):
+                    file_store.move_file(name, target_path)
+                    del fileinfo['created']
+                    updated.append(fileinfo)
+                    replaced_hashes.append(f['hash'])
+            acquisition_obj = container.commit_files(added, updated)
+            blobrefs.replace_refs(replaced_hashes, [fileinfo['hash'] for fileinfo in added + updated])
+            rules.create_jobs_for_files(config.db, acquisition_obj, 'acquisition', added + updated)
+            size = sum(fileinfo['size'] for fileinfo in file_store.files.itervalues())
+            throughput = size / (datetime.datetime.utcnow() - start_time).total_seconds()
+            log.info('Received    %d files [%s, %s/s] from %s (%d new, %d replaced)' % (len(file_store.files), util.hrsize(size), util.hrsize(throughput), self.request.client_addr, len(added), len(updated)))
+            return [{'name': k, 'hash': v['hash'], 'size': v['size']} for k, v in file_store.files.items()]
 
     def engine(self):
         """
@@ -69,7 +126,16 @@ class Upload(base.RequestHandler):
             acquisition_id = util.ObjectId(acquisition_id)
         if not self.superuser_request:
             self.abort(402, 'uploads must be from an authorized drone')
-        with tempfile.TemporaryDirectory(prefix='.tmp', dir=config.get_item('persistent', 'data_path')) as tempdir_path:
+        job_id = self.get_param('job')
+        if job_id:
+            try:
+                job_id = util.ObjectId(job_id)
+            except bson.errors.InvalidId:
+                self.abort(400, 'invalid job id ' + job_id)
+        # check the target before receiving the files
+        if config.db.acquisitions.find_one({'_id': acquisition_id}, []) is None:
+            self.abort(404, 'acquisition {} not found'.format(acquisition_id))
+        with self.admit_upload(), tempfile.TemporaryDirectory(prefix='.tmp', dir=config.get_item('persistent', 'data_path')) as tempdir_path:
             try:
                 file_store = files.MultiFileStore(self.request, tempdir_path)
             except files.FileStoreException as e:
@@ -79,45 +145,40 @@ class Upload(base.RequestHandler):
             metadata_validator = validators.payload_from_schema_file(self, 'enginemetadata.json')
             metadata_validator(file_store.metadata, 'POST')
             file_infos = file_store.metadata['acquisition'].pop('files', [])
+            # the metadata is recorded as it is uploaded, update_container_hierarchy modifies it
+            job_metadata = copy.deepcopy(file_store.metadata)
             now = datetime.datetime.utcnow()
             try:
                 acquisition_obj = reaperutil.update_container_hierarchy(file_store.metadata, acquisition_id, level)
             except APIStorageException as e:
                 self.abort(400, e.message)
             # move the files before updating the database
+            bytes_copied = 0
             for name, fileinfo in file_store.files.items():
-                path = fileinfo['path']
-                target_path = os.path.join(config.get_item('persistent', 'data_path'), util.path_from_hash(fileinfo['hash']))
-                files.move_file(path, target_path)
+                target_path = blobstore.resolve_path(config.get_item('persistent', 'data_path'), fileinfo['hash'])
+                bytes_copied += file_store.move_file(name, target_path)
+            if bytes_copied:
+                log.warning('Copied      %s to store engine outputs for acquisition %s' % (util.hrsize(bytes_copied), acquisition_id))
+            for name, fileinfo in file_store.files.items():
+                duration = file_store.durations[name].total_seconds()
+                throughput = fileinfo['size'] / duration if duration else 0
+                log.info('Received    %s [%s, %s/s] from %s' % (name, util.hrsize(fileinfo['size']), util.hrsize(throughput), self.request.client_addr))
             # merge infos from the actual file and from the metadata
             merged_infos = self._merge_fileinfos(file_store.files, file_infos)
-            # update the fileinfo in mongo if a file already exists
-            for f in acquisition_obj['files']:
-                fileinfo = merged_infos.get(f['name'])
-                if fileinfo:
-                    fileinfo.pop('path', None)
-                    fileinfo['modified'] = now
-                    acquisition_obj = reaperutil.update_fileinfo('acquisitions', acquisition_obj['_id'], fileinfo)
-                    fileinfo['existing'] = True
-            # create the missing fileinfo in mongo
-            for name, fileinfo in merged_infos.items():
-                # if the file exists we don't need to create it
-                # skip update fileinfo for files that doesn't have a path
-                if not fileinfo.get('existing') and fileinfo.get('path'):
-                    del fileinfo['path']
-                    fileinfo['created'] = now
-                    fileinfo['modified'] = now
-                    acquisition_obj = reaperutil.add_fileinfo('acquisitions', acquisition_obj['_id'], fileinfo)
+            acquisition_obj, committed = reaperutil.commit_engine_files(acquisition_obj, merged_infos, file_store.files, now)
+            if job_id:
+                jobs.record_outputs(config.db, job_id, job_metadata, committed, file_store.files.keys())
 
+            files_ = []
             for f in acquisition_obj['files']:
                 if f['name'] in file_store.files:
-                    file_ = {
+                    files_.append({
                         'name': f['name'],
                         'hash': f['hash'],
                         'type': f.get('type'),
                         'measurements': f.get('measurements', [])
-                    }
-                    rules.create_jobs(config.db, acquisition_obj, 'acquisition', file_)
+                    })
+            rules.create_jobs_for_files(config.db, acquisition_obj, 'acquisition', files_)
             return [{'name': k, 'hash': v['hash'], 'size': v['size']} for k, v in merged_infos.items()]
 
     def _merge_fileinfos(self, hard_infos, infos):
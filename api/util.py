@@ -1,8 +1,11 @@
 import os
 import pytz
+import time
 import uuid
 import datetime
+import threading
 import mimetypes
+import collections
 import bson.objectid
 import tempdir as tempfile
 import enum as baseEnum
@@ -79,18 +82,17 @@ def guess_mimetype(filepath):
     return mime or 'application/octet-stream'
 
 
-def path_from_hash(hash_):
+def path_from_hash(hash_, depth=2):
     """
-    create a filepath from a hash
+    create a filepath from a hash, with depth levels of 2 characters
     e.g.
     hash_ = v0-sha384-01b395a1cbc0f218
     will return
     v0/sha384/01/b3/v0-sha384-01b395a1cbc0f218
     """
     hash_version, hash_alg, actual_hash = hash_.split('-')
-    first_stanza = actual_hash[0:2]
-    second_stanza = actual_hash[2:4]
-    path = (hash_version, hash_alg, first_stanza, second_stanza, hash_)
+    stanzas = tuple(actual_hash[i:i + 2] for i in range(0, 2 * depth, 2))
+    path = (hash_version, hash_alg) + stanzas + (hash_,)
     return os.path.join(*path)
 
 
@@ -108,6 +110,55 @@ def custom_json_serializer(obj):
         return pytz.timezone('UTC').localize(obj).isoformat()
     raise TypeError(repr(obj) + " is not JSON serializable")
 
+class LRUCache(object):
+    """
+    A thread safe mapping holding at most maxsize items, discarding the least recently used ones.
+    If ttl is set, items expire ttl seconds after they were set.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires, value)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, (None, default))[1]
+
+    def discard(self, predicate):
+        """remove the items for which predicate(key, value) is true"""
+        with self._lock:
+            for key in [k for k, (_, v) in self._items.iteritems() if predicate(k, v)]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
 class Enum(baseEnum.Enum):
     # Enum strings are prefixed by their class: "Category.classifier".
     # This overrides that behaviour and removes the prefix.
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""This script maintains the content addressed blob store"""
+
+import os
+import time
+import argparse
+import datetime
+
+from api.dao import blobrefs
+from api import util
+from api import files
+from api import config
+from api import blobstore
+from api import scrub
+
+log = config.log
+
+# blobs moved between saves of the migration cursor
+MIGRATE_CURSOR_INTERVAL = 100
+
+
+def reindex(args):
+    log.info('rebuilding blob reference counts...')
+    referenced, unreferenced = blobrefs.reindex(scan_store=not args.no_scan)
+    log.info('%d referenced blobs, %d unreferenced blobs' % (referenced, unreferenced))
+
+reindex_desc = """
+Rebuild the blob reference counts from all containers and snapshots.
+The blob store is walked once to find the blobs that are not referenced.
+It must run once before the first collect.
+
+example:
+./bin/blobstore.py reindex
+"""
+
+
+def collect(args):
+    grace = datetime.timedelta(hours=args.grace)
+    try:
+        removed, removed_bytes = blobrefs.collect(grace=grace, limit=args.limit, rate=args.rate, dry_run=args.dry_run)
+    except blobrefs.BlobRefsException as e:
+        log.error(str(e))
+        raise SystemExit(1)
+    log.info('%s %d blobs [%s]' % ('would remove' if args.dry_run else 'removed', removed, util.hrsize(removed_bytes)))
+
+collect_desc = """
+Remove blobs that have not been referenced for longer than the grace period.
+Each run handles at most --limit blobs, it can be scheduled periodically.
+
+example:
+./bin/blobstore.py collect --grace 24 --limit 1000 --rate 10
+"""
+
+
+def _project_fileinfos(project):
+    """return the fileinfos of a project, its sessions and acquisitions"""
+    sessions = list(config.db.sessions.find({'project': project['_id']}, ['files']))
+    acquisitions = config.db.acquisitions.find({'session': {'$in': [s['_id'] for s in sessions]}}, ['files'])
+    return [f for c in [project] + sessions + list(acquisitions) for f in c.get('files', []) if f.get('hash')]
+
+def _projects(args):
+    query = {'_id': util.ObjectId(args.project)} if args.project else {}
+    return config.db.projects.find(query, ['label', 'group', 'files'])
+
+
+def chunk(args):
+    data_path = config.get_item('persistent', 'data_path')
+    min_size = args.min_size * 2**20
+    total_size = total_written = 0
+    for project in _projects(args):
+        for fileinfo in _project_fileinfos(project):
+            if fileinfo['size'] < min_size:
+                continue
+            path = blobstore.resolve_path(data_path, fileinfo['hash'])
+            # compressed and already chunked blobs are left as they are
+            if blobstore.stored_path(path) != path:
+                continue
+            # zip members are read through the zip index, which can not be built from the chunks later
+            files.get_zip_index(fileinfo['hash'], path)
+            size, bytes_written = blobstore.chunk_blob(path, data_path)
+            total_size += size
+            total_written += bytes_written
+            log.info('Chunked     %s [%s, %s new]' % (fileinfo['hash'], util.hrsize(size), util.hrsize(bytes_written)))
+    log.info('chunked %s, %s of new chunks' % (util.hrsize(total_size), util.hrsize(total_written)))
+
+chunk_desc = """
+Store the large blobs of all or one project as content defined chunks.
+Chunks shared with other blobs, e.g. earlier versions of the same file, are stored once.
+Chunked blobs are not available through symlink downloads and local file paths.
+
+example:
+./bin/blobstore.py chunk --project 57a0cd3d7c3b2e0011b7e5f4 --min-size 16
+"""
+
+
+def report(args):
+    data_path = config.get_item('persistent', 'data_path')
+    all_stored = {}
+    print '%-40s %12s %12s %8s' % ('project', 'size', 'stored', 'dedup')
+    for project in _projects(args):
+        size = 0
+        # stored blobs and chunks of the project, with their size
+        stored = {}
+        for fileinfo in _project_fileinfos(project):
+            size += fileinfo['size']
+            if fileinfo['hash'] in stored:
+                continue
+            path = blobstore.stored_path(blobstore.resolve_path(data_path, fileinfo['hash']))
+            if path is None:
+                continue
+            if blobstore.is_chunked(path):
+                stored.update(blobstore.read_manifest(path)['chunks'])
+            else:
+                stored[fileinfo['hash']] = os.path.getsize(path)
+        stored_size = sum(stored.itervalues())
+        all_stored.update(stored)
+        ratio = float(size) / stored_size if stored_size else 1.0
+        print '%-40s %12s %12s %7.2fx' % ((project['group'] + '/' + project.get('label', ''))[:40], util.hrsize(size), util.hrsize(stored_size), ratio)
+    print '%-40s %12s %12s' % ('total', '', util.hrsize(sum(all_stored.itervalues())))
+
+report_desc = """
+Report the size of the files of each project, the size of their stored blobs and chunks
+and the deduplication ratio. Blobs and chunks shared between projects are counted in each project.
+
+example:
+./bin/blobstore.py report
+"""
+
+
+def migrate(args):
+    data_path = config.get_item('persistent', 'data_path')
+    # resume an interrupted migration after the last blob it saved
+    status = config.db.blobs_status.find_one({'_id': 'migrate'}) or {}
+    cursor = status.get('cursor')
+    if cursor:
+        log.info('resuming the migration after %s' % cursor)
+    moved = 0
+    for path in blobstore.iter_stored_blobs(data_path, after=cursor):
+        if args.limit and moved >= args.limit:
+            break
+        start_time = time.time()
+        hash_ = blobstore.blob_filename(os.path.basename(path))
+        cursor = os.path.relpath(path, data_path)
+        if not blobstore.relink_blob(data_path, path, blobstore.shard_depth(hash_)):
+            continue
+        moved += 1
+        log.debug('Moved       %s' % hash_)
+        if moved % MIGRATE_CURSOR_INTERVAL == 0:
+            config.db.blobs_status.update_one({'_id': 'migrate'}, {'$set': {'cursor': cursor}}, upsert=True)
+        if args.rate:
+            time.sleep(max(0, 1.0 / args.rate - (time.time() - start_time)))
+    else:
+        # a pass over the whole store, in one or several runs, moved all the blobs to their configured depth
+        configured = blobstore.shard_depths()
+        blobstore.migrated(dict(
+            (hash_version, configured.get(hash_version, blobstore.DEFAULT_SHARD_DEPTH))
+            for hash_version in os.listdir(data_path)
+            if not hash_version.startswith('.') and hash_version != blobstore.CHUNKS_DIR
+        ))
+        cursor = None
+        log.info('migration pass completed')
+    config.db.blobs_status.update_one({'_id': 'migrate'}, {'$set': {'cursor': cursor}}, upsert=True)
+    log.info('moved %d blobs to the configured shard depth' % moved)
+
+migrate_desc = """
+Move the blobs to their path with the shard depth configured for their hash version.
+Blobs are hard linked to their new path before they are removed from the old one, they stay
+available to the API during the migration, which finds blobs at the depths used before too.
+The position of the migration is saved, an interrupted migration resumes where it stopped.
+Once a pass over the whole store completes, the previous depths are no longer looked up.
+The migration must not run together with collect.
+
+example:
+./bin/blobstore.py migrate --rate 1000
+"""
+
+
+def scrub_(args):
+    if args.report:
+        for blob in scrub.corrupt_blobs():
+            print '%s %s %s' % (blob['corrupt']['detected'].isoformat(), blob['_id'], blob['corrupt']['reason'])
+        return
+    while True:
+        verified, corrupt = scrub.scrub(
+            workers=args.workers,
+            bytes_per_second=args.bandwidth * 2**20 if args.bandwidth else None,
+            ops_per_second=args.iops,
+            limit=args.limit,
+        )
+        log.info('verified %d blobs, %d corrupt' % (verified, corrupt))
+        if not args.continuous:
+            break
+        if not verified:
+            time.sleep(60)
+
+scrub_desc = """
+Verify the referenced blobs against their hash, in hash order. A pass can be interrupted,
+the next run resumes it. The workers run at idle I/O priority within a shared budget.
+Corrupt and missing blobs are logged and flagged, --report lists them.
+The reference counts must have been built by reindex.
+
+example:
+./bin/blobstore.py scrub --workers 2 --bandwidth 50 --iops 100 --continuous
+"""
+
+
+def cache_stats(args):
+    print '%-30s %8s %8s %12s %12s %12s %12s' % ('host', 'hits', 'misses', 'hit bytes', 'filled', 'uploaded', 'evicted')
+    for stats in config.db.blob_cache_stats.find().sort('_id'):
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        print '%-30s %8d %8d %12s %12s %12s %12s  %.1f%% hit rate' % (
+            stats['_id'][:30], stats.get('hits', 0), stats.get('misses', 0), util.hrsize(stats.get('hit_bytes', 0)),
+            util.hrsize(stats.get('fill_bytes', 0)), util.hrsize(stats.get('upload_bytes', 0)), util.hrsize(stats.get('evicted_bytes', 0)),
+            100.0 * stats.get('hits', 0) / lookups if lookups else 0)
+
+cache_stats_desc = """
+Report the hits and misses of the local blob caches, per host.
+
+example:
+./bin/blobstore.py cache-stats
+"""
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(help='operation to perform')
+
+reindex_parser = subparsers.add_parser(
+        name='reindex',
+        help='rebuild blob reference counts',
+        description=reindex_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+reindex_parser.add_argument('--no-scan', action='store_true', help='do not walk the blob store for unreferenced blobs')
+reindex_parser.set_defaults(func=reindex)
+
+collect_parser = subparsers.add_parser(
+        name='collect',
+        help='remove unreferenced blobs',
+        description=collect_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+collect_parser.add_argument('--grace', type=float, default=24, help='hours a blob must be unreferenced before removal')
+collect_parser.add_argument('--limit', type=int, default=1000, help='maximum number of blobs removed in this run')
+collect_parser.add_argument('--rate', type=float, default=None, help='maximum number of blobs removed per second')
+collect_parser.add_argument('-n', '--dry-run', action='store_true', help='only report the blobs that would be removed')
+collect_parser.set_defaults(func=collect)
+
+chunk_parser = subparsers.add_parser(
+        name='chunk',
+        help='store large blobs as content defined chunks',
+        description=chunk_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+chunk_parser.add_argument('--project', help='only chunk the blobs of this project')
+chunk_parser.add_argument('--min-size', type=int, default=16, help='minimum size in MiB of the chunked blobs')
+chunk_parser.set_defaults(func=chunk)
+
+report_parser = subparsers.add_parser(
+        name='report',
+        help='report deduplication ratio per project',
+        description=report_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+report_parser.add_argument('--project', help='only report this project')
+report_parser.set_defaults(func=report)
+
+migrate_parser = subparsers.add_parser(
+        name='migrate',
+        help='move blobs to the configured shard depth',
+        description=migrate_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+migrate_parser.add_argument('--limit', type=int, default=None, help='maximum number of blobs moved in this run')
+migrate_parser.add_argument('--rate', type=float, default=None, help='maximum number of blobs moved per second')
+migrate_parser.set_defaults(func=migrate)
+
+scrub_parser = subparsers.add_parser(
+        name='scrub',
+        help='verify blobs against their hash',
+        description=scrub_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+scrub_parser.add_argument('--workers', type=int, default=2, help='number of worker processes')
+scrub_parser.add_argument('--bandwidth', type=float, default=None, help='maximum read bandwidth in MiB/s')
+scrub_parser.add_argument('--iops', type=float, default=None, help='maximum read operations per second')
+scrub_parser.add_argument('--limit', type=int, default=None, help='maximum number of blobs verified in this run')
+scrub_parser.add_argument('--continuous', action='store_true', help='start a new pass when a pass completes')
+scrub_parser.add_argument('--report', action='store_true', help='only list the corrupt blobs')
+scrub_parser.set_defaults(func=scrub_)
+
+cache_stats_parser = subparsers.add_parser(
+        name='cache-stats',
+        help='report blob cache hit rates',
+        description=cache_stats_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+cache_stats_parser.set_defaults(func=cache_stats)
+
+args = parser.parse_args()
+args.func(args)
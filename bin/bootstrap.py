@@ -13,9 +13,11 @@ import requests
 
 
 from api.dao import reaperutil
+from api.dao import blobrefs
 from api import util
 from api import rules
 from api import config
+from api import blobstore
 
 log = config.log
 
@@ -57,6 +59,7 @@ def users(args):
         for r in g['roles']:
             r.setdefault('site', site_id)
         config.db.groups.update_one({'_id': g['_id']}, {'$setOnInsert': g}, upsert=True)
+    reaperutil.groups_changed(config.db)
     log.info('bootstrapping drones...')
     for d in input_data.get('drones', []):
         log.info('    ' + d['_id'])
@@ -95,7 +98,7 @@ def data(args):
             for chunk in iter(lambda: fd.read(2**20), ''):
                 hash_.update(chunk)
         computed_hash = 'v0-sha384-' + hash_.hexdigest()
-        destpath = os.path.join(config.get_item('persistent', 'data_path'), util.path_from_hash(computed_hash))
+        destpath = blobstore.resolve_path(config.get_item('persistent', 'data_path'), computed_hash)
         dir_destpath = os.path.dirname(destpath)
         filename = os.path.basename(filepath)
         if not os.path.exists(dir_destpath):
@@ -114,6 +117,7 @@ def data(args):
             'modified': modified
         }
         container.add_file(fileinfo)
+        blobrefs.add_refs([computed_hash])
         rules.create_jobs(config.db, container.acquisition, 'acquisition', fileinfo)
 
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Compare reaper group routing with reaperutil.GroupMatcher against the plain difflib lookup.
+
+example:
+PYTHONPATH=. test/benchmarks/bench_group_matching.py --groups 10000 --uploads 1000
+"""
+
+import time
+import random
+import string
+import difflib
+import argparse
+
+from api.dao import reaperutil
+
+
+def random_group_id(rnd):
+    chars = string.ascii_lowercase + string.digits
+    return ''.join(rnd.choice(chars) for _ in range(rnd.randint(2, 32)))
+
+def misspell(rnd, group_id):
+    i = rnd.randrange(len(group_id))
+    return group_id[:i] + rnd.choice(string.ascii_lowercase) + group_id[i+1:]
+
+def difflib_match(group_name, group_ids):
+    matches = difflib.get_close_matches(group_name, group_ids, cutoff=0.8)
+    return matches[0] if len(matches) == 1 else None
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--groups', type=int, default=10000, help='number of existing groups')
+parser.add_argument('--uploads', type=int, default=1000, help='number of uploads to route')
+parser.add_argument('--names', type=int, default=50, help='number of distinct group names sent by the drones')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+rnd = random.Random(args.seed)
+group_ids = list(set(random_group_id(rnd) for _ in range(args.groups)))
+names = []
+for _ in range(args.names):
+    group_id = rnd.choice(group_ids)
+    names.append(rnd.choice([group_id, misspell(rnd, group_id), random_group_id(rnd)]))
+uploads = [rnd.choice(names) for _ in range(args.uploads)]
+
+start = time.time()
+expected = [difflib_match(name, group_ids) for name in uploads]
+difflib_time = time.time() - start
+
+start = time.time()
+group_matcher = reaperutil.GroupMatcher(group_ids)
+build_time = time.time() - start
+start = time.time()
+for name in set(names):
+    group_matcher.match(name)
+first_time = time.time() - start
+start = time.time()
+results = [group_matcher.match(name) for name in uploads]
+matcher_time = time.time() - start
+
+assert results == expected, 'routing decisions differ'
+print('%d groups, %d uploads, %d distinct names' % (len(group_ids), len(uploads), len(set(names))))
+print('difflib:                   %8.1f us/upload' % (difflib_time / len(uploads) * 1e6))
+print('GroupMatcher, first match: %8.1f us/name (index built in %.1f ms)' % (first_time / len(set(names)) * 1e6, build_time * 1e3))
+print('GroupMatcher:              %8.1f us/upload' % (matcher_time / len(uploads) * 1e6))
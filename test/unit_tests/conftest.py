@@ -0,0 +1,499 @@
+"""
+An in-memory database with the subset of the pymongo collection API used by the api, for the tests of code
+that reads and writes several collections. Documents are deep copied in and out, as with a real server.
+"""
+
+import re
+import copy
+
+import bson
+import pymongo
+import pytest
+
+from api import config
+
+
+_MISSING = object()
+
+def _values(doc, path):
+    """the values at a dotted path, array elements are expanded as in mongo queries"""
+    values = [doc]
+    for part in path.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    next_values.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    next_values.append(value[int(part)])
+                next_values.extend(v[part] for v in value if isinstance(v, dict) and part in v)
+        values = next_values
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+def _is_operator_dict(cond):
+    return isinstance(cond, dict) and cond and all(key.startswith('$') for key in cond)
+
+def _match_operator(values, op, arg):
+    if op == '$exists':
+        return bool(values) == bool(arg)
+    if op == '$ne':
+        return not any(v == arg for v in values) and not (arg is None and not values)
+    if op == '$nin':
+        return not any(v in arg for v in values) and not (None in arg and not values)
+    if op == '$in':
+        return any(v in arg for v in values) or (None in arg and not values)
+    if op == '$all':
+        return all(any(v == a for v in values) for a in arg)
+    if op == '$regex':
+        return any(isinstance(v, basestring) and re.search(arg, v) for v in values)
+    if op == '$elemMatch':
+        return any(isinstance(v, dict) and match(v, arg) for v in values)
+    comparisons = {'$lt': lambda a, b: a < b, '$lte': lambda a, b: a <= b, '$gt': lambda a, b: a > b, '$gte': lambda a, b: a >= b}
+    if op in comparisons:
+        return any(v is not None and not isinstance(v, list) and comparisons[op](v, arg) for v in values)
+    raise NotImplementedError(op)
+
+def match(doc, query):
+    """whether doc matches a query"""
+    for key, cond in (query or {}).iteritems():
+        if key == '$or':
+            if not any(match(doc, q) for q in cond):
+                return False
+        elif key == '$and':
+            if not all(match(doc, q) for q in cond):
+                return False
+        elif key == '$nor':
+            if any(match(doc, q) for q in cond):
+                return False
+        else:
+            values = _values(doc, key)
+            if _is_operator_dict(cond):
+                if not all(_match_operator(values, op, arg) for op, arg in cond.iteritems()):
+                    return False
+            elif not (any(v == cond for v in values) or (cond is None and not values)):
+                return False
+    return True
+
+def _positional_index(doc, prefix, query):
+    """the index of the first element of the array at prefix matched by query, for the $ operator"""
+    array = _values(doc, prefix)[0]
+    element_query = dict(
+        (key[len(prefix) + 1:], cond) for key, cond in query.iteritems()
+        if key.startswith(prefix + '.')
+    )
+    for i, element in enumerate(array):
+        if isinstance(element, dict) and match(element, element_query):
+            return i
+    raise ValueError('no array element matched for ' + prefix)
+
+def _parent(doc, path, query, create=True):
+    parts = path.split('.')
+    for i, part in enumerate(parts):
+        if part == '$':
+            parts[i] = str(_positional_index(doc, '.'.join(parts[:i]), query))
+    parent = doc
+    for part in parts[:-1]:
+        if isinstance(parent, list):
+            parent = parent[int(part)]
+        else:
+            if part not in parent:
+                if not create:
+                    return None, None
+                parent[part] = {}
+            parent = parent[part]
+    return parent, parts[-1]
+
+def _get(parent, key):
+    if isinstance(parent, list):
+        return parent[int(key)]
+    return parent.get(key, _MISSING)
+
+def _put(parent, key, value):
+    if isinstance(parent, list):
+        parent[int(key)] = value
+    else:
+        parent[key] = value
+
+def apply_update(doc, update, query, inserting=False):
+    """apply the update operators of update to doc in place"""
+    if not any(key.startswith('$') for key in update):
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if _id is not None:
+            doc.setdefault('_id', _id)
+        return
+    for op, fields in update.iteritems():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, arg in fields.iteritems():
+            arg = copy.deepcopy(arg)
+            if op == '$unset':
+                parent, key = _parent(doc, path, query, create=False)
+                if isinstance(parent, dict):
+                    parent.pop(key, None)
+                continue
+            parent, key = _parent(doc, path, query)
+            current = _get(parent, key)
+            if op in ('$set', '$setOnInsert'):
+                _put(parent, key, arg)
+            elif op == '$inc':
+                _put(parent, key, (0 if current is _MISSING else current) + arg)
+            elif op == '$min':
+                _put(parent, key, arg if current is _MISSING else min(current, arg))
+            elif op == '$max':
+                _put(parent, key, arg if current is _MISSING else max(current, arg))
+            elif op in ('$push', '$addToSet'):
+                items = arg['$each'] if isinstance(arg, dict) and '$each' in arg else [arg]
+                array = [] if current is _MISSING else current
+                for item in items:
+                    if op == '$push' or item not in array:
+                        array.append(item)
+                _put(parent, key, array)
+            elif op == '$pull':
+                if current is not _MISSING:
+                    if isinstance(arg, dict) and not _is_operator_dict(arg):
+                        _put(parent, key, [v for v in current if not (isinstance(v, dict) and match(v, arg))])
+                    elif _is_operator_dict(arg):
+                        _put(parent, key, [v for v in current if not all(_match_operator([v], o, a) for o, a in arg.iteritems())])
+                    else:
+                        _put(parent, key, [v for v in current if v != arg])
+            else:
+                raise NotImplementedError(op)
+
+def project(doc, projection):
+    if projection is None:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = dict((field, 1) for field in projection)
+    include_id = projection.get('_id', 1)
+    includes = [field.split('.')[0] for field, value in projection.iteritems() if value and field != '_id']
+    if includes or not any(not value for field, value in projection.iteritems() if field != '_id'):
+        result = dict((field, copy.deepcopy(doc[field])) for field in includes if field in doc)
+    else:
+        result = dict((field, copy.deepcopy(value)) for field, value in doc.iteritems() if projection.get(field, 1))
+    if include_id and '_id' in doc:
+        result['_id'] = doc['_id']
+    return result
+
+def _sort_key(spec):
+    def key(doc):
+        return [(lambda vs: vs[0] if vs else None)(_values(doc, field)) for field, _ in spec]
+    return key
+
+def _sort(docs, spec):
+    for field, direction in reversed(spec):
+        docs.sort(key=_sort_key([(field, direction)]), reverse=direction < 0)
+    return docs
+
+
+class Result(object):
+
+    def __init__(self, **kwargs):
+        self.matched_count = self.modified_count = self.deleted_count = 0
+        self.upserted_id = self.inserted_id = None
+        self.inserted_ids = []
+        self.acknowledged = True
+        self.__dict__.update(kwargs)
+
+
+class Cursor(object):
+
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=pymongo.ASCENDING):
+        self._sort = [(key_or_list, direction)] if isinstance(key_or_list, basestring) else list(key_or_list)
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def _docs(self):
+        docs = [doc for doc in self.collection.docs if match(doc, self.query)]
+        if self._sort:
+            docs = _sort(list(docs), self._sort)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return docs
+
+    def __iter__(self):
+        return iter([project(doc, self.projection) for doc in self._docs()])
+
+    def count(self, with_limit_and_skip=False):
+        return len(self._docs()) if with_limit_and_skip else sum(1 for doc in self.collection.docs if match(doc, self.query))
+
+    def close(self):
+        pass
+
+
+class Collection(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = []
+        self.indexes = {'_id_': {'key': [('_id', 1)]}}
+
+    def _find(self, query):
+        for doc in self.docs:
+            if match(doc, query):
+                yield doc
+
+    def _check_unique(self, doc):
+        if any(other['_id'] == doc['_id'] for other in self.docs if other is not doc):
+            raise pymongo.errors.DuplicateKeyError('E11000 duplicate key error index: _id_ dup key: ' + repr(doc['_id']), 11000)
+
+    def find(self, filter=None, projection=None, **kwargs):
+        cursor = Cursor(self, filter, projection)
+        if kwargs.get('sort'):
+            cursor.sort(kwargs['sort'])
+        return cursor
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for doc in self.find(filter, projection, **kwargs).limit(1):
+            return doc
+        return None
+
+    def count(self, filter=None):
+        return sum(1 for _ in self._find(filter))
+
+    def distinct(self, key, filter=None):
+        values = []
+        for doc in self._find(filter):
+            for value in _values(doc, key):
+                if not isinstance(value, list) and value not in values:
+                    values.append(value)
+        return values
+
+    def insert_one(self, document):
+        document.setdefault('_id', bson.ObjectId())
+        doc = copy.deepcopy(document)
+        self._check_unique(doc)
+        self.docs.append(doc)
+        return Result(inserted_id=doc['_id'])
+
+    def insert_many(self, documents, ordered=True):
+        inserted_ids = []
+        errors = []
+        for i, document in enumerate(documents):
+            try:
+                inserted_ids.append(self.insert_one(document).inserted_id)
+            except pymongo.errors.DuplicateKeyError as e:
+                errors.append({'index': i, 'code': 11000, 'errmsg': str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise pymongo.errors.BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted_ids)})
+        return Result(inserted_ids=inserted_ids)
+
+    def _upsert(self, filter, update):
+        doc = dict(
+            (key, copy.deepcopy(cond)) for key, cond in filter.iteritems()
+            if not key.startswith('$') and '.' not in key and not _is_operator_dict(cond)
+        )
+        apply_update(doc, update, filter, inserting=True)
+        doc.setdefault('_id', bson.ObjectId())
+        self._check_unique(doc)
+        self.docs.append(doc)
+        return doc
+
+    def _update(self, filter, update, upsert, multi):
+        matched = list(self._find(filter))
+        if not multi:
+            matched = matched[:1]
+        modified = 0
+        for doc in matched:
+            before = copy.deepcopy(doc)
+            apply_update(doc, update, filter)
+            modified += doc != before
+        if not matched and upsert:
+            return Result(upserted_id=self._upsert(filter, update)['_id'])
+        return Result(matched_count=len(matched), modified_count=modified)
+
+    def update_one(self, filter, update, upsert=False):
+        return self._update(filter, update, upsert, multi=False)
+
+    def update_many(self, filter, update, upsert=False):
+        return self._update(filter, update, upsert, multi=True)
+
+    def replace_one(self, filter, replacement, upsert=False):
+        return self._update(filter, replacement, upsert, multi=False)
+
+    def delete_one(self, filter):
+        for doc in self._find(filter):
+            self.docs.remove(doc)
+            return Result(deleted_count=1)
+        return Result(deleted_count=0)
+
+    def delete_many(self, filter):
+        deleted = list(self._find(filter))
+        self.docs = [doc for doc in self.docs if not any(doc is d for d in deleted)]
+        return Result(deleted_count=len(deleted))
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=pymongo.collection.ReturnDocument.BEFORE):
+        matched = list(self._find(filter))
+        if sort:
+            matched = _sort(matched, sort)
+        if matched:
+            doc = matched[0]
+            before = copy.deepcopy(doc)
+            apply_update(doc, update, filter)
+        elif upsert:
+            doc = self._upsert(filter, update)
+            before = None
+        else:
+            return None
+        result = doc if return_document == pymongo.collection.ReturnDocument.AFTER else before
+        return project(result, projection) if result is not None else None
+
+    def find_one_and_delete(self, filter, projection=None, sort=None):
+        matched = list(self._find(filter))
+        if sort:
+            matched = _sort(matched, sort)
+        if not matched:
+            return None
+        self.docs.remove(matched[0])
+        return project(matched[0], projection)
+
+    # the operations of bulk_write, see pymongo.operations
+    def add_insert(self, document):
+        self._bulk_results.append(('inserted', self.insert_one(document)))
+
+    def add_update(self, selector, update, multi, upsert):
+        self._bulk_results.append(('updated', self._update(selector, update, upsert, multi)))
+
+    def add_replace(self, selector, replacement, upsert):
+        self._bulk_results.append(('updated', self._update(selector, replacement, upsert, multi=False)))
+
+    def add_delete(self, selector, limit):
+        self._bulk_results.append(('deleted', self.delete_one(selector) if limit else self.delete_many(selector)))
+
+    def bulk_write(self, requests, ordered=True):
+        self._bulk_results = []
+        for request in requests:
+            request._add_to_bulk(self)
+        results = self._bulk_results
+        del self._bulk_results
+        self.bulk_writes = getattr(self, 'bulk_writes', 0) + 1
+        return Result(
+            inserted_count=sum(1 for kind, _ in results if kind == 'inserted'),
+            matched_count=sum(r.matched_count for kind, r in results if kind == 'updated'),
+            modified_count=sum(r.modified_count for kind, r in results if kind == 'updated'),
+            upserted_count=sum(1 for kind, r in results if kind == 'updated' and r.upserted_id is not None),
+            deleted_count=sum(r.deleted_count for kind, r in results if kind == 'deleted'),
+        )
+
+    def aggregate(self, pipeline):
+        docs = [copy.deepcopy(doc) for doc in self.docs]
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if op == '$match':
+                docs = [doc for doc in docs if match(doc, arg)]
+            elif op == '$unwind':
+                field = arg.lstrip('$')
+                docs = [dict(doc, **{field: value}) for doc in docs for value in doc.get(field, [])]
+            elif op == '$group':
+                groups = {}
+                def evaluate(doc, expr):
+                    if isinstance(expr, basestring) and expr.startswith('$'):
+                        values = _values(doc, expr[1:])
+                        return values[0] if values else None
+                    return expr
+                for doc in docs:
+                    _id = evaluate(doc, arg['_id'])
+                    key = repr(_id)
+                    group = groups.setdefault(key, {'_id': _id})
+                    for field, accumulator in arg.iteritems():
+                        if field == '_id':
+                            continue
+                        (acc_op, expr), = accumulator.items()
+                        value = evaluate(doc, expr)
+                        if acc_op == '$sum':
+                            group[field] = group.get(field, 0) + (value or 0)
+                        elif acc_op == '$max':
+                            group[field] = max(group.get(field), value)
+                        else:
+                            raise NotImplementedError(acc_op)
+                docs = groups.values()
+            elif op == '$sort':
+                docs = _sort(docs, list(arg.items()))
+            elif op == '$limit':
+                docs = docs[:arg]
+            else:
+                raise NotImplementedError(op)
+        return iter(docs)
+
+    def create_index(self, keys, **kwargs):
+        keys = [(keys, 1)] if isinstance(keys, basestring) else list(keys)
+        name = '_'.join('%s_%s' % key for key in keys)
+        self.indexes[name] = dict(kwargs, key=keys)
+        return name
+
+    def index_information(self):
+        return copy.deepcopy(self.indexes)
+
+    def drop_index(self, name):
+        del self.indexes[name]
+
+
+class Database(object):
+    """collections are created on first access, as with pymongo"""
+
+    def __init__(self):
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = Collection(name)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def collection_names(self):
+        return self._collections.keys()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """an empty in-memory database, installed as config.db"""
+    database = Database()
+    monkeypatch.setattr(config, 'db', database)
+    return database
+
+@pytest.fixture
+def settings(monkeypatch):
+    """the configuration read by config.get_item, the defaults to be edited by the tests"""
+    items = copy.deepcopy(config.DEFAULT_CONFIG)
+    monkeypatch.setattr(config, 'get_item', lambda outer, inner: items[outer][inner])
+    return items
+
+@pytest.fixture
+def tmpdir_path(tmpdir):
+    """the path of a temporary directory, as a string"""
+    return str(tmpdir)
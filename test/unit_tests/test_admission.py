@@ -0,0 +1,41 @@
+import os
+
+import pytest
+from api import admission
+
+def test_upload_slots(tmpdir_path):
+    slot1 = admission.acquire_slot(100, tmpdir_path, 2, slots_path=tmpdir_path)
+    slot2 = admission.acquire_slot(100, tmpdir_path, 2, slots_path=tmpdir_path)
+    with pytest.raises(admission.AdmissionException) as exc_info:
+        admission.acquire_slot(100, tmpdir_path, 2, slots_path=tmpdir_path)
+    assert exc_info.value.status == 503
+    assert exc_info.value.retry_after
+    slot1.release()
+    with admission.acquire_slot(100, tmpdir_path, 2, slots_path=tmpdir_path):
+        pass
+    slot2.release()
+
+def test_upload_slots_disabled(tmpdir_path):
+    slots = [admission.acquire_slot(100, tmpdir_path, 0, slots_path=tmpdir_path) for _ in range(10)]
+    assert os.listdir(tmpdir_path) == []
+    for slot in slots:
+        slot.release()
+    with pytest.raises(admission.AdmissionException) as exc_info:
+        admission.acquire_slot(2**20 + 1, tmpdir_path, 0, max_size=2**20, slots_path=tmpdir_path)
+    assert exc_info.value.status == 413
+
+def test_upload_size(tmpdir_path):
+    with pytest.raises(admission.AdmissionException) as exc_info:
+        admission.acquire_slot(2**20 + 1, tmpdir_path, 2, max_size=2**20, slots_path=tmpdir_path)
+    assert exc_info.value.status == 413
+    stat = os.statvfs(tmpdir_path)
+    free = stat.f_bavail * stat.f_frsize
+    # the uploads in progress are reserved
+    with admission.acquire_slot(free / 2, tmpdir_path, 2, slots_path=tmpdir_path):
+        with pytest.raises(admission.AdmissionException) as exc_info:
+            admission.acquire_slot(free / 2 + 2**20, tmpdir_path, 2, slots_path=tmpdir_path)
+        assert exc_info.value.status == 507
+    # the slot of the refused upload is released
+    with admission.acquire_slot(None, tmpdir_path, 2, slots_path=tmpdir_path):
+        with admission.acquire_slot(None, tmpdir_path, 2, slots_path=tmpdir_path):
+            pass
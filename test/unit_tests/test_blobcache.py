@@ -0,0 +1,66 @@
+import os
+import shutil
+import cStringIO
+import tempfile
+
+import pytest
+from api import blobcache
+
+
+@pytest.fixture
+def cache(request):
+    path = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(path))
+    return blobcache.BlobCache(os.path.join(path, 'cache'), 1000, max_entry_size=400)
+
+def _fill(cache, hash_, data):
+    with cache.tee(cStringIO.StringIO(data), hash_, len(data)) as fd:
+        while fd.read(64):
+            pass
+
+
+def test_cache_hit_miss(cache):
+    assert cache.open('a', 10) is None
+    # a miss is counted when the cache is filled
+    assert cache.stats['misses'] == 0
+    _fill(cache, 'a', 'x' * 100)
+    fd = cache.open('a', 100)
+    assert fd.read() == 'x' * 100
+    fd.close()
+    stats = cache.stats
+    assert (stats['hits'], stats['misses'], stats['fill_bytes']) == (1, 1, 100)
+
+def test_cache_partial_read_not_cached(cache):
+    data = 'x' * 100
+    with cache.tee(cStringIO.StringIO(data), 'a', len(data)) as fd:
+        fd.read(10)
+    assert cache.open('a', 100) is None
+    assert os.listdir(cache.cache_path) == []
+    # blobs larger than max_entry_size are not cached
+    data = 'x' * 500
+    assert isinstance(cache.tee(cStringIO.StringIO(data), 'b', len(data)), cStringIO.InputType)
+    # nor counted as misses
+    assert cache.stats['misses'] == 1
+
+def test_cache_add_file(cache):
+    path = os.path.join(os.path.dirname(cache.cache_path), 'upload')
+    with open(path, 'wb') as fd:
+        fd.write('x' * 100)
+    cache.add_file(path, 'a')
+    cache.add_file(path, 'a')
+    with cache.open('a', 100) as fd:
+        assert fd.read() == 'x' * 100
+    # the copies of uploads are counted apart from the fills of reads, once
+    stats = cache.stats
+    assert (stats['upload_bytes'], stats['fill_bytes']) == (100, 0)
+
+def test_cache_eviction_lru(cache):
+    for i, hash_ in enumerate('abc'):
+        _fill(cache, hash_, hash_ * 300)
+        os.utime(os.path.join(cache.cache_path, hash_), (i, i))
+    # a hit makes a blob the most recently used
+    cache.open('a', 300).close()
+    # the cache grows over its maximum size, the least recently used blob is evicted
+    _fill(cache, 'd', 'd' * 300)
+    assert sorted(f for f in os.listdir(cache.cache_path) if not f.startswith('.')) == ['a', 'c', 'd']
+    assert cache.stats['evicted_bytes'] == 300
@@ -0,0 +1,107 @@
+import os
+import time
+import hashlib
+import datetime
+
+import pytest
+from api import util
+from api import files
+from api import blobstore
+from api.dao import blobrefs
+
+
+@pytest.fixture
+def data_path(tmpdir, db, settings):
+    settings['persistent']['data_path'] = str(tmpdir)
+    return str(tmpdir)
+
+def _store(data_path, data, mtime=None):
+    hash_ = util.format_hash('sha384', hashlib.sha384(data).hexdigest())
+    upload_path = os.path.join(data_path, '.upload')
+    with open(upload_path, 'wb') as fd:
+        fd.write(data)
+    path = blobstore.resolve_path(data_path, hash_)
+    files.move_file(upload_path, path)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return hash_, path
+
+def _refcounts(db):
+    return dict((blob['_id'], blob['refcount']) for blob in db.blobs.find())
+
+
+def test_refcounts(db):
+    blobrefs.add_refs(['a', 'a', 'b'])
+    assert _refcounts(db) == {'a': 2, 'b': 1}
+    blobrefs.remove_refs(['a', 'b', 'b'])
+    assert _refcounts(db) == {'a': 1, 'b': 0}
+    assert db.blobs.find_one({'_id': 'b'})['zero_since']
+    assert 'zero_since' not in db.blobs.find_one({'_id': 'a'})
+    # blobs without a count are left to reindex, counts never go below zero
+    blobrefs.remove_refs(['a', 'a', 'c'])
+    assert _refcounts(db) == {'a': 0, 'b': 0}
+    blobrefs.replace_refs(['a'], ['b'])
+    assert _refcounts(db) == {'a': 0, 'b': 1}
+    assert 'zero_since' not in db.blobs.find_one({'_id': 'b'})
+
+def test_reindex(db, data_path):
+    referenced, _ = _store(data_path, 'referenced')
+    unreferenced, _ = _store(data_path, 'unreferenced')
+    db.acquisitions.insert_one({'files': [{'name': 'a.dcm', 'hash': referenced}, {'name': 'b.dcm', 'hash': referenced}]})
+    db.acquisition_snapshots.insert_one({'files': [{'name': 'a.dcm', 'hash': referenced}]})
+    db.sessions.insert_one({'files': [{'name': 'notes.txt'}]})
+    # a count left over from files deleted since
+    db.blobs.insert_one({'_id': 'v0-sha384-deleted', 'refcount': 5})
+    assert blobrefs.reindex() == (1, 2)
+    assert _refcounts(db) == {referenced: 3, unreferenced: 0, 'v0-sha384-deleted': 0}
+    assert 'zero_since' not in db.blobs.find_one({'_id': referenced})
+    assert db.blobs.find_one({'_id': unreferenced})['zero_since']
+    assert blobrefs.index_complete()
+
+def test_collect_requires_reindex(db, data_path):
+    with pytest.raises(blobrefs.BlobRefsException):
+        blobrefs.collect()
+
+def test_collect(db, data_path):
+    old = time.time() - 3 * 86400
+    collected, collected_path = _store(data_path, 'collected', mtime=old)
+    recent, recent_path = _store(data_path, 'recent', mtime=old)
+    referenced, referenced_path = _store(data_path, 'referenced', mtime=old)
+    reuploaded, reuploaded_path = _store(data_path, 'reuploaded')
+    db.acquisitions.insert_one({'files': [{'name': 'a.dcm', 'hash': referenced}]})
+    blobrefs.reindex()
+    # the counts were out of date: the referenced blob is found by looking at the containers
+    db.blobs.update_one({'_id': referenced}, {'$set': {'refcount': 0, 'zero_since': datetime.datetime(2016, 1, 1)}})
+    for hash_ in (collected, reuploaded):
+        db.blobs.update_one({'_id': hash_}, {'$set': {'zero_since': datetime.datetime(2016, 1, 1)}})
+
+    assert blobrefs.collect(dry_run=True) == (2, 0)
+    assert os.path.exists(collected_path)
+
+    assert blobrefs.collect() == (1, len('collected'))
+    assert not os.path.exists(collected_path)
+    assert os.listdir(os.path.join(data_path, blobrefs.TRASH_DIR)) == []
+    assert db.blobs.find_one({'_id': collected}) is None
+    # within the grace period
+    assert os.path.exists(recent_path)
+    # referenced by a container, the count is fixed
+    assert os.path.exists(referenced_path)
+    assert 'zero_since' not in db.blobs.find_one({'_id': referenced})
+    # uploaded again after the count dropped to zero, restored from the trash
+    assert os.path.exists(reuploaded_path)
+    assert db.blobs.find_one({'_id': reuploaded})
+
+def test_collect_restores_blob_referenced_meanwhile(db, data_path, monkeypatch):
+    hash_, path = _store(data_path, 'data', mtime=time.time() - 3 * 86400)
+    blobrefs.reindex()
+    db.blobs.update_one({'_id': hash_}, {'$set': {'zero_since': datetime.datetime(2016, 1, 1)}})
+    rename = os.rename
+    def rename_then_reference(src, dst):
+        rename(src, dst)
+        # the blob is referenced again while it is moved to the trash
+        if os.path.basename(os.path.dirname(dst)) == blobrefs.TRASH_DIR:
+            blobrefs.add_refs([hash_])
+    monkeypatch.setattr(os, 'rename', rename_then_reference)
+    assert blobrefs.collect() == (0, 0)
+    assert os.path.exists(path)
+    assert db.blobs.find_one({'_id': hash_})['refcount'] == 1
@@ -0,0 +1,154 @@
+import os
+import cStringIO
+import threading
+
+import pytest
+from api import files
+from api import blobstore
+
+def _write(path, data):
+    with open(path, 'wb') as fd:
+        fd.write(data)
+
+def _write_tmp(dir_path, data):
+    path = os.path.join(dir_path, '.upload')
+    _write(path, data)
+    return path
+
+
+def test_move_file_compressed(tmpdir_path):
+    src = os.path.join(tmpdir_path, 'upload')
+    target = os.path.join(tmpdir_path, 'v0', 'sha384', 'ab', 'cd', 'blob')
+    data = '{"key": "value"}\n' * 100000
+    _write(src, data)
+    bytes_written = files.move_file(src, target, compress_ratio=0.8)
+    assert 0 < bytes_written < len(data) * 0.8
+    assert not os.path.exists(src)
+    assert blobstore.stored_path(target) == target + blobstore.GZIP_SUFFIX
+    assert os.listdir(os.path.dirname(target)) == ['blob' + blobstore.GZIP_SUFFIX]
+    with blobstore.open_blob(target) as fd:
+        assert fd.read() == data
+    fd, compressed = blobstore.open_stored_blob(target)
+    assert compressed
+    fd.close()
+    # the same content is not stored again
+    _write(src, data)
+    assert files.move_file(src, target, compress_ratio=0.8) == 0
+    assert not os.path.exists(src)
+    assert not os.path.exists(target)
+
+def test_move_file_concurrent(tmpdir_path):
+    target = os.path.join(tmpdir_path, 'v0', 'blob')
+    data = '{"key": "value"}\n' * 100000
+    errors = []
+    def store(i):
+        src = os.path.join(tmpdir_path, 'upload%d' % i)
+        _write(src, data)
+        try:
+            files.move_file(src, target, compress_ratio=0.8)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=store, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    # the temporary files of the threads are distinct, none is left behind
+    assert os.listdir(os.path.dirname(target)) == ['blob' + blobstore.GZIP_SUFFIX]
+    with blobstore.open_blob(target) as fd:
+        assert fd.read() == data
+
+def test_move_file_incompressible(tmpdir_path):
+    src = os.path.join(tmpdir_path, 'upload')
+    target = os.path.join(tmpdir_path, 'blob')
+    data = os.urandom(100000)
+    _write(src, data)
+    assert files.move_file(src, target, compress_ratio=0.8) == 0
+    assert blobstore.stored_path(target) == target
+    with blobstore.open_blob(target) as fd:
+        assert fd.read() == data
+
+def test_stored_path_missing(tmpdir_path):
+    assert blobstore.stored_path(os.path.join(tmpdir_path, 'blob')) is None
+
+
+CHUNK_PARAMS = {'min_size': 2**10, 'avg_bits': 12, 'max_size': 2**14}
+
+def test_iter_chunks_content_defined():
+    data = os.urandom(2**19)
+    chunks = list(blobstore.iter_chunks(cStringIO.StringIO(data), **CHUNK_PARAMS))
+    assert ''.join(chunks) == data
+    assert all(len(chunk) <= CHUNK_PARAMS['max_size'] for chunk in chunks)
+    assert all(len(chunk) >= CHUNK_PARAMS['min_size'] for chunk in chunks[:-1])
+    # inserting bytes only changes the chunks around the insertion
+    edited = data[:2**18] + 'inserted' + data[2**18:]
+    edited_chunks = list(blobstore.iter_chunks(cStringIO.StringIO(edited), **CHUNK_PARAMS))
+    assert len(set(chunks) - set(edited_chunks)) <= 2
+
+def test_iter_chunks_small_file():
+    assert list(blobstore.iter_chunks(cStringIO.StringIO(''), **CHUNK_PARAMS)) == []
+    assert list(blobstore.iter_chunks(cStringIO.StringIO('data'), **CHUNK_PARAMS)) == ['data']
+
+def test_chunked_blob(tmpdir_path):
+    chunks_path = os.path.join(tmpdir_path, 'chunks')
+    data = os.urandom(2**18)
+    manifest, bytes_written = blobstore.write_chunks(cStringIO.StringIO(data), chunks_path, **CHUNK_PARAMS)
+    assert bytes_written == manifest['size'] == len(data)
+    # a near duplicate only stores the changed chunks
+    edited = data[:2**17] + 'inserted' + data[2**17:]
+    edited_manifest, bytes_written = blobstore.write_chunks(cStringIO.StringIO(edited), chunks_path, **CHUNK_PARAMS)
+    assert bytes_written < len(edited) / 4
+    with blobstore.ChunkedBlob(edited_manifest, chunks_path) as fd:
+        assert fd.read() == edited
+        fd.seek(2**17 - 10)
+        assert fd.read(30) == edited[2**17 - 10:2**17 + 20]
+        fd.seek(-5, os.SEEK_END)
+        assert fd.read(100) == edited[-5:]
+        assert fd.tell() == len(edited)
+
+def test_relink_blob(tmpdir_path):
+    hash_ = 'v0-sha384-01b395a1cbc0f218'
+    path = blobstore.blob_path(tmpdir_path, hash_, 2)
+    files.move_file(_write_tmp(tmpdir_path, 'data'), path)
+    assert list(blobstore.iter_stored_blobs(tmpdir_path)) == [path]
+    assert blobstore.relink_blob(tmpdir_path, path, 3)
+    new_path = blobstore.blob_path(tmpdir_path, hash_, 3)
+    assert list(blobstore.iter_stored_blobs(tmpdir_path)) == [new_path]
+    with blobstore.open_blob(new_path) as fd:
+        assert fd.read() == 'data'
+    # already moved, or moved by an interrupted run
+    assert not blobstore.relink_blob(tmpdir_path, new_path, 3)
+    os.link(new_path, path)
+    assert blobstore.relink_blob(tmpdir_path, path, 3)
+    assert list(blobstore.iter_stored_blobs(tmpdir_path)) == [new_path]
+
+def test_parse_shard_depths():
+    assert blobstore.parse_shard_depths('') == {}
+    assert blobstore.parse_shard_depths('v0=3, v1=4') == {'v0': 3, 'v1': 4}
+    for setting in ('v0', 'v0=three', 'v0=0', 'v0=3=4'):
+        with pytest.raises(ValueError):
+            blobstore.parse_shard_depths(setting)
+
+def test_resolve_path_depths_in_use(tmpdir_path, monkeypatch):
+    hash_ = 'v0-sha384-01b395a1cbc0f218'
+    monkeypatch.setattr(blobstore, 'shard_depth', lambda hash_: 4)
+    # the store was migrated from depth 2 to 3, and is now configured with depth 4
+    monkeypatch.setattr(blobstore, 'depths_in_use', lambda hash_version, depth: [4, 2, 3])
+    path = blobstore.blob_path(tmpdir_path, hash_, 3)
+    files.move_file(_write_tmp(tmpdir_path, 'data'), path)
+    assert blobstore.resolve_path(tmpdir_path, hash_) == path
+    # not stored yet
+    assert blobstore.resolve_path(tmpdir_path, 'v0-sha384-02c4') == blobstore.blob_path(tmpdir_path, 'v0-sha384-02c4', 4)
+
+def test_iter_stored_blobs_after(tmpdir_path):
+    hashes = ['v0-sha384-01b3', 'v0-sha384-01b4', 'v0-sha384-02c4', 'v0-sha384-ffe1']
+    paths = []
+    for i, hash_ in enumerate(hashes):
+        paths.append(blobstore.blob_path(tmpdir_path, hash_, 2 + i % 2))
+        files.move_file(_write_tmp(tmpdir_path, hash_), paths[-1])
+    paths.sort()
+    assert list(blobstore.iter_stored_blobs(tmpdir_path)) == paths
+    for i, path in enumerate(paths):
+        after = os.path.relpath(path, tmpdir_path)
+        assert list(blobstore.iter_stored_blobs(tmpdir_path, after=after)) == paths[i + 1:]
@@ -0,0 +1,198 @@
+import os
+import errno
+import hashlib
+import zipfile
+import threading
+
+import pytest
+import webob
+from api import files
+
+def _write(path, data):
+    with open(path, 'wb') as fd:
+        fd.write(data)
+
+def _read(path):
+    with open(path, 'rb') as fd:
+        return fd.read()
+
+
+def test_move_file_places_new_blob_without_copy(tmpdir_path):
+    src = os.path.join(tmpdir_path, 'upload')
+    target = os.path.join(tmpdir_path, 'v0', 'sha384', 'ab', 'cd', 'blob')
+    _write(src, 'data')
+    assert files.move_file(src, target) == 0
+    assert not os.path.exists(src)
+    assert _read(target) == 'data'
+
+def test_move_file_drops_existing_blob(tmpdir_path):
+    src = os.path.join(tmpdir_path, 'upload')
+    target = os.path.join(tmpdir_path, 'blob')
+    _write(src, 'data')
+    _write(target, 'data')
+    target_inode = os.stat(target).st_ino
+    assert files.move_file(src, target) == 0
+    assert not os.path.exists(src)
+    assert os.stat(target).st_ino == target_inode
+
+def test_move_file_refreshes_existing_blob(tmpdir_path):
+    src = os.path.join(tmpdir_path, 'upload')
+    target = os.path.join(tmpdir_path, 'blob')
+    _write(src, 'data')
+    _write(target, 'data')
+    os.utime(target, (0, 0))
+    files.move_file(src, target)
+    assert os.path.getmtime(target) > 0
+
+def test_move_file_copies_across_devices(tmpdir_path, monkeypatch):
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', cross_device)
+    src = os.path.join(tmpdir_path, 'upload')
+    target = os.path.join(tmpdir_path, 'blob')
+    _write(src, 'data')
+    assert files.move_file(src, target) == 4
+    assert not os.path.exists(src)
+    assert _read(target) == 'data'
+    assert os.listdir(tmpdir_path) == ['blob']
+
+
+def _write_zip(path, members, comment='', compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(path, 'w', compression) as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+        zf.comment = comment
+
+def test_zip_index(tmpdir_path):
+    path = os.path.join(tmpdir_path, 'test.zip')
+    _write_zip(path, [('a.dcm', 'a' * 1000), ('b.dcm', 'b')], comment='{"group": "unknown"}')
+    index = files.zip_index(path)
+    assert str(index['comment']) == '{"group": "unknown"}'
+    assert [(m['name'], m['size']) for m in index['members']] == [('a.dcm', 1000), ('b.dcm', 1)]
+
+def test_zip_index_not_a_zip(tmpdir_path):
+    path = os.path.join(tmpdir_path, 'test.txt')
+    _write(path, 'not a zip')
+    assert files.zip_index(path) is None
+
+def test_zip_indexes_identical(tmpdir_path):
+    path1 = os.path.join(tmpdir_path, 'test1.zip')
+    path2 = os.path.join(tmpdir_path, 'test2.zip')
+    path3 = os.path.join(tmpdir_path, 'test3.zip')
+    _write_zip(path1, [('a.dcm', 'a'), ('b.dcm', 'b')])
+    # same members in a different order and with a different compression
+    _write_zip(path2, [('b.dcm', 'b'), ('a.dcm', 'a')], compression=zipfile.ZIP_STORED)
+    _write_zip(path3, [('a.dcm', 'a'), ('b.dcm', 'c')])
+    assert files.zip_indexes_identical(files.zip_index(path1), files.zip_index(path2))
+    assert not files.zip_indexes_identical(files.zip_index(path1), files.zip_index(path3))
+
+def test_open_zip_member(tmpdir_path):
+    path = os.path.join(tmpdir_path, 'test.zip')
+    data = os.urandom(100000) + 'x' * 100000
+    for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        # prepend some data to check that offsets are absolute
+        with open(path, 'wb') as fd:
+            fd.write('prefix')
+        with zipfile.ZipFile(path, 'a', compression) as zf:
+            zf.writestr('a.dcm', 'a')
+            zf.writestr('b.dcm', data)
+        index = files.zip_index(path)
+        assert files.zip_member_info(index, 'missing.dcm') is None
+        assert files.open_zip_member(path, files.zip_member_info(index, 'b.dcm')).read() == data
+        assert files.open_zip_member(path, files.zip_member_info(index, 'a.dcm')).read() == 'a'
+
+def test_iter_zip_member_range(tmpdir_path):
+    path = os.path.join(tmpdir_path, 'test.zip')
+    data = os.urandom(300000)
+    _write_zip(path, [('a.dcm', 'a'), ('b.dcm', data)], compression=zipfile.ZIP_STORED)
+    member = files.zip_member_info(files.zip_index(path), 'b.dcm')
+    fd = files.open_zip_member_range(path, member, 1000)
+    chunks = list(files.iter_file(fd, 200000, chunk_size=2**16))
+    assert fd.closed
+    assert len(chunks) == 4
+    assert ''.join(chunks) == data[1000:201000]
+
+def test_open_zip_member_range_compressed(tmpdir_path):
+    path = os.path.join(tmpdir_path, 'test.zip')
+    _write_zip(path, [('a.dcm', 'a' * 1000)])
+    member = files.zip_member_info(files.zip_index(path), 'a.dcm')
+    with pytest.raises(zipfile.BadZipfile):
+        files.open_zip_member_range(path, member, 10)
+
+def test_threaded_hashing_file(tmpdir_path):
+    path = os.path.join(tmpdir_path, 'upload')
+    data = os.urandom(3 * 2**20 + 100)
+    received_file = files.ThreadedHashingFile(path, 'sha384')
+    for i in range(0, len(data), 2**16):
+        received_file.write(data[i:i + 2**16])
+    received_file.close()
+    assert received_file.get_hash() == hashlib.sha384(data).hexdigest()
+    assert received_file.size == len(data)
+    assert _read(path) == data
+
+def test_multi_file_store(tmpdir_path):
+    body = ''
+    parts = [('metadata', None, '{"acquisition": {}}'), ('file1', 'a b.txt', 'a' * 1000), ('file2', 'c.txt', os.urandom(2**21))]
+    for name, filename, data in parts:
+        body += '--boundary\r\nContent-Disposition: form-data; name="%s"' % name
+        if filename:
+            body += '; filename="%s"' % filename
+        body += '\r\n\r\n' + data + '\r\n'
+    body += '--boundary--\r\n'
+    request = webob.Request.blank('/', method='POST', body=body, content_type='multipart/form-data; boundary=boundary')
+    file_store = files.MultiFileStore(request, tmpdir_path)
+    assert file_store.metadata == {'acquisition': {}}
+    assert sorted(file_store.files) == ['a%20b.txt', 'c.txt']
+    for filename, data in (('a%20b.txt', parts[1][2]), ('c.txt', parts[2][2])):
+        fileinfo = file_store.files[filename]
+        assert fileinfo['size'] == len(data)
+        assert fileinfo['hash'].endswith(hashlib.sha384(data).hexdigest())
+        assert _read(fileinfo['path']) == data
+
+def test_multi_file_store_workers_finished_per_part(tmpdir_path):
+    body = ''
+    for i in range(3):
+        body += '--boundary\r\nContent-Disposition: form-data; name="file%d"; filename="%d.dat"\r\n\r\n' % (i, i)
+        body += os.urandom(2**20) + '\r\n'
+    body += '--boundary--\r\n'
+    request = webob.Request.blank('/', method='POST', body=body, content_type='multipart/form-data; boundary=boundary')
+    threads = []
+    class CountingHashingFile(files.ThreadedHashingFile):
+        def __init__(self, *args):
+            threads.append(threading.active_count())
+            super(CountingHashingFile, self).__init__(*args)
+    field_storage = files.getHashingFieldStorage(tmpdir_path, 'sha384', CountingHashingFile)
+    field_storage(fp=request.body_file, environ=dict(request.environ, QUERY_STRING=''), keep_blank_values=True)
+    # the worker of each part is finished before the next part is received
+    assert len(threads) == 3 and len(set(threads)) == 1
+
+def test_zip_index_too_large(tmpdir_path, monkeypatch):
+    monkeypatch.setattr(files, 'MAX_ZIP_INDEX_MEMBERS', 2)
+    path = os.path.join(tmpdir_path, 'test.zip')
+    _write_zip(path, [('c.dcm', 'c'), ('a.dcm', 'a'), ('b.dcm', 'b')], comment='large')
+    index = files.zip_index(path)
+    # the archive is still a zip file, its members are read from the archive
+    assert index['too_large'] and str(index['comment']) == 'large'
+    assert [m['name'] for m in files.zip_members(index, path)] == ['c.dcm', 'a.dcm', 'b.dcm']
+    assert files.open_zip_member(path, files.zip_member_info(index, 'b.dcm', path)).read() == 'b'
+    assert files.zip_member_info(index, 'missing.dcm', path) is None
+
+def test_zip_index_long_names(tmpdir_path):
+    path = os.path.join(tmpdir_path, 'test.zip')
+    # 9 MB of member names, few members
+    names = ['%04d' % i + 'x' * 4500 for i in range(2000)]
+    _write_zip(path, [(name, '') for name in names])
+    index = files.zip_index(path)
+    assert index['too_large']
+    assert files.zip_member_info(index, names[10], path)['name'] == names[10]
+
+def test_zip_member_info_lookup(tmpdir_path):
+    path = os.path.join(tmpdir_path, 'test.zip')
+    names = ['%03d.dcm' % i for i in range(100, 0, -1)]
+    _write_zip(path, [(name, name) for name in names])
+    index = files.zip_index(path)
+    assert [m['name'] for m in index['members']] == names
+    for name in names:
+        assert files.zip_member_info(index, name)['name'] == name
+    assert files.zip_member_info(index, '000.dcm') is None
+    assert files.zip_member_info(index, '999.dcm') is None
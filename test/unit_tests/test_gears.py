@@ -0,0 +1,44 @@
+import datetime
+
+import pytest
+from api import gears
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    docs = {}
+    lookups = []
+    def find_gear(name):
+        lookups.append(name)
+        return docs.get(name)
+    monkeypatch.setattr(gears, '_find_gear', find_gear)
+    gears._lookups.clear()
+    return docs, lookups
+
+def test_builtin_gear(registry):
+    _, lookups = registry
+    gear = gears.get_gear('dcm_convert')
+    assert gear.version == 'dcm_convert-0.3.0.c.tar'
+    assert gears.get_gear('dcm_convert') is gear
+    # the lookup is cached
+    assert lookups == ['dcm_convert']
+    with pytest.raises(Exception):
+        gears.get_gear('unknown')
+
+def test_registered_gear_template(registry):
+    docs, _ = registry
+    docs['dcm_convert'] = {
+        'name': 'dcm_convert', 'category': 'converter', 'version': '0.4.0', 'created': datetime.datetime.utcnow(),
+        'input': {'type': 'file', 'location': '/', 'uri': '/opt/flywheel-temp/dcm_convert-0.4.0.c.tar'},
+    }
+    template = gears.get_template('dcm_convert')
+    assert template.gear.version == '0.4.0'
+    assert str(template.gear.category) == 'converter'
+    # a lookup after the cache expired reuses the template of the same version
+    gears._lookups.clear()
+    assert gears.get_template('dcm_convert') is template
+    i = {'container_type': 'acquisition', 'container_id': '57a0cd3d7c3b2e0011b7e5f4', 'filename': 'scan.dcm'}
+    formula = template.formula(i, 'job1')
+    assert formula['inputs'][0] is template.gear.input
+    assert formula['inputs'][1]['uri'] == '/acquisitions/57a0cd3d7c3b2e0011b7e5f4/files/scan.dcm'
+    assert formula['outputs'][0]['uri'] == '/engine?level=acquisition&id=57a0cd3d7c3b2e0011b7e5f4&job=job1'
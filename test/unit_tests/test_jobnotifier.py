@@ -0,0 +1,48 @@
+import time
+import threading
+
+from api import jobnotifier
+
+
+def test_notifier_wait():
+    notifier = jobnotifier.JobNotifier(db=None)
+    generation = notifier.generation
+    start = time.time()
+    assert notifier.wait(generation, 0.05) == generation
+    assert time.time() - start >= 0.05
+    # jobs queued before the wait
+    notifier.notify()
+    assert notifier.wait(generation, 10) == generation + 1
+    # jobs queued during the wait
+    threading.Timer(0.05, notifier.notify).start()
+    start = time.time()
+    assert notifier.wait(generation + 1, 10) == generation + 2
+    assert time.time() - start < 5
+
+class _TailableCursor(object):
+    """yields the events, then the events inserted while it is iterated, and dies"""
+
+    def __init__(self, events, inserted):
+        self.events = list(events)
+        self.inserted = inserted
+        self.alive = True
+
+    def __iter__(self):
+        for event in self.events:
+            yield event
+        self.events = self.inserted
+        self.inserted = []
+        if not self.events:
+            self.alive = False
+
+def test_notifier_tail_cursor():
+    events = [{'_id': 2, 'queued': 0}, {'_id': 1, 'queued': 3}]
+    inserted = [{'_id': 0, 'queued': 1}, {'_id': 3, 'queued': 2}]
+    job_events = type('job_events', (object,), {
+        'find_one': lambda self, sort: events[-1],
+        'find': lambda self, cursor_type: _TailableCursor(events, inserted),
+    })()
+    notifier = jobnotifier.JobNotifier(db=type('db', (object,), {'job_events': job_events})())
+    notifier._tail_cursor()
+    # once when the cursor is opened, and for each event inserted afterwards, whatever their _id
+    assert notifier.generation == 3
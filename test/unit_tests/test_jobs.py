@@ -0,0 +1,301 @@
+import os
+import bson
+import json
+import datetime
+
+import pytest
+from api import jobs
+from api import gears
+
+
+@pytest.fixture(autouse=True)
+def builtin_gears(monkeypatch):
+    # no gear is registered, jobs run the built-in gears
+    monkeypatch.setattr(gears, '_find_gear', lambda name: None)
+    gears._lookups.clear()
+
+
+def test_new_job_formula():
+    input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash='v0-sha384-01b3')
+    job = jobs._new_job('dcm_convert', input_)
+    assert job['state'] == 'pending'
+    # the formula is generated at enqueue time, engines do not wait for it when claiming jobs
+    assert job['request'] == jobs.generate_formula('dcm_convert', input_._asdict(), job['_id'])
+    assert job['request']['inputs'][1]['uri'] == '/acquisitions/57a0cd3d7c3b2e0011b7e5f4/files/scan.dcm'
+    # the outputs are recorded on the job
+    assert job['request']['outputs'][0]['uri'].endswith('&job=' + str(job['_id']))
+
+def test_new_job_lease():
+    input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash='v0-sha384-01b3')
+    assert jobs._new_job('dcm_convert', input_)['lease'] == jobs.DEFAULT_LEASE
+    assert jobs._new_job('dcm_convert', input_, lease=3600)['lease'] == 3600
+    for lease in (0, -1, jobs.MAX_LEASE + 1, '100', True):
+        with pytest.raises(ValueError):
+            jobs._new_job('dcm_convert', input_, lease=lease)
+
+class _Collection(object):
+    """the job_queues operations used by assign_vtimes, on a dict"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find_one(self, query):
+        return self.docs.get(query['_id'])
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        doc = self.docs.setdefault(query['_id'], {'_id': query['_id']})
+        for key, value in update.get('$setOnInsert', {}).iteritems():
+            doc.setdefault(key, value)
+        for key, value in update.get('$max', {}).iteritems():
+            doc[key] = max(doc.get(key, value), value)
+        for key, value in update.get('$inc', {}).iteritems():
+            doc[key] = doc.get(key, 0) + value
+        return doc
+
+def test_assign_vtimes_fair_share():
+    db = type('db', (object,), {'job_queues': _Collection({})})()
+    input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash='v0-sha384-01b3')
+    bulk = [jobs._new_job('dcm_convert', input_, queue='bulk') for _ in range(100)]
+    jobs.assign_vtimes(db, bulk)
+    other = [jobs._new_job('dcm_convert', input_, queue='other') for _ in range(2)]
+    jobs.assign_vtimes(db, other)
+    # the jobs of the other queue are not queued behind the bulk import
+    order = sorted(bulk + other, key=lambda j: (-j['priority'], j['vtime']))
+    assert [j['queue'] for j in order[:4]] == ['bulk', 'other', 'bulk', 'other']
+    # a queue with twice the weight gets twice the share
+    db.job_queues.docs['heavy'] = {'_id': 'heavy', 'weight': 2.0, 'finish': 0.0}
+    heavy = [jobs._new_job('dcm_convert', input_, queue='heavy') for _ in range(4)]
+    jobs.assign_vtimes(db, heavy)
+    assert [j['vtime'] for j in heavy] == [0.0, 0.5, 1.0, 1.5]
+    # a queue with an invalid weight gets the default share
+    for weight in (0, -1.0, 'heavy', None):
+        db.job_queues.docs['broken'] = {'_id': 'broken', 'weight': weight, 'finish': 0.0}
+        broken = [jobs._new_job('dcm_convert', input_, queue='broken') for _ in range(2)]
+        jobs.assign_vtimes(db, broken)
+        assert [j['vtime'] for j in broken] == [0.0, 1.0]
+
+def test_memoize():
+    def input_(container_id, filehash):
+        return jobs.FileInput(container_type='acquisition', container_id=container_id, filename='scan.dcm', filehash=filehash)
+    done = jobs._new_job('dcm_convert', input_('a1', 'v0-sha384-01b3'))
+    done.update(state='complete', outputs={'metadata': {}, 'files': [], 'received': []})
+    pending = jobs._new_job('dcm_convert', input_('a2', 'v0-sha384-02c4'))
+    db = type('db', (object,), {
+        'jobs': type('jobs', (object,), {'find': lambda self, query, fields: [pending]})(),
+        'jobs_archive': type('jobs_archive', (object,), {'find': lambda self, query, fields: [done]})(),
+        'job_stats': type('job_stats', (object,), {'update_one': lambda self, *args, **kwargs: None})(),
+    })()
+    specs = [
+        ('dcm_convert', input_('a1', 'v0-sha384-01b3')), # already computed for the acquisition
+        ('dcm_convert', input_('a2', 'v0-sha384-02c4')), # pending for the acquisition
+        ('dcm_convert', input_('a3', 'v0-sha384-01b3')), # computed for another acquisition
+        ('dcm_convert', input_('a3', 'v0-sha384-03d5')), # new
+        ('dcm_convert', input_('a3', 'v0-sha384-03d5')), # twice in the batch
+        ('qa-report-fmri', input_('a3', 'v0-sha384-03d5')), # another gear
+    ]
+    to_queue, reusable = jobs.memoize(db, specs)
+    assert to_queue == [specs[3], specs[5]]
+    assert reusable == [(specs[2], done)]
+
+class _Stats(object):
+    """the job_stats operations used by the materialized statistics, on a dict"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def update_one(self, query, update, upsert=False):
+        doc = self.docs.get(query['_id'])
+        if doc is None and upsert:
+            doc = self.docs[query['_id']] = dict(query, **update.get('$setOnInsert', {}))
+        if doc is not None:
+            doc.update(update.get('$set', {}))
+            for key, value in update.get('$inc', {}).iteritems():
+                d = doc
+                path = key.split('.')
+                for part in path[:-1]:
+                    d = d.setdefault(part, {})
+                d[path[-1]] = d.get(path[-1], 0) + value
+        return type('result', (object,), {'matched_count': int(doc is not None)})()
+
+    def add_update(self, selector, document, multi, upsert):
+        self.update_one(selector, document, upsert=upsert)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            request._add_to_bulk(self)
+
+def test_materialized_stats():
+    counts = {'_id': 'counts', 'state': {}, 'total': 0, 'permafailed': 0}
+    db = type('db', (object,), {'job_stats': _Stats({'counts': counts})})()
+    input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash='v0-sha384-01b3')
+    jobs.count_new_jobs(db, [jobs._new_job('dcm_convert', input_, tags=['b', 'a']) for _ in range(3)])
+    jobs.count_transition(db, 'pending', 'running', 2)
+    jobs.count_transition(db, 'running', 'failed', 1, permafailed=1)
+    assert counts == {'_id': 'counts', 'state': {'pending': 1, 'running': 1, 'failed': 1}, 'total': 3, 'permafailed': 1}
+    assert db.job_stats.docs['tags:a|b|converter|dcm_convert']['count'] == 3
+    jobs.count_new_jobs(db, [jobs._new_job('dcm_convert', input_, tags=['a', 'b'])])
+    assert db.job_stats.docs['tags:a|b|converter|dcm_convert']['count'] == 4
+    assert counts['total'] == 4
+
+def test_list_query():
+    assert jobs.list_query() == {}
+    query = jobs.list_query(states=['failed'], tags=['qa'], since='2016-08-01T00:00:00+02:00', after='2016-08-02T10:00:00.123000+00:00,57a0cd3d7c3b2e0011b7e5f4')
+    assert query['state'] == {'$in': ['failed']}
+    assert query['tags'] == {'$all': ['qa']}
+    assert query['modified'] == {'$gte': datetime.datetime(2016, 7, 31, 22)}
+    modified = datetime.datetime(2016, 8, 2, 10, 0, 0, 123000)
+    assert query['$or'] == [
+        {'modified': {'$lt': modified}},
+        {'modified': modified, '_id': {'$lt': bson.ObjectId('57a0cd3d7c3b2e0011b7e5f4')}},
+    ]
+    with pytest.raises(ValueError):
+        jobs.list_query(since='yesterday')
+
+def test_iter_json_list():
+    assert ''.join(jobs.iter_json_list([])) == '[]'
+    docs = [{'_id': bson.ObjectId('57a0cd3d7c3b2e0011b7e5f4')}, {'state': 'failed'}]
+    assert json.loads(''.join(jobs.iter_json_list(docs))) == [{'_id': '57a0cd3d7c3b2e0011b7e5f4'}, {'state': 'failed'}]
+
+def test_job_attempts():
+    input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash='v0-sha384-01b3')
+    first = jobs._new_job('dcm_convert', input_)
+    second = jobs._new_job('dcm_convert', input_, attempt_n=2, previous_job_id=first['_id'])
+    third = jobs._new_job('dcm_convert', input_, attempt_n=3, previous_job_id=second['_id'])
+    def collection(docs):
+        return type('collection', (object,), {'find_one': lambda self, query: docs.get(query['_id'])})()
+    # the first attempts were archived
+    db = type('db', (object,), {
+        'jobs': collection({third['_id']: third}),
+        'jobs_archive': collection({first['_id']: first, second['_id']: second}),
+    })()
+    assert jobs.find_job(db, first['_id']) is first
+    assert jobs.job_attempts(db, third) == [first, second, third]
+
+def test_localize_formula(tmpdir):
+    data_path = str(tmpdir)
+    input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash='v0-sha384-01b3')
+    formula = jobs._new_job('dcm_convert', input_)['request']
+    path = os.path.join(data_path, 'v0', 'sha384', '01', 'b3', 'v0-sha384-01b3')
+    # the blob is compressed, the engine downloads the input
+    os.makedirs(os.path.dirname(path))
+    open(path + '.gz', 'w').close()
+    assert jobs.localize_formula(formula, path, 'scan.dcm', data_path, '/mnt/data') is formula
+    open(path, 'w').close()
+    local = jobs.localize_formula(formula, path, 'scan.dcm', data_path, '/mnt/data')
+    assert local['inputs'][0] is formula['inputs'][0]
+    assert local['inputs'][1] == {'type': 'local', 'uri': '/mnt/data/v0/sha384/01/b3/v0-sha384-01b3', 'name': 'scan.dcm', 'location': '/flywheel/v0/input'}
+    assert local['outputs'] == formula['outputs']
+
+def test_outputs_stored(tmpdir, monkeypatch):
+    monkeypatch.setattr(jobs.blobstore, 'shard_depth', lambda hash_: jobs.blobstore.DEFAULT_SHARD_DEPTH)
+    monkeypatch.setattr(jobs.blobstore, 'depths_in_use', lambda hash_version, depth: [depth])
+    data_path = str(tmpdir)
+    outputs = {'files': [{'name': 'scan.nii.gz', 'hash': 'v0-sha384-01b3'}]}
+    assert not jobs.outputs_stored(outputs, data_path)
+    path = jobs.blobstore.blob_path(data_path, 'v0-sha384-01b3')
+    os.makedirs(os.path.dirname(path))
+    open(path + '.gz', 'w').close()
+    assert jobs.outputs_stored(outputs, data_path)
+
+class _Jobs(object):
+    """the jobs operations used by claim_jobs, on a list, another engine claims the first candidates"""
+
+    def __init__(self, docs, stolen):
+        self.docs = docs
+        self.stolen = stolen
+
+    def _match(self, doc, query):
+        ids = query.get('_id', {})
+        return (
+            all(doc.get(key) == query[key] for key in ('state', 'claim') if key in query) and
+            ('$in' not in ids or doc['_id'] in ids['$in']) and
+            ('$nin' not in ids or doc['_id'] not in ids['$nin'])
+        )
+
+    def find(self, query, fields=None):
+        return _Cursor([doc for doc in self.docs if self._match(doc, query)])
+
+    def update_many(self, query, update):
+        for doc in self.docs[:self.stolen]:
+            doc['state'] = 'running'
+        self.stolen = 0
+        matched = [doc for doc in self.docs if self._match(doc, query)]
+        for doc in matched:
+            doc.update(update['$set'])
+        return type('result', (object,), {'modified_count': len(matched)})()
+
+class _Cursor(list):
+
+    def sort(self, keys):
+        return self
+
+    def limit(self, n):
+        return _Cursor(self[:n])
+
+def test_claim_jobs_concurrent():
+    input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash='v0-sha384-01b3')
+    pending = [jobs._new_job('dcm_convert', input_) for _ in range(5)]
+    db = type('db', (object,), {
+        'jobs': _Jobs(pending, stolen=2),
+        'job_stats': type('job_stats', (object,), {'update_one': lambda self, *args: None})(),
+        'job_queues': type('job_queues', (object,), {'update_one': lambda self, *args, **kwargs: None})(),
+    })()
+    # the jobs claimed by the other engine are replaced by the next pending jobs
+    claimed = jobs.claim_jobs(db, 3)
+    assert [j['_id'] for j in claimed] == [j['_id'] for j in pending[2:]]
+    assert jobs.claim_jobs(db, 3) == []
+
+def _running_job(db, attempt=1, expires_in=-10):
+    input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash='v0-sha384-01b3')
+    job = jobs._new_job('dcm_convert', input_, attempt_n=attempt)
+    now = datetime.datetime.utcnow()
+    job.update({'state': 'running', 'modified': now, 'expires': now + datetime.timedelta(seconds=expires_in)})
+    db.jobs.insert_one(job)
+    return job['_id']
+
+def test_reap_jobs(db):
+    assert jobs.reap_jobs(db) == 0
+    expired = _running_job(db)
+    last_attempt = _running_job(db, attempt=jobs.MAX_ATTEMPTS)
+    alive = _running_job(db, expires_in=60)
+    assert jobs.reap_jobs(db) == 2
+    # the expired job is failed and retried
+    assert db.jobs.find_one({'_id': expired})['state'] == 'failed'
+    retry = db.jobs.find_one({'previous_job_id': expired})
+    assert (retry['state'], retry['attempt']) == ('pending', 2)
+    # the job at the attempt limit is failed permanently
+    assert db.jobs.find_one({'_id': last_attempt})['state'] == 'failed'
+    assert db.jobs.find_one({'previous_job_id': last_attempt}) is None
+    # the job with a live lease is left alone
+    assert db.jobs.find_one({'_id': alive})['state'] == 'running'
+    assert db.jobs.count() == 4
+    # the reaped jobs are not reaped again
+    assert jobs.reap_jobs(db) == 0
+
+def test_archive_jobs(db):
+    input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash='v0-sha384-01b3')
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    first = jobs._new_job('dcm_convert', input_)
+    second = jobs._new_job('dcm_convert', input_, attempt_n=2, previous_job_id=first['_id'])
+    third = jobs._new_job('dcm_convert', input_, attempt_n=3, previous_job_id=second['_id'])
+    first.update({'state': 'failed', 'modified': old})
+    second.update({'state': 'complete', 'modified': old})
+    third.update({'state': 'complete', 'modified': datetime.datetime.utcnow()})
+    pending = jobs._new_job('dcm_convert', input_)
+    pending['modified'] = old
+    running = jobs._new_job('dcm_convert', input_)
+    running.update({'state': 'running', 'modified': old})
+    db.jobs.insert_many([first, second, third, pending, running])
+    assert jobs.archive_jobs(db, 86400) == 2
+    # the old terminal jobs are moved, the recent and the active jobs stay
+    assert sorted(j['_id'] for j in db.jobs_archive.find()) == sorted([first['_id'], second['_id']])
+    assert sorted(j['_id'] for j in db.jobs.find()) == sorted([third['_id'], pending['_id'], running['_id']])
+    assert jobs.find_job(db, first['_id'])['state'] == 'failed'
+    assert jobs.find_job(db, third['_id'])['state'] == 'complete'
+    assert [j['_id'] for j in jobs.job_attempts(db, third)] == [first['_id'], second['_id'], third['_id']]
+    # a job copied by an interrupted run is removed by the next one
+    db.jobs_archive.insert_one(dict(third, modified=old))
+    db.jobs.update_one({'_id': third['_id']}, {'$set': {'modified': old}})
+    assert jobs.archive_jobs(db, 86400) == 1
+    assert db.jobs.count() == 2 and db.jobs_archive.count() == 3
+    assert jobs.archive_jobs(db, 86400) == 0
@@ -0,0 +1,161 @@
+import random
+import string
+import difflib
+import datetime
+
+from api.dao import reaperutil
+
+
+def _difflib_match(group_name, group_ids):
+    matches = difflib.get_close_matches(group_name, group_ids, cutoff=0.8)
+    return matches[0] if len(matches) == 1 else None
+
+def test_group_matcher():
+    group_ids = ['unknown', 'scitran', 'scitran2', 'neuro', 'neurolab', 'ab']
+    group_matcher = reaperutil.GroupMatcher(group_ids)
+    assert group_matcher.match('neurolab') == 'neurolab'
+    assert group_matcher.match('neurolob') == 'neurolab'
+    # close to both scitran and scitran2
+    assert group_matcher.match('scitran') is None
+    assert group_matcher.match('ab') == 'ab'
+    assert group_matcher.match('') is None
+
+def test_group_matcher_same_as_difflib():
+    rnd = random.Random(0)
+    chars = 'abcde' # small alphabet for many close matches
+    group_ids = list(set(''.join(rnd.choice(chars) for _ in range(rnd.randint(1, 12))) for _ in range(300)))
+    group_matcher = reaperutil.GroupMatcher(group_ids)
+    for i in range(300):
+        group_name = rnd.choice(group_ids)
+        j = rnd.randrange(len(group_name))
+        if i % 3 == 1: # misspelled
+            group_name = group_name[:j] + rnd.choice(string.ascii_lowercase) + group_name[j:]
+        elif i % 3 == 2: # truncated
+            group_name = group_name[:j]
+        assert group_matcher.match(group_name) == _difflib_match(group_name, group_ids)
+        # memoized result
+        assert group_matcher.match(group_name) == _difflib_match(group_name, group_ids)
+
+def test_match_group_rebuilt_on_stamp(monkeypatch):
+    groups = [{'_id': 'neurolab'}]
+    status = {}
+    db = type('db', (object,), {
+        'groups': type('groups', (object,), {'find': lambda self, query, fields: list(groups)})(),
+        'groups_status': type('groups_status', (object,), {
+            'find_one': lambda self, query: status.get(query['_id']),
+            'update_one': lambda self, query, update, upsert: status.setdefault(query['_id'], {'stamp': 0}).update(stamp=status[query['_id']]['stamp'] + 1),
+        })(),
+    })()
+    monkeypatch.setattr(reaperutil.config, 'db', db)
+    reaperutil.invalidate_group_matcher()
+    assert reaperutil._match_group('neurolob') == 'neurolab'
+    assert reaperutil._match_group('scitrn') is None
+    # created by another process
+    groups.append({'_id': 'scitran'})
+    assert reaperutil._match_group('scitrn') is None
+    reaperutil.groups_changed(db)
+    reaperutil._group_matcher = reaperutil.GroupMatcher(['neurolab'], stamp=0) # other process's matcher
+    assert reaperutil._match_group('scitrn') == 'scitran'
+
+def _hierarchy_db(db):
+    db.groups.insert_one({'_id': 'unknown', 'roles': []})
+    db.groups.insert_one({'_id': 'scitran', 'roles': [{'_id': 'admin@example.com', 'access': 'admin'}]})
+    reaperutil.invalidate_group_matcher()
+    reaperutil.hierarchy_cache.clear()
+
+def _metadata(acquisition_uid='1.2.3.4', timestamp='2016-08-01T10:00:00'):
+    return {
+        'group': {'_id': 'scitran'},
+        'project': {'label': 'neuro'},
+        'session': {'uid': '1.2.3'},
+        'acquisition': {'uid': acquisition_uid, 'timestamp': timestamp, 'timezone': 'UTC'},
+        'file': {'name': 'scan.dcm'},
+    }
+
+def test_container_hierarchy_cache_miss(db):
+    _hierarchy_db(db)
+    acquisition = reaperutil.create_container_hierarchy(_metadata()).acquisition
+    session = db.sessions.find_one({'uid': '1.2.3'})
+    project = db.projects.find_one({'_id': session['project']})
+    assert (project['group'], project['label']) == ('scitran', 'neuro')
+    assert acquisition['session'] == session['_id']
+    assert project['timestamp'] == session['timestamp'] == datetime.datetime(2016, 8, 1, 10)
+
+def test_container_hierarchy_cache_hit(db, monkeypatch):
+    _hierarchy_db(db)
+    acquisition = reaperutil.create_container_hierarchy(_metadata()).acquisition
+    old = datetime.datetime(2016, 1, 1)
+    db.acquisitions.update_one({'_id': acquisition['_id']}, {'$set': {'modified': old}})
+    db.sessions.update_one({'uid': '1.2.3'}, {'$set': {'modified': old}})
+    upserts = []
+    upsert_session = reaperutil._upsert_session
+    monkeypatch.setattr(reaperutil, '_upsert_session', lambda *args: upserts.append(args) or upsert_session(*args))
+    cached = reaperutil.create_container_hierarchy(_metadata()).acquisition
+    # the session and its project are not looked up again, the containers are still updated
+    assert upserts == []
+    assert cached['_id'] == acquisition['_id']
+    assert cached['modified'] > old
+    assert db.sessions.find_one({'uid': '1.2.3'})['modified'] > old
+    # a new acquisition of the cached session
+    other = reaperutil.create_container_hierarchy(_metadata(acquisition_uid='1.2.3.5')).acquisition
+    assert upserts == []
+    assert other['_id'] != acquisition['_id'] and other['session'] == acquisition['session']
+    assert (db.projects.count(), db.sessions.count(), db.acquisitions.count()) == (1, 1, 2)
+
+def test_container_hierarchy_cache_stale(db):
+    _hierarchy_db(db)
+    acquisition = reaperutil.create_container_hierarchy(_metadata()).acquisition
+    # another process moves the cached session to another project
+    other_project = db.projects.insert_one({'group': 'scitran', 'label': 'other', 'permissions': [], 'public': False}).inserted_id
+    db.sessions.update_one({'_id': acquisition['session']}, {'$set': {'project': other_project}})
+    reaperutil.create_container_hierarchy(_metadata())
+    assert reaperutil.hierarchy_cache.get(('session', '1.2.3'))['project'] == other_project
+    cached = reaperutil.create_container_hierarchy(_metadata(timestamp='2016-08-02T10:00:00')).acquisition
+    assert cached['_id'] == acquisition['_id']
+    # the timestamp is applied to the project the session is in now
+    assert db.projects.find_one({'_id': other_project})['timestamp'] == datetime.datetime(2016, 8, 2, 10)
+    assert db.projects.find_one({'label': 'neuro'})['timestamp'] == datetime.datetime(2016, 8, 1, 10)
+    # and deletes the cached acquisition
+    db.acquisitions.delete_one({'_id': acquisition['_id']})
+    recreated = reaperutil.create_container_hierarchy(_metadata()).acquisition
+    assert recreated['_id'] != acquisition['_id'] and recreated['session'] == acquisition['session']
+    assert db.acquisitions.count() == 1
+
+def _refcounts(db):
+    return dict((blob['_id'], blob['refcount']) for blob in db.blobs.find())
+
+def test_commit_fileinfos(db):
+    _id = db.acquisitions.insert_one({'files': [{'name': 'a.txt', 'hash': 'v0-sha384-a', 'size': 1}]}).inserted_id
+    added = [{'name': 'b.txt', 'hash': 'v0-sha384-b'}, {'name': 'c.txt', 'hash': 'v0-sha384-c'}]
+    updated = [{'name': 'a.txt', 'hash': 'v0-sha384-a2', 'size': 2}]
+    acquisition = reaperutil.commit_fileinfos('acquisitions', _id, added, updated)
+    assert db.acquisitions.bulk_writes == 1
+    assert [(f['name'], f['hash']) for f in acquisition['files']] == [('a.txt', 'v0-sha384-a2'), ('b.txt', 'v0-sha384-b'), ('c.txt', 'v0-sha384-c')]
+    assert acquisition['files'][0]['size'] == 2 and 'modified' in acquisition['files'][0]
+    # nothing to commit
+    assert reaperutil.commit_fileinfos('acquisitions', _id, [], []) == acquisition
+    assert db.acquisitions.bulk_writes == 1
+
+def test_commit_engine_files(db):
+    now = datetime.datetime(2016, 8, 1)
+    files = [{'name': 'a.txt', 'hash': 'v0-sha384-a'}, {'name': 'b.txt', 'hash': 'v0-sha384-b'}]
+    _id = db.acquisitions.insert_one({'files': files}).inserted_id
+    db.blobs.insert_one({'_id': 'v0-sha384-a', 'refcount': 2})
+    db.blobs.insert_one({'_id': 'v0-sha384-b', 'refcount': 1})
+    fileinfos = {
+        'a.txt': {'name': 'a.txt', 'hash': 'v0-sha384-a2', 'path': '/tmp/a.txt'},  # replaced
+        'b.txt': {'name': 'b.txt', 'info': {'checked': True}},                     # metadata only
+        'c.txt': {'name': 'c.txt', 'hash': 'v0-sha384-c', 'path': '/tmp/c.txt'},  # new
+        'd.txt': {'name': 'd.txt', 'hash': 'v0-sha384-d'},                         # not received
+    }
+    acquisition, committed = reaperutil.commit_engine_files(db.acquisitions.find_one({'_id': _id}), fileinfos, ['a.txt', 'c.txt'], now)
+    assert db.acquisitions.bulk_writes == 1
+    assert sorted(f['name'] for f in committed) == ['a.txt', 'b.txt', 'c.txt']
+    assert all('path' not in f for f in committed)
+    files = dict((f['name'], f) for f in acquisition['files'])
+    assert sorted(files) == ['a.txt', 'b.txt', 'c.txt']
+    assert files['a.txt']['hash'] == 'v0-sha384-a2' and files['a.txt']['modified'] == now
+    assert files['b.txt']['hash'] == 'v0-sha384-b' and files['b.txt']['info'] == {'checked': True}
+    assert files['c.txt']['created'] == files['c.txt']['modified'] == now
+    # the replaced blob loses one reference, the new blobs gain one, the others are unchanged
+    assert _refcounts(db) == {'v0-sha384-a': 1, 'v0-sha384-a2': 1, 'v0-sha384-b': 1, 'v0-sha384-c': 1}
@@ -1,6 +1,14 @@
 
+import os
+import hashlib
+
 import pytest
+from api import jobs
+from api import util
+from api import gears
 from api import rules
+from api import config
+from api import blobstore
 
 # Statefully holds onto some construction args and can return tuples to unroll for calling rules.eval_match.
 # Might indicate a need for a match tuple in rules.py.
@@ -199,3 +207,56 @@ def test_eval_rule_any_all():
 	file_ = {'name': 'hello.txt', 'type': 'a'}
 	result = rules.eval_rule(rule, file_, container)
 	assert result == False
+
+def _hash(data):
+	return util.format_hash('sha384', hashlib.sha384(data).hexdigest())
+
+@pytest.fixture
+def acquisition(tmpdir, db, settings):
+	"""an acquisition with a dicom file, the blobs of the outputs are stored in tmpdir"""
+	settings['persistent']['data_path'] = str(tmpdir)
+	gears._lookups.clear()
+	project = db.projects.insert_one({'group': 'scitran', 'label': 'neuro', 'permissions': []}).inserted_id
+	session = db.sessions.insert_one({'project': project, 'label': 'session'}).inserted_id
+	files = [{'name': 'scan.dcm', 'type': 'dicom', 'hash': _hash('scan'), 'measurements': []}]
+	_id = db.acquisitions.insert_one({'session': session, 'label': 'acquisition', 'files': files}).inserted_id
+	return db.acquisitions.find_one({'_id': _id})
+
+def _memo_job(db, alg_name, filehash, output, data):
+	"""a complete job of another acquisition on filehash, with output as output file"""
+	path = blobstore.resolve_path(config.get_item('persistent', 'data_path'), _hash(data))
+	os.makedirs(os.path.dirname(path))
+	with open(path, 'w') as f:
+		f.write(data)
+	input_ = jobs.FileInput(container_type='acquisition', container_id='57a0cd3d7c3b2e0011b7e5f4', filename='scan.dcm', filehash=filehash)
+	job = jobs._new_job(alg_name, input_)
+	job['state'] = 'complete'
+	job['outputs'] = {
+		'metadata': {'project': {'label': 'other'}, 'session': {'label': 'other'}, 'acquisition': {'label': 'other'}},
+		'files': [dict(output, hash=_hash(data), size=len(data))],
+		'received': [output['name']],
+	}
+	db.jobs.insert_one(job)
+
+def test_reuse_outputs(acquisition, db):
+	_memo_job(db, 'dicom_mr_classifier', _hash('scan'), {'name': 'scan.json', 'type': 'json'}, 'classified')
+	queued = rules.create_jobs_for_files(db, acquisition, 'acquisition', acquisition['files'])
+	assert sorted(queued) == ['dcm_convert', 'dicom_mr_classifier']
+	# the output file is added, the metadata of the other hierarchy is not applied
+	reused = db.acquisitions.find_one({'_id': acquisition['_id']})
+	assert [(f['name'], f['hash']) for f in reused['files']] == [('scan.dcm', _hash('scan')), ('scan.json', _hash('classified'))]
+	assert reused['label'] == 'acquisition'
+	assert db.sessions.find_one({'_id': acquisition['session']})['label'] == 'session'
+	assert db.projects.find_one()['label'] == 'neuro'
+	assert db.blobs.find_one({'_id': _hash('classified')})['refcount'] == 1
+	jobs_ = db.jobs.find({'input.container_id': str(acquisition['_id'])})
+	assert sorted((j['algorithm_id'], j['state']) for j in jobs_) == [('dcm_convert', 'pending'), ('dicom_mr_classifier', 'complete')]
+
+def test_reuse_outputs_once(acquisition, db, monkeypatch):
+	# the converted file is identical to its input, its jobs would reuse the same results again
+	_memo_job(db, 'dcm_convert', _hash('scan'), {'name': 'copy.dcm', 'type': 'dicom', 'measurements': []}, 'scan')
+	reused = []
+	monkeypatch.setattr(jobs, 'record_reused', lambda db, alg_name, *args: reused.append(alg_name))
+	rules.create_jobs_for_files(db, acquisition, 'acquisition', acquisition['files'])
+	assert reused == ['dcm_convert']
+	assert sorted(f['name'] for f in db.acquisitions.find_one({'_id': acquisition['_id']})['files']) == ['copy.dcm', 'scan.dcm']
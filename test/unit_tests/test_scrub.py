@@ -0,0 +1,39 @@
+import os
+import time
+import hashlib
+
+from api import util
+from api import files
+from api import scrub
+
+def _store(data_path, data, compress_ratio=None):
+    hash_ = util.format_hash('sha384', hashlib.sha384(data).hexdigest())
+    upload_path = os.path.join(data_path, '.upload')
+    with open(upload_path, 'wb') as fd:
+        fd.write(data)
+    path = os.path.join(data_path, util.path_from_hash(hash_))
+    files.move_file(upload_path, path, compress_ratio)
+    return hash_, path
+
+
+def test_verify_blob(tmpdir_path):
+    hash_, path = _store(tmpdir_path, 'data' * 100000, compress_ratio=0.8)
+    assert scrub.verify_blob(path, hash_) == hash_
+    hash_, path = _store(tmpdir_path, 'other data')
+    with open(path, 'r+b') as fd:
+        fd.write('O')
+    assert scrub.verify_blob(path, hash_) == util.format_hash('sha384', hashlib.sha384('Other data').hexdigest())
+    os.remove(path)
+    assert scrub.verify_blob(path, hash_) is None
+
+def test_throttle(monkeypatch):
+    now = [1000.0]
+    sleeps = []
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    throttle = scrub.Throttle(bytes_per_second=100, ops_per_second=2)
+    throttle.wait(50)
+    assert sleeps == [0.5]
+    throttle.wait(0)
+    throttle.wait(0)
+    assert sleeps[-1] == 1.5
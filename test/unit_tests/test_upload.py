@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+
+import pytest
+import webapp2
+from api import util
+from api import upload
+from api.dao import reaperutil
+
+
+@pytest.fixture
+def drone(tmpdir, db, settings):
+    """the settings of a drone upload to a store in tmpdir"""
+    settings['persistent']['data_path'] = str(tmpdir)
+    settings['core']['drone_secret'] = 'secret'
+    db.groups.insert_one({'_id': 'unknown', 'roles': []})
+    db.groups.insert_one({'_id': 'scitran', 'roles': []})
+    reaperutil.invalidate_group_matcher()
+    reaperutil.hierarchy_cache.clear()
+    return str(tmpdir)
+
+def _reaper_batch(files, infos=None):
+    metadata = {
+        'group': {'_id': 'scitran'},
+        'project': {'label': 'neuro'},
+        'session': {'uid': '1.2.3'},
+        'acquisition': {'uid': '1.2.3.4', 'files': infos or []},
+    }
+    body = '--boundary\r\nContent-Disposition: form-data; name="metadata"\r\n\r\n' + json.dumps(metadata) + '\r\n'
+    for i, (filename, data) in enumerate(files):
+        body += '--boundary\r\nContent-Disposition: form-data; name="file%d"; filename="%s"\r\n\r\n%s\r\n' % (i, filename, data)
+    return _post(body + '--boundary--\r\n')
+
+def _post(body):
+    request = webapp2.Request.blank('/upload/reaper-batch', method='POST', body=body, content_type='multipart/form-data; boundary=boundary')
+    request.headers['User-Agent'] = 'SciTran Drone reaper'
+    request.headers['X-SciTran-Auth'] = 'secret'
+    return upload.Upload(request, webapp2.Response()).reaper_batch()
+
+def _hash(data):
+    return util.format_hash('sha384', hashlib.sha384(data).hexdigest())
+
+def _refcounts(db):
+    return dict((blob['_id'], blob['refcount']) for blob in db.blobs.find())
+
+
+def test_reaper_batch(drone, db, monkeypatch):
+    lookups = []
+    create_container_hierarchy = reaperutil.create_container_hierarchy
+    monkeypatch.setattr(reaperutil, 'create_container_hierarchy', lambda metadata: lookups.append(metadata) or create_container_hierarchy(metadata))
+    result = _reaper_batch([('a.dcm', 'a'), ('b.txt', 'b'), ('c.txt', 'c')], infos=[{'name': 'a.dcm', 'type': 'dicom'}])
+    assert sorted((f['name'], f['hash']) for f in result) == [('a.dcm', _hash('a')), ('b.txt', _hash('b')), ('c.txt', _hash('c'))]
+    # the hierarchy is resolved once, the fileinfos are committed with one write
+    assert len(lookups) == 1
+    assert db.acquisitions.bulk_writes == 1
+    acquisition = db.acquisitions.find_one({'uid': '1.2.3.4'})
+    assert sorted(f['name'] for f in acquisition['files']) == ['a.dcm', 'b.txt', 'c.txt']
+    assert [f.get('type') for f in acquisition['files'] if f['name'] == 'a.dcm'] == ['dicom']
+    assert _refcounts(db) == {_hash('a'): 1, _hash('b'): 1, _hash('c'): 1}
+    # the jobs of the dicom file
+    assert sorted(j['algorithm_id'] for j in db.jobs.find()) == ['dcm_convert', 'dicom_mr_classifier']
+    # only the blobs are left in the store
+    assert sorted(os.listdir(drone)) == ['v0']
+
+def test_reaper_batch_unchanged_and_replaced_files(drone, db):
+    _reaper_batch([('a.txt', 'a'), ('b.txt', 'b')])
+    _reaper_batch([('a.txt', 'a'), ('b.txt', 'b2'), ('c.txt', 'c')])
+    acquisition = db.acquisitions.find_one({'uid': '1.2.3.4'})
+    assert sorted((f['name'], f['hash']) for f in acquisition['files']) == [('a.txt', _hash('a')), ('b.txt', _hash('b2')), ('c.txt', _hash('c'))]
+    # the unchanged file is not counted again, the replaced blob loses its reference
+    assert _refcounts(db) == {_hash('a'): 1, _hash('b'): 0, _hash('b2'): 1, _hash('c'): 1}
+
+def test_reaper_batch_failures(drone, db, monkeypatch):
+    body = '--boundary\r\nContent-Disposition: form-data; name="file0"; filename="a.txt"\r\n\r\na\r\n--boundary--\r\n'
+    with pytest.raises(webapp2.HTTPException) as exc_info:
+        _post(body)
+    # the metadata is missing
+    assert exc_info.value.code == 400
+    # the commit fails after the files are received: nothing is referenced nor queued
+    def commit_fileinfos(*args):
+        raise Exception('commit failed')
+    monkeypatch.setattr(reaperutil, 'commit_fileinfos', commit_fileinfos)
+    with pytest.raises(Exception):
+        _reaper_batch([('a.dcm', 'a'), ('b.txt', 'b')], infos=[{'name': 'a.dcm', 'type': 'dicom'}])
+    assert db.acquisitions.find_one({'uid': '1.2.3.4'}).get('files', []) == []
+    assert _refcounts(db) == {}
+    assert db.jobs.count() == 0
+    # the temporary files of the upload are removed
+    assert [name for name in os.listdir(drone) if name.startswith('.tmp')] == []
@@ -0,0 +1,40 @@
+import time
+
+from api import util
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = util.LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+def test_lru_cache_ttl(monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    cache = util.LRUCache(ttl=10)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert cache.get('a', 'expired') == 'expired'
+
+def test_lru_cache_discard():
+    cache = util.LRUCache()
+    cache.set('a', {'project': 1})
+    cache.set('b', {'project': 2})
+    cache.discard(lambda key, value: value['project'] == 1)
+    assert cache.get('a') is None
+    assert cache.get('b') == {'project': 2}
+    assert cache.pop('b') == {'project': 2}
+    assert len(cache) == 0
+
+def test_path_from_hash_depth():
+    hash_ = 'v0-sha384-01b395a1cbc0f218'
+    assert util.path_from_hash(hash_) == 'v0/sha384/01/b3/v0-sha384-01b395a1cbc0f218'
+    assert util.path_from_hash(hash_, depth=3) == 'v0/sha384/01/b3/95/v0-sha384-01b395a1cbc0f218'
+    assert util.path_from_hash(hash_, depth=0) == 'v0/sha384/v0-sha384-01b395a1cbc0f218'